@@ -0,0 +1,50 @@
+import os
+import argparse
+
+import pandas as pd
+
+from helper_files.utils import open_spreadsheet
+from helper_files.ontology import start_lookup_budget, read_needs_label, label_columns, ols_labels
+
+def define_parser():
+    """Defines and returns the argument parser."""
+    parser = argparse.ArgumentParser(description="Backfill ontology labels that were kept as IDs during conversion.")
+    parser.add_argument("-dt", "--dcp_tier1_spreadsheet", action="store",
+                        dest="dt_spreadsheet", type=str, required=True,
+                        help="DCP formeted tier 1 spreadsheet path")
+    parser.add_argument("-nl", "--needs_label", action="store",
+                        dest="needs_label", type=str, required=True,
+                        help="Path of the `_needs_label.csv` side-file written by convert_to_dcp.py")
+    parser.add_argument("-o", "--output_dir", action="store",
+                        dest="output_dir", type=str, required=False, default='metadata/dt/',
+                        help="Directory for the output files")
+    return parser
+
+def backfill_labels(spreadsheet, terms):
+    """Replace terms kept as IDs in label columns with their OLS label. Return the terms still unlabelled."""
+    labels = ols_labels(terms)
+    labels = {term: label for term, label in labels.items() if label != term}
+    for tab in spreadsheet.values():
+        for col in label_columns(tab):
+            tab[col] = tab[col].replace(labels)
+    print(f"Backfilled {len(labels)} of {len(terms)} ontology labels")
+    return set(terms) - set(labels)
+
+def main(dt_spreadsheet, needs_label, output_dir='metadata/dt/'):
+    start_lookup_budget()
+    terms = read_needs_label(needs_label)
+    dt_df = open_spreadsheet(dt_spreadsheet)
+    remaining = backfill_labels(dt_df, terms)
+
+    output_filename = os.path.basename(dt_spreadsheet).replace(".xlsx", "_labelled.xlsx")
+    with pd.ExcelWriter(os.path.join(output_dir, output_filename), engine='openpyxl') as writer:
+        for tab_name, df in dt_df.items():
+            # add empty row for "FILL OUT INFORMATION BELOW THIS ROW" row
+            df = df.reindex(index=[-1] + list(df.index)).reset_index(drop=True)
+            df.to_excel(writer, sheet_name=tab_name, index=False, startrow=3)
+    pd.DataFrame({'term': sorted(remaining), 'needs_label': True}).to_csv(needs_label, index=False)
+    print(f"Labels have been added to {os.path.join(output_dir, output_filename)}.")
+
+if __name__ == "__main__":
+    args = define_parser().parse_args()
+    main(dt_spreadsheet=args.dt_spreadsheet, needs_label=args.needs_label, output_dir=args.output_dir)
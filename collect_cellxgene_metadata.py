@@ -8,10 +8,12 @@ from helper_files.collect import (
     get_collection_data,
     generate_collection_report,
     selection_of_dataset,
-    download_h5ad_file,
+    h5ad_path,
     extract_and_save_metadata,
+    extract_and_save_metadata_chunked,
     doi_search_ingest
 )
+from helper_files.h5ad_store import H5adStore, fetch_dataset_h5ad, STORE_BUDGET_GB
 from helper_files.utils import filename_suffixed
 
 BOLD_START = '\033[1m'
@@ -35,12 +37,19 @@ def define_parser():
     parser.add_argument("-t", "--ingest_token", action="store",
                         dest="token", type=str, required=False,
                         help="Ingest token to query for existing projects with same DOI")
+    parser.add_argument("--h5ad_budget", action="store", default=STORE_BUDGET_GB,
+                        dest="h5ad_budget", type=float, required=False,
+                        help="Disk budget in GB of the h5ads/ store, least recently used H5ADs are removed above it")
+    parser.add_argument("--max_memory", action="store",
+                        dest="max_memory", type=float, required=False,
+                        help="Read obs from the H5AD in row chunks using about this many MB, for atlas-scale datasets")
     return parser
 
-def main(collection_id, dataset_id=None, label=None, output_dir="metadata/t1/", token=None):
+def main(collection_id, dataset_id=None, label=None, output_dir="metadata/t1/", token=None, collection=None, store=None, max_memory=None):
 
-    # Query collection data
-    collection = get_collection_data(collection_id)
+    # Query collection data, unless already prefetched
+    if collection is None:
+        collection = get_collection_data(collection_id)
     collection['protocols'] = [link['link_url']
                                for link in collection['links'] if link['link_type'] == 'PROTOCOL']
 
@@ -53,33 +62,29 @@ def main(collection_id, dataset_id=None, label=None, output_dir="metadata/t1/",
         .rename({'name': 'title', 'contact_name': 'study_pi'})\
         .to_csv(filename_suffixed(output_dir, label, 'study_metadata'), header=None)
         
-    # Download the H5AD file
-    mx_file = f'h5ads/{collection_id}_{dataset_id}.h5ad'
-    os.makedirs('h5ads', exist_ok=True)
-
-    h5ad_url = None
-    for dataset in collection['datasets']:
-        if dataset['dataset_id'] == dataset_id:
-            h5ad_url = [asset['url'] for asset in dataset['assets']
-                        if asset['filetype'] == 'H5AD'][0]
-            break
-
-    if h5ad_url:
-        download_h5ad_file(h5ad_url, mx_file)
-    else:
+    # Download the H5AD file, or reuse the stored copy of the same dataset version
+    store = H5adStore() if store is None else store
+    h5ad_key, mx_file = fetch_dataset_h5ad(store, collection, collection_id, dataset_id)
+    if mx_file is None:
         print("H5AD URL not found for the selected dataset.")
+        mx_file = h5ad_path(collection_id, dataset_id)
 
     label = f"{collection_id}_{dataset_id}" if not label else label
-    # Extract metadata from the AnnData file
-    adata = anndata.read_h5ad(mx_file, backed='r')
-    extract_and_save_metadata(adata, label, output_dir)
+    # Extract metadata from the AnnData file, pinned so that it is not evicted meanwhile
+    with store.pinned(h5ad_key):
+        if max_memory:
+            obs_columns = extract_and_save_metadata_chunked(mx_file, label, output_dir, max_memory)
+        else:
+            adata = anndata.read_h5ad(mx_file, backed='r')
+            extract_and_save_metadata(adata, label, output_dir)
+            obs_columns = adata.obs.columns
 
     print(f"{BOLD_START}ADDITIONAL INFO:{BOLD_END}")
     # Check if doi exists in ingest
     if token is not None:
         doi_search_ingest(coll_report['doi'], token)
 
-    if 'sequencing_platform' not in adata.obs:
+    if 'sequencing_platform' not in obs_columns:
         if 'doi' in coll_report:
             print(f"No sequencer info. See doi.org/{coll_report['doi']} for more.")
         else:
@@ -91,4 +96,5 @@ def main(collection_id, dataset_id=None, label=None, output_dir="metadata/t1/",
 
 if __name__ == "__main__":
     args = define_parser().parse_args()
-    main(collection_id=args.collection_id, dataset_id=args.dataset_id, label=args.label, output_dir=args.output_dir, token=args.token)
+    main(collection_id=args.collection_id, dataset_id=args.dataset_id, label=args.label, output_dir=args.output_dir, token=args.token,
+         store=H5adStore(budget_gb=args.h5ad_budget), max_memory=args.max_memory)
@@ -0,0 +1,67 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from helper_files.collect import extract_and_save_metadata_chunked, MAX_MEMORY_MB
+from helper_files.h5ad_obs import open_anndata, read_uns, READ_WORKERS
+from helper_files.constants.tier1_mapping import tier1
+from helper_files.utils import filename_suffixed, get_label, BOLD_START, BOLD_END
+
+UNS_FIELDS = tier1['uns']['MUST'] + tier1['uns']['RECOMMENDED']
+
+def define_parser():
+    """Defines and returns the argument parser."""
+    parser = argparse.ArgumentParser(description="Collect tier 1 metadata from a local .h5ad file or .zarr store, without network access")
+    parser.add_argument("-i", "--input", action="store",
+                        dest="input_path", type=str, required=True,
+                        help="Path of the .h5ad file or .zarr store")
+    parser.add_argument("-l", "--dataset-label", action="store",
+                        dest="label", type=str, required=False,
+                        help="Label to use instead of the input file name")
+    parser.add_argument("-o", "--output_dir", action="store",
+                        dest="output_dir", type=str, required=False, default='metadata/t1/',
+                        help="Directory for the output files")
+    parser.add_argument("--max_memory", action="store", default=MAX_MEMORY_MB,
+                        dest="max_memory", type=float, required=False,
+                        help="MB used for the obs row chunks read at a time")
+    parser.add_argument("--workers", action="store", default=READ_WORKERS,
+                        dest="workers", type=int, required=False,
+                        help="Threads reading zarr obs chunks ahead")
+    return parser
+
+def uns_value(value):
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return '||'.join(str(item) for item in value)
+    return value
+
+def main(input_path, label=None, output_dir='metadata/t1/', max_memory=MAX_MEMORY_MB, workers=READ_WORKERS):
+    if not os.path.exists(input_path):
+        raise FileNotFoundError(f"File not found at {input_path}")
+    label = get_label(input_path) if not label else label
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Study metadata from the tier 1 uns fields, the rest of uns and X are not read
+    with open_anndata(input_path) as group:
+        uns = read_uns(group, UNS_FIELDS)
+    missing_uns = [field for field in tier1['uns']['MUST'] if field not in uns]
+    if missing_uns:
+        print(f"The following REQUIRED fields are NOT present in the anndata uns: {','.join(missing_uns)}")
+    pd.DataFrame({field: uns_value(value) for field, value in uns.items()}, index=[0]).transpose()\
+        .to_csv(filename_suffixed(output_dir, label, 'study_metadata'), header=None)
+
+    obs_columns = extract_and_save_metadata_chunked(input_path, label, output_dir, max_memory, workers)
+
+    print(f"{BOLD_START}ADDITIONAL INFO:{BOLD_END}")
+    if 'sequencing_platform' not in obs_columns:
+        print("No sequencer info. Ask the data contributors for the sequencing platform.")
+
+    print(f'Output {filename_suffixed(output_dir, label, suffix=None,ext=None)}')
+
+    return label
+
+if __name__ == "__main__":
+    args = define_parser().parse_args()
+    main(input_path=args.input_path, label=args.label, output_dir=args.output_dir,
+         max_memory=args.max_memory, workers=args.workers)
@@ -1,7 +1,12 @@
+import os
 import argparse
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
 
 from helper_files.constants.tier1_mapping import entity_types, all_entities
-from helper_files.utils import open_spreadsheet, get_label, BOLD_END, BOLD_START
+from helper_files.utils import open_spreadsheet, spreadsheet_tabs, get_label, BOLD_END, BOLD_START
 from helper_files.compare import (
     check_tab_id,
     export_report_json,
@@ -9,7 +14,10 @@ from helper_files.compare import (
     compare_n_tabs,
     compare_n_ids,
     compare_v_ids,
-    compare_filled_fields
+    compare_filled_fields,
+    index_report,
+    query_field_diffs,
+    REPORT_INDEX
 )
 
 # Open cellxgene spreadsheet
@@ -26,26 +34,39 @@ def define_parser():
     """Defines and returns the argument parser."""
     parser = argparse.ArgumentParser(description="Parser for the arguments")
     parser.add_argument("-dt", "--dcp_tier1_spreadsheet", action="store",
-                        dest="tier1_spreadsheet", type=str, required=True,
+                        dest="tier1_spreadsheet", type=str, required=False,
                         help="DCP formeted tier 1 spreadsheet path")
     parser.add_argument("-w", "--wrangled_spreadsheet", action="store",
-                        dest="wrangled_spreadsheet", type=str, required=True,
+                        dest="wrangled_spreadsheet", type=str, required=False,
                         help="Previously wrangled project spreadsheet path")
     parser.add_argument("-u", "--unequal_comparisson", action="store_false",
                         dest="unequal_comparisson",
                         help="Automaticly continue comparing even if biomaterials are not equal")
+    parser.add_argument("-b", "--batch", action="store",
+                        dest="batch", type=str, required=False,
+                        help="csv with tier1_spreadsheet and wrangled_spreadsheet columns, to compare many pairs in parallel")
+    parser.add_argument("--workers", action="store",
+                        dest="workers", type=int, required=False, default=None,
+                        help="Number of parallel comparisons in batch mode")
+    parser.add_argument("-q", "--query_field", action="store",
+                        dest="query_field", type=str, required=False,
+                        help="List projects of the report index that disagree on this field, i.e. donor_organism.sex")
     return parser
 
-def main(tier1_spreadsheet, wrangled_spreadsheet, unequal_comparisson=False):
+def main(tier1_spreadsheet, wrangled_spreadsheet, unequal_comparisson=False, index_db=REPORT_INDEX):
     report_dict = init_report_dict()
 
     label = get_label(tier1_spreadsheet)
-    tier1_df = open_spreadsheet(tier1_spreadsheet)
-    wrangled_df = open_spreadsheet(wrangled_spreadsheet)
-    
+
     # Compare number of tabs
     print(f"{BOLD_START}____COMPARE TABS____{BOLD_END}")
-    report_dict = compare_n_tabs(tier1_df, wrangled_df, report_dict)
+    report_dict = compare_n_tabs(spreadsheet_tabs(tier1_spreadsheet), spreadsheet_tabs(wrangled_spreadsheet), report_dict)
+
+    # only parse the tabs that are compared
+    compared_tabs = [tab for tab in all_entities if tab in report_dict['tabs']['intersect']
+                     and tab not in entity_types['project'] + entity_types['file']]
+    tier1_df = open_spreadsheet(tier1_spreadsheet, tabs=compared_tabs)
+    wrangled_df = open_spreadsheet(wrangled_spreadsheet, tabs=compared_tabs)
 
     # compare number and values of ids for intersect tabs
     print(f"{BOLD_START}____COMPARE IDs____{BOLD_END}")
@@ -76,8 +97,52 @@ def main(tier1_spreadsheet, wrangled_spreadsheet, unequal_comparisson=False):
         report_dict = compare_filled_fields(tab, report_dict, tier1_df, wrangled_df)
 
     export_report_json(label, report_dict)
+    if index_db:
+        index_report(report_dict, label, tier1_spreadsheet, wrangled_spreadsheet, db_path=index_db)
+    return report_dict
+
+def compare_pair(tier1_spreadsheet, wrangled_spreadsheet):
+    """Compare one pair without prompting, logging the output to report_compare/<label>_compare.log"""
+    label = get_label(tier1_spreadsheet)
+    os.makedirs('report_compare', exist_ok=True)
+    with open(f'report_compare/{label}_compare.log', 'w', encoding='UTF-8') as log, redirect_stdout(log):
+        report_dict = main(tier1_spreadsheet, wrangled_spreadsheet, unequal_comparisson=True, index_db=None)
+    return label, report_dict
+
+def read_batch(batch_path):
+    pairs = pd.read_csv(batch_path, index_col=False)
+    columns = ['tier1_spreadsheet', 'wrangled_spreadsheet']
+    if not all(col in pairs.columns for col in columns):
+        raise KeyError(f"Batch csv should have the following column names: {'; '.join(columns)}. Found the following: {'; '.join(pairs.columns)}")
+    return pairs[columns].dropna().drop_duplicates()
+
+def batch_compare(batch_path, workers=None, index_db=REPORT_INDEX):
+    """Compare all tier1/ wrangled pairs of batch_path in parallel and add each report to the index"""
+    pairs = read_batch(batch_path)
+    print(f"{BOLD_START}____COMPARE {len(pairs)} PAIRS____{BOLD_END}")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(compare_pair, row.tier1_spreadsheet, row.wrangled_spreadsheet): row
+                   for row in pairs.itertuples(index=False)}
+        for future in as_completed(futures):
+            row = futures[future]
+            try:
+                label, report_dict = future.result()
+            except Exception as e:
+                print(f"{BOLD_START}FAILED{BOLD_END} {row.tier1_spreadsheet}: {e}")
+                continue
+            index_report(report_dict, label, row.tier1_spreadsheet, row.wrangled_spreadsheet, db_path=index_db)
+            print(f"Compared {label}, see report_compare/{label}_compare.json")
+    print(f"Reports indexed in {index_db}")
 
 if __name__ == "__main__":
-    args = define_parser().parse_args()
-    main(tier1_spreadsheet=args.tier1_spreadsheet, wrangled_spreadsheet=args.wrangled_spreadsheet,
-         unequal_comparisson=args.unequal_comparisson)
+    parser = define_parser()
+    args = parser.parse_args()
+    if args.query_field:
+        print(query_field_diffs(args.query_field).to_string(index=False))
+    elif args.batch:
+        batch_compare(args.batch, workers=args.workers)
+    elif not args.tier1_spreadsheet or not args.wrangled_spreadsheet:
+        parser.error("-dt and -w are required unless --batch or --query_field is given")
+    else:
+        main(tier1_spreadsheet=args.tier1_spreadsheet, wrangled_spreadsheet=args.wrangled_spreadsheet,
+             unequal_comparisson=args.unequal_comparisson)
@@ -0,0 +1,212 @@
+import io
+import json
+import time
+import uuid
+import inspect
+import argparse
+import builtins
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import collect_cellxgene_metadata
+import collect_spreadsheet_metadata
+import collect_local_metadata
+import convert_to_dcp
+import compare_with_dcp
+import merge_tier2_metadata
+import merge_file_manifest
+from helper_files.convert import get_dcp_template, get_dcp_headers, get_xml_keys
+from helper_files.ontology import start_lookup_budget, end_lookup_budget
+from helper_files.utils import start_session, thread_local_stdout, BOLD_START, BOLD_END
+
+JOBS = {
+    'collect_cellxgene': collect_cellxgene_metadata.main,
+    'collect_spreadsheet': collect_spreadsheet_metadata.main,
+    'collect_local': collect_local_metadata.main,
+    'convert': convert_to_dcp.main,
+    'merge_tier2': merge_tier2_metadata.main,
+    'merge_file_manifest': merge_file_manifest.main,
+    'compare': compare_with_dcp.main
+}
+# finished jobs kept with their log and result, older ones are dropped
+MAX_FINISHED_JOBS = 100
+
+def define_parser():
+    """Defines and returns the argument parser."""
+    parser = argparse.ArgumentParser(description="Local service running collect, convert, merge and compare jobs with warm caches")
+    parser.add_argument("--host", action="store", default='127.0.0.1',
+                        dest="host", type=str, required=False,
+                        help="Host to listen on")
+    parser.add_argument("-p", "--port", action="store", default=8765,
+                        dest="port", type=int, required=False,
+                        help="Port to listen on")
+    parser.add_argument("--workers", action="store", default=4,
+                        dest="workers", type=int, required=False,
+                        help="Number of jobs run at the same time")
+    parser.add_argument("-lt", "--local_template", action="store",
+                        dest="local_template", type=str, required=False,
+                        help="Local path of the HCA spreadsheet template, used by jobs that do not set one")
+    parser.add_argument("--max_finished_jobs", action="store", default=MAX_FINISHED_JOBS,
+                        dest="max_finished_jobs", type=int, required=False,
+                        help="Number of finished jobs kept with their log and result")
+    return parser
+
+def no_input(prompt=''):
+    raise RuntimeError(f"Interactive input is not available in service mode: {prompt.strip()}")
+
+def warm_caches(local_template=None):
+    """Load what every job would otherwise fetch again: HTTP session, DCP template and schema listing"""
+    start_session()
+    get_dcp_template(local_template)
+    get_dcp_headers(local_template)
+    get_xml_keys()
+
+def job_arguments(job, args, local_template=None):
+    """Return the keyword arguments of a job, adding the service template. Raise TypeError if they do not fit the job."""
+    if job not in JOBS:
+        raise ValueError(f"Unknown job {job}. Available jobs: {', '.join(JOBS)}")
+    params = inspect.signature(JOBS[job]).parameters
+    if local_template and 'local_template' in params and not args.get('local_template'):
+        args = {**args, 'local_template': local_template}
+    inspect.signature(JOBS[job]).bind(**args)
+    return args
+
+class JobRunner:
+    """Runs jobs on a worker pool and keeps their status, output and result.
+    Only the max_finished most recently finished jobs are kept."""
+    def __init__(self, workers=4, local_template=None, max_finished=MAX_FINISHED_JOBS):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.local_template = local_template
+        self.max_finished = max_finished
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.stdout = thread_local_stdout()
+
+    def submit(self, job, args):
+        args = job_arguments(job, args, self.local_template)
+        job_id = uuid.uuid4().hex[:12]
+        with self.lock:
+            self.jobs[job_id] = {'id': job_id, 'job': job, 'args': args, 'status': 'queued',
+                                 'submitted': time.time(), 'started': None, 'finished': None,
+                                 'log': io.StringIO(), 'result': None, 'error': None}
+        self.executor.submit(self.run, job_id)
+        return job_id
+
+    def update(self, job_id, **fields):
+        with self.lock:
+            self.jobs[job_id].update(fields)
+
+    def run(self, job_id):
+        with self.lock:
+            record = self.jobs[job_id]
+            job, args, log = record['job'], record['args'], record['log']
+        started = time.time()
+        self.update(job_id, status='running', started=started)
+        with self.stdout.capture(log):
+            # every job gets a fresh ontology lookup budget, also the ones that do not start their own,
+            # and leaves none behind on the pool thread for the next job
+            start_lookup_budget()
+            try:
+                fields = {'result': JOBS[job](**args), 'status': 'done'}
+            except Exception as e:
+                fields = {'error': f"{type(e).__name__}: {e}", 'status': 'failed'}
+                print(f"{BOLD_START}ERROR:{BOLD_END} {fields['error']}")
+            finally:
+                end_lookup_budget()
+        finished = time.time()
+        self.update(job_id, finished=finished, **fields)
+        self.evict_finished()
+        print(f"Job {job_id} {job} {fields['status']} in {finished - started:.1f}s")
+
+    def evict_finished(self):
+        """Drop the oldest finished jobs beyond max_finished, so a long-running service does not keep every log"""
+        with self.lock:
+            finished = sorted((record['finished'], job_id) for job_id, record in self.jobs.items() if record['finished'])
+            for _, job_id in finished[:max(len(finished) - self.max_finished, 0)]:
+                del self.jobs[job_id]
+
+    def status(self, job_id):
+        with self.lock:
+            record = self.jobs.get(job_id)
+            if record is None:
+                return None
+            return {**record, 'log': record['log'].getvalue()}
+
+    def summary(self):
+        with self.lock:
+            records = list(self.jobs.values())
+            return [{key: record[key] for key in ['id', 'job', 'status', 'submitted', 'finished']} for record in records]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """HTTP API of the service:
+    POST /jobs {"job": "convert", "args": {...}} submits a job and returns its id,
+    GET /jobs lists jobs, GET /jobs/<id> returns status, output and result of a job."""
+    runner = None
+
+    def send_json(self, code, body):
+        content = json.dumps(body, default=str).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        path = self.path.rstrip('/')
+        if path == '/health':
+            self.send_json(200, {'status': 'ok', 'jobs': list(JOBS)})
+        elif path == '/jobs':
+            self.send_json(200, self.runner.summary())
+        elif path.startswith('/jobs/'):
+            status = self.runner.status(path.split('/')[-1])
+            if status is None:
+                self.send_json(404, {'error': 'job not found'})
+            else:
+                self.send_json(200, status)
+        else:
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            job_id = self.runner.submit(body.get('job'), body.get('args', {}))
+        except (ValueError, TypeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        self.send_json(202, {'id': job_id})
+
+    def log_message(self, format, *args):
+        # request lines are not printed, job completions are
+        return
+
+def create_server(host='127.0.0.1', port=8765, workers=4, local_template=None, max_finished_jobs=MAX_FINISHED_JOBS):
+    runner = JobRunner(workers=workers, local_template=local_template, max_finished=max_finished_jobs)
+    handler = type('Handler', (ServiceHandler,), {'runner': runner})
+    return ThreadingHTTPServer((host, port), handler)
+
+def main(host='127.0.0.1', port=8765, workers=4, local_template=None, max_finished_jobs=MAX_FINISHED_JOBS):
+    print(f"{BOLD_START}WARMING CACHES{BOLD_END}")
+    warm_caches(local_template)
+    # jobs run unattended, so dataset or collection method selection prompts must fail instead of hanging a worker
+    builtins.input = no_input
+    server = create_server(host, port, workers, local_template, max_finished_jobs)
+    print(f"Conversion service listening on http://{host}:{server.server_address[1]} with {workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.RequestHandlerClass.runner.shutdown()
+
+if __name__ == "__main__":
+    args = define_parser().parse_args()
+    main(host=args.host, port=args.port, workers=args.workers, local_template=args.local_template,
+         max_finished_jobs=args.max_finished_jobs)
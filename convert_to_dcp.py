@@ -4,6 +4,7 @@ import pandas as pd
 
 from helper_files.constants.file_mapping import FILE_MANIFEST_MAPPING
 from helper_files.convert import (
+    EDIT_STEPS,
     read_sample_metadata,
     read_study_metadata,
     get_dcp_template,
@@ -12,16 +13,18 @@ from helper_files.convert import (
     edit_all_sample_metadata,
     create_protocol_ids,
     fill_ontologies,
-    check_enum_values,
     populate_spreadsheet,
     add_analysis_file,
-    check_required_fields,
     export_to_excel,
     tiered_suffix
 )
 from helper_files.merge import merge_file_manifest_with_flat_dcp, merge_tier2_with_flat_dcp
+from helper_files.validate import check_required_fields, check_enum_values
+from helper_files.ontology import start_lookup_budget, export_needs_label, build_matcher
+from helper_files.step_cache import STEP_CACHE_DIR
+from helper_files.step_graph import STEP_WORKERS, step_graph, render_mermaid
 
-from helper_files.utils import get_label, BOLD_END, BOLD_START
+from helper_files.utils import get_label, filename_suffixed, compact_categories, record_memory, BOLD_END, BOLD_START
 from helper_files.constants.tier1_mapping import tier1_to_dcp, collection_dict
 
 def define_parser():
@@ -45,37 +48,76 @@ def define_parser():
     parser.add_argument("-lt", "--local_template", action="store",
                         dest="local_template", type=str, required=False,
                         help="Local path of the HCA spreadsheet template")
+    parser.add_argument("--ols_deadline", action="store",
+                        dest="ols_deadline", type=float, required=False, default=600,
+                        help="Total seconds allowed for ontology lookups before keeping IDs unlabelled")
+    parser.add_argument("--ols_timeout", action="store",
+                        dest="ols_timeout", type=float, required=False, default=10,
+                        help="Timeout in seconds of a single ontology lookup")
+    parser.add_argument("--cache_dir", action="store",
+                        dest="cache_dir", type=str, required=False, default=STEP_CACHE_DIR,
+                        help="Directory of cached edit step outputs, reused when their input columns are unchanged. Empty to disable")
+    parser.add_argument("--step_workers", action="store",
+                        dest="step_workers", type=int, required=False, default=STEP_WORKERS,
+                        help="Threads running independent network-bound edit steps concurrently. 1 to run them serially")
+    parser.add_argument("--step_graph", action="store",
+                        dest="step_graph", type=str, required=False,
+                        help="Write the edit step graph with its timings and critical path as a mermaid flowchart to this path")
+    parser.add_argument("--ontology_dump", action="store", nargs='+',
+                        dest="ontology_dump", type=str, required=False,
+                        help="Ontology dumps (.obo, or csv/tsv with obo_id, label and synonyms) to match free text to ontology IDs locally instead of OLS search")
+    parser.add_argument("--memory_report", action="store_true",
+                        dest="memory_report", required=False,
+                        help="Report the memory of the metadata after each stage, compact and expanded, in <label>_memory_report.csv")
     return parser
 
-def main(flat_tier1_spreadsheet, tier2_spreadsheet=None, file_manifest=None, output_dir='metadata/dt/', skip=False, local_template=None):
+def main(flat_tier1_spreadsheet, tier2_spreadsheet=None, file_manifest=None, output_dir='metadata/dt/', skip=False, local_template=None,
+         ols_deadline=600, ols_timeout=10, cache_dir=None,
+         step_workers=STEP_WORKERS, step_graph_path=None, memory_report=False, ontology_dump=None):
     label = get_label(flat_tier1_spreadsheet)
+    start_lookup_budget(deadline=ols_deadline, timeout=ols_timeout)
     input_dir = os.path.dirname(flat_tier1_spreadsheet)
     print(f"{BOLD_START}READING FILES{BOLD_END}")
     sample_metadata = read_sample_metadata(label, input_dir)
     study_metadata = read_study_metadata(label, input_dir)
+    memory = [] if memory_report else None
+    record_memory(memory, 'read', sample_metadata)
     
     # Edit conditionally mapped fields
     print(f"{BOLD_START}CONVERTING METADATA{BOLD_END}")
-    sample_metadata = edit_all_sample_metadata(sample_metadata, collection_dict)
+    durations = {}
+    sample_metadata = edit_all_sample_metadata(sample_metadata, collection_dict, cache_dir=cache_dir or None,
+                                               max_workers=step_workers, durations=durations)
+    if step_graph_path:
+        with open(step_graph_path, 'w', encoding='utf-8') as graph:
+            graph.write(render_mermaid(step_graph(EDIT_STEPS), EDIT_STEPS, durations))
     print(f'\nConverted {"; ".join([col for col in sample_metadata if col in tier1_to_dcp])}')
+    record_memory(memory, 'edit', sample_metadata)
 
-    # Rename directly mapped fields
-    dcp_flat = sample_metadata.rename(columns=tier1_to_dcp)
+    # Rename directly mapped fields. Edits need plain values, from here on low-cardinality columns
+    # are carried as categories and only expanded at export
+    dcp_flat = compact_categories(sample_metadata.rename(columns=tier1_to_dcp))
+    record_memory(memory, 'compact', dcp_flat)
     check_enum_values(dcp_flat)
     
     # add t2
     if pd.notna(tier2_spreadsheet):
         print(f"{BOLD_START}MERGING TIER 2 METADATA{BOLD_END}")
-        dcp_flat = merge_tier2_with_flat_dcp(tier2_spreadsheet, dcp_flat, tier1_to_dcp)
+        dcp_flat = compact_categories(merge_tier2_with_flat_dcp(tier2_spreadsheet, dcp_flat, tier1_to_dcp))
+        record_memory(memory, 'merge tier 2', dcp_flat)
     # file manifest
     if pd.notna(file_manifest):
         print(f"{BOLD_START}MERGING FILE MANIFEST METADATA{BOLD_END}")
-        dcp_flat = merge_file_manifest_with_flat_dcp(dcp_flat, file_manifest, FILE_MANIFEST_MAPPING)
+        dcp_flat = compact_categories(merge_file_manifest_with_flat_dcp(dcp_flat, file_manifest, FILE_MANIFEST_MAPPING))
+        record_memory(memory, 'merge file manifest', dcp_flat)
     # Add ontology id and labels
     if not skip:
         print(f"{BOLD_START}FILLING ONTOLOGIES{BOLD_END}")
-        dcp_flat = fill_ontologies(dcp_flat)
+        matcher = build_matcher(ontology_dump) if ontology_dump else None
+        dcp_flat = compact_categories(fill_ontologies(dcp_flat, matcher=matcher))
+        record_memory(memory, 'fill ontologies', dcp_flat)
         dcp_flat = add_analysis_file(dcp_flat, label)
+        record_memory(memory, 'analysis file', dcp_flat)
     
     # Generate spreadsheet
     dcp_spreadsheet = get_dcp_template(local_template)
@@ -84,17 +126,25 @@ def main(flat_tier1_spreadsheet, tier2_spreadsheet=None, file_manifest=None, out
     dcp_spreadsheet = add_title(study_metadata, dcp_spreadsheet)
     
     if not skip:
-        dcp_flat = create_protocol_ids(dcp_spreadsheet, dcp_flat)
+        dcp_flat = compact_categories(create_protocol_ids(dcp_spreadsheet, dcp_flat))
+        record_memory(memory, 'protocol ids', dcp_flat)
 
     # Populate spreadsheet
     print(f"{BOLD_START}POPULATING SPREADSHEET{BOLD_END}")
     dcp_spreadsheet = populate_spreadsheet(dcp_spreadsheet, dcp_flat)
+    record_memory(memory, 'populate', dcp_spreadsheet)
     
     check_required_fields(dcp_spreadsheet)
 
     print(f"{BOLD_START}EXPORTING SPREADSHEET{BOLD_END}")
     export_to_excel(dcp_spreadsheet, output_dir, label, local_template, 
                     suffix=tiered_suffix(tier2_spreadsheet, file_manifest))
+    export_needs_label(output_dir, label)
+    if memory_report:
+        report = pd.DataFrame(memory)
+        report.to_csv(filename_suffixed(output_dir, label, 'memory_report'), index=False)
+        print(f"{BOLD_START}MEMORY REPORT{BOLD_END}")
+        print('\t' + report.to_string(index=False).replace('\n', '\n\t'))
 
 if __name__ == "__main__":
     args = define_parser().parse_args()
@@ -103,4 +153,11 @@ if __name__ == "__main__":
          file_manifest=args.file_manifest,
          output_dir=args.output_dir,
          skip=args.skip,
-         local_template=args.local_template)
+         local_template=args.local_template,
+         ols_deadline=args.ols_deadline,
+         ols_timeout=args.ols_timeout,
+         cache_dir=args.cache_dir,
+         step_workers=args.step_workers,
+         step_graph_path=args.step_graph,
+         memory_report=args.memory_report,
+         ontology_dump=args.ontology_dump)
@@ -8,6 +8,8 @@ import convert_to_dcp
 import compare_with_dcp
 from helper_files.collect import selection_of_dataset, get_collection_data
 from helper_files.convert import tiered_suffix
+from helper_files.prefetch import prefetch_rows, PREFETCH_DEPTH, DISK_BUDGET_GB
+from helper_files.h5ad_store import H5adStore, STORE_BUDGET_GB
 from helper_files.utils import filename_suffixed, get_label, BOLD_START, BOLD_END
 
 output_dirs = {'t1': os.path.join('metadata', 't1'), 
@@ -51,6 +53,15 @@ def define_parser():
     parser.add_argument("-u", "--unequal_comparisson", action="store_false",
                         dest="unequal_comparisson",
                         help="Comparing even if biomaterials are not equal")
+    parser.add_argument("-p", "--prefetch", action="store", default=PREFETCH_DEPTH,
+                        dest="prefetch", type=int, required=False,
+                        help="Number of datasets of the input spreadsheet to download ahead while converting (0 to disable)")
+    parser.add_argument("--disk_budget", action="store", default=DISK_BUDGET_GB,
+                        dest="disk_budget", type=float, required=False,
+                        help="Maximum GB of prefetched H5ADs waiting to be converted")
+    parser.add_argument("--h5ad_budget", action="store", default=STORE_BUDGET_GB,
+                        dest="h5ad_budget", type=float, required=False,
+                        help="Disk budget in GB of the h5ads/ store, least recently used H5ADs are removed above it")
     return parser
 
 
@@ -67,17 +78,22 @@ def read_input_spreadsheet(input_path):
 def run_all_scripts(collection_id, dataset_id, label,
                     tier1_spreadsheet, tier2_spreadsheet,
                     file_manifest, wrangled_spreadsheet,
-                    token, local_template, unequal_comparisson):
+                    token, local_template, unequal_comparisson, prefetched=None, store=None):
 
     if collection_id and dataset_id:
         print(f"{BOLD_START}===C: {collection_id} D: {dataset_id}===={BOLD_END}")
-        collection = get_collection_data(collection_id)
+        if prefetched:
+            collection, dataset_id = prefetched['collection'], prefetched['dataset_id']
+        else:
+            collection = get_collection_data(collection_id)
         dataset_id = selection_of_dataset(collection, dataset_id)
         label = collect_cellxgene_metadata.main(collection_id=collection_id,
                                                 dataset_id=dataset_id,
                                                 label=label,
                                                 output_dir=output_dirs["t1"],
-                                                token=token)
+                                                token=token,
+                                                collection=collection,
+                                                store=store)
     elif tier1_spreadsheet:
         label = get_label(tier1_spreadsheet)
         print(f"{BOLD_START}===L: {label}===={BOLD_END}")
@@ -109,14 +125,17 @@ def run_all_scripts(collection_id, dataset_id, label,
 
 def main(input_spreadsheet, collection_id, dataset_id, label,
          tier1_spreadsheet, tier2_spreadsheet, file_manifest, wrangled_spreadsheet,
-         local_template, token, unequal_comparisson):
+         local_template, token, unequal_comparisson,
+         prefetch=PREFETCH_DEPTH, disk_budget=DISK_BUDGET_GB, h5ad_budget=STORE_BUDGET_GB):
+    store = H5adStore(budget_gb=h5ad_budget)
     if collection_id or tier1_spreadsheet:
         run_all_scripts(collection_id, dataset_id, label, tier1_spreadsheet,
                         tier2_spreadsheet, file_manifest, wrangled_spreadsheet,
-                        token, local_template, unequal_comparisson)
+                        token, local_template, unequal_comparisson, store=store)
         return
     input_df = read_input_spreadsheet(input_spreadsheet)
-    for index, row in input_df.iterrows():
+    # next datasets' metadata and H5ADs are downloaded while the current one converts
+    for index, row, prefetched in prefetch_rows(input_df.iterrows(), prefetch, disk_budget, store):
         if pd.isnull(row['collection_id']):
             print(f"Collection_id not provided for index {index}")
             continue
@@ -124,11 +143,12 @@ def main(input_spreadsheet, collection_id, dataset_id, label,
                         row['tier1_spreadsheet'], row['tier2_spreadsheet'],
                         row['file_manifest'], row['wrangled_spreadsheet'],
                         token, local_template,
-                        unequal_comparisson)
+                        unequal_comparisson, prefetched, store)
 
 
 if __name__ == "__main__":
     args = define_parser().parse_args()
     main(args.input_spreadsheet, args.collection_id, args.dataset_id, args.label,
          args.tier1_spreadsheet, args.tier2_spreadsheet, args.file_manifest,
-         args.wrangled_spreadsheet, args.local_template, args.token, args.unequal_comparisson)
+         args.wrangled_spreadsheet, args.local_template, args.token, args.unequal_comparisson,
+         args.prefetch, args.disk_budget, args.h5ad_budget)
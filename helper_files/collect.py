@@ -1,19 +1,25 @@
+import os
 from os.path import isfile, getsize
 
+import h5py
 import requests
 import pandas as pd
 
-from helper_files.constants.tier1_mapping import tier1, tier1_list
-from helper_files.utils import filename_suffixed, BOLD_START, BOLD_END
+from helper_files.constants.tier1_mapping import tier1
+from helper_files.obs_summary import ObsSummary, obs_fields, obs_key, save_obs_summary, save_summary
+from helper_files.h5ad_obs import open_anndata, obs_columns, obs_chunk_rows, iter_obs_chunks, READ_WORKERS
+from helper_files.utils import filename_suffixed, http_get, BOLD_START, BOLD_END
 
 CXG_API = 'https://api.cellxgene.cziscience.com/curation/v1'
 DEFAULT_CHUNK = 1024 * 1024
+# memory in MB for obs chunks when extracting metadata out of core
+MAX_MEMORY_MB = 1024
 
 def get_collection_data(collection_id):
     """Queries the CELLxGENE API for collection metadata and returns it."""
     headers = {'Content-Type': 'application/json'}
     url = f'{CXG_API}/collections/{collection_id}'
-    response = requests.get(url, headers=headers, timeout=20)
+    response = http_get(url, headers=headers, timeout=20)
     response.raise_for_status()
     return response.json()
 
@@ -50,50 +56,78 @@ def selection_of_dataset(collection, dataset_id):
             return dataset_df.loc[int(dataset_ix), "dataset_id"]
         print("invalid index")
 
-def download_h5ad_file(h5ad_url, output_file):
-    """Downloads the H5AD file if not already present or if size differs."""
-    print(f"{BOLD_START}DOWNLOAD ANNDATA:{BOLD_END}")
-    with requests.get(h5ad_url, stream=True, timeout=10) as res:
+def h5ad_path(collection_id, dataset_id, h5ad_dir='h5ads'):
+    return os.path.join(h5ad_dir, f'{collection_id}_{dataset_id}.h5ad')
+
+def remote_file_size(url):
+    """Size in bytes of a remote file, from its Content-Length header."""
+    response = requests.head(url, allow_redirects=True, timeout=10)
+    response.raise_for_status()
+    return int(response.headers['Content-Length'])
+
+def download_h5ad_file(h5ad_url, output_file, quiet=False):
+    """Downloads the H5AD file if not already present or if size differs.
+    The file is written to `<output_file>.part` and renamed once complete,
+    so an interrupted download is never mistaken for a local copy."""
+    if not quiet:
+        print(f"{BOLD_START}DOWNLOAD ANNDATA:{BOLD_END}")
+    with http_get(h5ad_url, stream=True, timeout=10) as res:
         res.raise_for_status()
         filesize = int(res.headers['Content-Length'])
         if not isfile(output_file):
-            with open(output_file, 'wb') as df:
+            part_file = output_file + '.part'
+            with open(part_file, 'wb') as df:
                 total_bytes_received = 0
                 for chunk in res.iter_content(chunk_size=DEFAULT_CHUNK):
                     df.write(chunk)
                     total_bytes_received += len(chunk)
+                    if quiet:
+                        continue
                     percent_of_total_upload = float('{:.1f}'.format(
                         total_bytes_received / filesize * 100))
                     print(
                         f'\033[1m\033[38;5;10m{percent_of_total_upload}% downloaded {output_file}\033[0m\r', end='')
+            os.replace(part_file, output_file)
         elif getsize(output_file) != filesize:
             print("Local " + output_file + " and remote file has different size.")
             print("Please check if the local file is corrupted, rename it, and retry.")
-        else:
+        elif not quiet:
             print("Local " + output_file + " and remote file, has same size.")
 
 
 def extract_and_save_metadata(adata, label=None, output_dir='metadata'):
     """Extracts and saves metadata from the AnnData object."""
     print(f"{BOLD_START}EXTRACT METADATA:{BOLD_END}")
-    tier1_in_object = [key for key in adata.obs.keys() if key in tier1_list]
-    
-    # Save essential metadata
-    if 'library_id' in adata.obs:
-        pd.DataFrame(adata.obs[tier1_in_object].drop_duplicates()).set_index('library_id')\
-            .to_csv(filename_suffixed(output_dir, label, 'metadata'))
-    else:
-        print("No library_id information. Saving tier 1 with donor_id index.\n")
-        pd.DataFrame(adata.obs[tier1_in_object].drop_duplicates()).set_index('donor_id')\
-            .to_csv(filename_suffixed(output_dir, label, 'metadata'))
+    # Save essential metadata, one row per library, with the cell counts and fields varying within a library
+    save_obs_summary(adata.obs, label, output_dir)
     # Save full cell observations
     pd.DataFrame(adata.obs).to_csv(filename_suffixed(output_dir, label, 'cell_obs'))
 
-    # Check for missing fields
+    report_missing_fields(adata.obs.keys())
+
+def extract_and_save_metadata_chunked(anndata_path, label=None, output_dir='metadata', max_memory=MAX_MEMORY_MB, workers=READ_WORKERS):
+    """Same outputs as extract_and_save_metadata, reading obs straight from an .h5ad file or .zarr store
+    in row chunks of about max_memory MB in total, so that memory does not grow with the number of cells.
+    Zarr chunks are read ahead by `workers` threads. Return the obs columns."""
+    print(f"{BOLD_START}EXTRACT METADATA:{BOLD_END}")
+    cell_obs_path = filename_suffixed(output_dir, label, 'cell_obs')
+    with open_anndata(anndata_path) as group:
+        columns = obs_columns(group)
+        workers = 1 if isinstance(group, h5py.Group) else workers
+        summary = ObsSummary(obs_fields(columns), obs_key(columns))
+        chunks = iter_obs_chunks(group, obs_chunk_rows(group, max_memory / workers), workers=workers)
+        for i, chunk in enumerate(chunks):
+            summary.add(chunk)
+            chunk.to_csv(cell_obs_path, mode='a' if i else 'w', header=not i)
+    save_summary(summary.result(), label, output_dir)
+    report_missing_fields(columns)
+    return columns
+
+def report_missing_fields(obs_columns):
     missing_must_fields = [must for must in tier1['obs']
-                           ['MUST'] if must not in adata.obs.keys()]
+                           ['MUST'] if must not in obs_columns]
     missing_recom_fields = [rec for rec in tier1['obs']
-                            ['RECOMMENDED'] if rec not in adata.obs.keys()]
+                            ['RECOMMENDED'] if rec not in obs_columns]
 
     if missing_must_fields:
         print(f"The following REQUIRED fields are NOT present in the anndata obs: {','.join(missing_must_fields)}")
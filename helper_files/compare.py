@@ -3,9 +3,14 @@ import re
 import sys
 import select
 import json
+import sqlite3
+
+import numpy as np
+import pandas as pd
+from pandas.util import hash_pandas_object
 
 from helper_files.constants.tier1_mapping import entity_types
-from helper_files.utils import BOLD_END, BOLD_START
+from helper_files.utils import cell_hashes, BOLD_END, BOLD_START
 
 def get_tab_id(tab, spreadsheet):
     id_suffixs = ['.biomaterial_core.biomaterial_id', '.file_core.file_name', '.protocol_core.protocol_id']
@@ -33,10 +38,62 @@ def get_number_of_field(tab, spreadsheet, field):
 def get_values_of_field(tab, spreadsheet, field):
     return spreadsheet[tab][field].dropna().tolist()
 
+def get_id_index(tab, spreadsheet, field):
+    """Hashed index of the non-empty IDs of a tab, in spreadsheet order"""
+    return pd.Index(spreadsheet[tab][field].dropna())
+
 def export_report_json(label, report_dict):
     with open(f'report_compare/{label}_compare.json', 'w', encoding='UTF-8') as json_file:
                     json.dump(report_dict, json_file)
 
+REPORT_INDEX = 'report_compare/compare_index.sqlite'
+REPORT_INDEX_TABLES = """
+CREATE TABLE IF NOT EXISTS reports (label TEXT PRIMARY KEY, tier1_spreadsheet TEXT, wrangled_spreadsheet TEXT,
+                                    n_tabs_tier1 INTEGER, n_tabs_wrangled INTEGER);
+CREATE TABLE IF NOT EXISTS tabs (label TEXT, tab TEXT, status TEXT, n_ids_tier1 INTEGER, n_ids_wrangled INTEGER);
+CREATE TABLE IF NOT EXISTS ids (label TEXT, tab TEXT, origin TEXT, id TEXT);
+CREATE TABLE IF NOT EXISTS value_diffs (label TEXT, tab TEXT, field TEXT, id TEXT, tier1, wrangled);
+CREATE INDEX IF NOT EXISTS value_diffs_field ON value_diffs (field);
+CREATE INDEX IF NOT EXISTS ids_tab ON ids (tab);
+"""
+
+def sql_value(value):
+    return value if value is None or isinstance(value, (str, int, float)) else json.dumps(value, default=str)
+
+def index_report(report_dict, label, tier1_spreadsheet=None, wrangled_spreadsheet=None, db_path=REPORT_INDEX):
+    """Add a compare report to the sqlite index, replacing previous results of the same label"""
+    tabs_n = report_dict['tabs']['n']
+    tab_status = {tab: 'intersect' for tab in report_dict['tabs']['intersect']}
+    for origin, excess_tabs in report_dict['tabs']['excess'].items():
+        tab_status.update({tab: f'{origin}_excess' for tab in excess_tabs})
+    tabs = [(label, tab, status, report_dict['ids']['n'].get(tab, {}).get('tier1'), report_dict['ids']['n'].get(tab, {}).get('wrangled'))
+            for tab, status in tab_status.items()]
+    ids = [(label, tab, origin, str(id)) for tab in report_dict['ids']['values']
+           for origin in ['tier1', 'wrangled'] for id in get_unmatched_ids(report_dict, tab, origin)]
+    value_diffs = [(label, tab, field, str(id), sql_value(values.get('tier1')), sql_value(values.get('wrangled')))
+                   for tab, tab_values in report_dict['values'].items()
+                   for field, field_diffs in tab_values.get('values_diff', {}).items()
+                   for id, values in field_diffs.items()]
+    with sqlite3.connect(db_path) as conn:
+        conn.executescript(REPORT_INDEX_TABLES)
+        for table in ['reports', 'tabs', 'ids', 'value_diffs']:
+            conn.execute(f'DELETE FROM {table} WHERE label = ?', (label,))
+        conn.execute('INSERT INTO reports VALUES (?, ?, ?, ?, ?)',
+                     (label, tier1_spreadsheet, wrangled_spreadsheet, tabs_n.get('tier1'), tabs_n.get('wranlged')))
+        conn.executemany('INSERT INTO tabs VALUES (?, ?, ?, ?, ?)', tabs)
+        conn.executemany('INSERT INTO ids VALUES (?, ?, ?, ?)', ids)
+        conn.executemany('INSERT INTO value_diffs VALUES (?, ?, ?, ?, ?, ?)', value_diffs)
+    conn.close()
+
+def query_field_diffs(field, db_path=REPORT_INDEX):
+    """Projects with different tier 1 and wrangled values for field, with the number of differing ids"""
+    with sqlite3.connect(db_path) as conn:
+        field_diffs = pd.read_sql_query(
+            "SELECT label, tab, COUNT(*) AS n_ids, GROUP_CONCAT(id, '; ') AS ids FROM value_diffs "
+            'WHERE field = ? GROUP BY label, tab ORDER BY n_ids DESC', conn, params=(field,))
+    conn.close()
+    return field_diffs
+
 def init_report_dict():
     report_dict = {}
     report_dict['ids'] = {'n': {}, 'values': {}}
@@ -86,11 +143,12 @@ def compare_n_ids(tab, report_dict, tier1_spreadsheet, wrangled_spreadsheet, lab
 def compare_v_ids(tab, report_dict, tier1_spreadsheet, wrangled_spreadsheet):
     v_ids = {}
     tab_id = get_tab_id(tab, tier1_spreadsheet)
-    v_ids['tier1'] = get_values_of_field(tab, tier1_spreadsheet, tab_id)
-    v_ids['wrangled'] = get_values_of_field(tab, wrangled_spreadsheet, tab_id)
-    intersect_ids = [t for t in v_ids['tier1'] if t in v_ids['wrangled']]
+    tier1_ids = get_id_index(tab, tier1_spreadsheet, tab_id)
+    wrangled_ids = get_id_index(tab, wrangled_spreadsheet, tab_id)
+    v_ids['tier1'] = tier1_ids.tolist()
+    v_ids['wrangled'] = wrangled_ids.tolist()
     report_dict['ids']['values'][tab] = {'tier1': v_ids['tier1'], 'wrangled': v_ids['wrangled']}
-    if intersect_ids != v_ids['tier1']:
+    if not tier1_ids.isin(wrangled_ids).all():
         print(f"{BOLD_START}WARNING{BOLD_END}: {tab_id} IDs not identical between spreadsheets\n\t"+
               f"Tier 1 {', '.join(sorted(v_ids['tier1']))}\n\tWrangled {', '.join(sorted(v_ids['wrangled']))}")
     
@@ -98,7 +156,8 @@ def compare_v_ids(tab, report_dict, tier1_spreadsheet, wrangled_spreadsheet):
 
 def get_unmatched_ids(report_dict, tab, origin):
     opposed_origin = 'tier1' if origin == 'wrangled' else 'wrangled'
-    return set(report_dict['ids']['values'][tab][origin]) - set(report_dict['ids']['values'][tab][opposed_origin])
+    ids = pd.Index(report_dict['ids']['values'][tab][origin])
+    return set(ids.difference(pd.Index(report_dict['ids']['values'][tab][opposed_origin]), sort=False))
 
 def compare_filled_fields_stats(tab, report_dict, tier1_spreadsheet, wrangled_spreadsheet):
     tier1_cols = tier1_spreadsheet[tab].dropna(axis='columns').columns
@@ -131,6 +190,46 @@ def get_slim_comp_df(comp_df, tab):
         return comp_df_slim
     return comp_df
 
+def row_fingerprints(df):
+    return hash_pandas_object(cell_hashes(df), index=False).to_numpy()
+
+def pair_rows(comp_tier1, comp_wrang):
+    """Pair rows of two frames without IDs, first identical rows by fingerprint, then the rest by position.
+    Return the paired rows in tier 1 order, the wrangled rows relabelled with the tier 1 index."""
+    tier1_fp = pd.DataFrame({'fp': row_fingerprints(comp_tier1), 'pos': np.arange(len(comp_tier1))})
+    wrang_fp = pd.DataFrame({'fp': row_fingerprints(comp_wrang), 'pos': np.arange(len(comp_wrang))})
+    # n-th occurrence of a fingerprint in tier 1 pairs with its n-th occurrence in wrangled
+    tier1_fp['n'] = tier1_fp.groupby('fp').cumcount()
+    wrang_fp['n'] = wrang_fp.groupby('fp').cumcount()
+    pairs = tier1_fp.merge(wrang_fp, on=['fp', 'n'], suffixes=('_tier1', '_wrang'))
+    tier1_left = tier1_fp.loc[~tier1_fp['pos'].isin(pairs['pos_tier1']), 'pos'].to_numpy()
+    wrang_left = wrang_fp.loc[~wrang_fp['pos'].isin(pairs['pos_wrang']), 'pos'].to_numpy()
+    n_left = min(len(tier1_left), len(wrang_left))
+    tier1_pos = np.concatenate([pairs['pos_tier1'].to_numpy(), tier1_left[:n_left]])
+    wrang_pos = np.concatenate([pairs['pos_wrang'].to_numpy(), wrang_left[:n_left]])
+    order = np.argsort(tier1_pos, kind='stable')
+    paired_tier1 = comp_tier1.iloc[tier1_pos[order]]
+    paired_wrang = comp_wrang.iloc[wrang_pos[order]].set_axis(paired_tier1.index, axis=0)
+    return paired_tier1, paired_wrang
+
+def diff_frames(comp_tier1, comp_wrang):
+    """DataFrame.compare of two identically labelled frames. Only cells with different hashes are compared by value,
+    so 1 and 1.0 are equal, all other cells are equal and masked like compare does."""
+    changed = cell_hashes(comp_tier1).to_numpy() != cell_hashes(comp_wrang).to_numpy()
+    rows, cols = changed.any(axis=1), changed.any(axis=0)
+    tier1, wrang = comp_tier1.loc[:, cols], comp_wrang.loc[:, cols]
+    sub_tier1, sub_wrang = tier1.iloc[rows], wrang.iloc[rows]
+    differ = np.zeros(tier1.shape, dtype=bool)
+    differ[rows] = (~((sub_tier1 == sub_wrang) | (sub_tier1.isna() & sub_wrang.isna()))).to_numpy()
+    differ = pd.DataFrame(differ, index=tier1.index, columns=tier1.columns)
+    keep_rows = differ.any(axis=1)
+    differ = differ.loc[:, differ.any(axis=0)]
+    # masked over all rows, as compare does, so integer and boolean fields with equal cells turn float and object
+    columns = pd.MultiIndex.from_product([differ.columns, ['tier1', 'wrangled']])
+    return pd.DataFrame({(col, origin): frame[col].where(differ[col])[keep_rows]
+                         for col in differ.columns for origin, frame in [('tier1', tier1), ('wrangled', wrang)]},
+                        index=differ.index[keep_rows], columns=columns)
+
 def compare_filled_fields(tab, report_dict, tier1_spreadsheet, wrangled_spreadsheet):
     report_dict = compare_filled_fields_stats(tab, report_dict, tier1_spreadsheet, wrangled_spreadsheet)
     tier1_excess_fields = report_dict['values'][tab]['excess']['tier1']
@@ -138,28 +237,37 @@ def compare_filled_fields(tab, report_dict, tier1_spreadsheet, wrangled_spreadsh
     if tier1_excess_fields:
         print(f"In tab {tab} we have more metadata in Tier 1:\n\t{', '.join(tier1_excess_fields)}")
     tab_id = get_tab_id(tab, tier1_spreadsheet)
-    # get clean dfs (identical IDs & columns) to compare
+    # get clean dfs (paired rows & identical columns) to compare
     if not tab_id:
         print(f"Skipping comparisson of values for tab {tab} due to missing ID field")
         return report_dict
     if tab in entity_types['biomaterial']:
-        if not all(id in wrangled_spreadsheet[tab][tab_id].values for id in tier1_spreadsheet[tab][tab_id]):
-            print(f"{BOLD_START}WARNING{BOLD_END}: Cannot compare entities with not identical IDs")
+        key = fields_intersect[0]
+        comp_tier1 = tier1_spreadsheet[tab][fields_intersect].set_index(key).sort_index()
+        comp_wrang = wrangled_spreadsheet[tab][fields_intersect].set_index(key)
+        duplicated = comp_wrang.index.duplicated()
+        if duplicated.any():
+            duplicated_ids = comp_wrang.index[duplicated].unique().tolist()
+            report_dict['values'][tab]['duplicated_ids'] = {'wrangled': duplicated_ids}
+            print(f"{BOLD_START}WARNING{BOLD_END}: Duplicated wrangled {tab} IDs, comparing values of their first row")
+            print(f"\tWrangled {tab} duplicated IDs: {', '.join(map(str, duplicated_ids))}")
+            comp_wrang = comp_wrang[~duplicated]
+        shared_ids = comp_tier1.index.notna() & comp_tier1.index.isin(comp_wrang.index)
+        if not shared_ids.all():
+            print(f"{BOLD_START}WARNING{BOLD_END}: Not identical IDs, comparing values of the {shared_ids.sum()} shared IDs")
             print(f"\tTier1 {tab} unmatched IDs: {get_unmatched_ids(report_dict, tab, 'tier1')}")
             print(f"\tWrangled {tab} unmatched IDs: {get_unmatched_ids(report_dict, tab, 'wrangled')}")
-            return report_dict
-        comp_tier1 = tier1_spreadsheet[tab][fields_intersect].set_index(fields_intersect[0]).sort_index()
-        comp_wrang = wrangled_spreadsheet[tab][fields_intersect].set_index(fields_intersect[0]).sort_index()
+            comp_tier1 = comp_tier1[shared_ids]
+        comp_wrang = comp_wrang.reindex(comp_tier1.index)
     else:
         # protocol IDs are not defined in tier 1, therefore, we can skip them
         comp_tier1 = tier1_spreadsheet[tab][fields_intersect].drop(columns=get_tab_id(tab, tier1_spreadsheet))
         comp_wrang = wrangled_spreadsheet[tab][fields_intersect].drop(columns=get_tab_id(tab, wrangled_spreadsheet))
         if len(comp_tier1) != len(comp_wrang):
-            print(f'More rows ({max(len(comp_wrang), len(comp_tier1))} > {min(len(comp_wrang), len(comp_tier1))}) in {"wrangled" if len(comp_wrang) > len(comp_tier1) else "tier1"}' + \
-                   'Cannot compare protocol entities with not equal number of rows')
-            return report_dict
-    comp_wrang = comp_wrang.reindex(comp_tier1.index)
-    comp_df = comp_tier1.compare(comp_wrang,result_names= ('tier1', 'wrangled'), align_axis=1)
+            print(f'More rows ({max(len(comp_wrang), len(comp_tier1))} > {min(len(comp_wrang), len(comp_tier1))}) in {"wrangled" if len(comp_wrang) > len(comp_tier1) else "tier1"}. ' + \
+                   'Comparing identical rows first and the rest by position')
+        comp_tier1, comp_wrang = pair_rows(comp_tier1, comp_wrang)
+    comp_df = diff_frames(comp_tier1, comp_wrang)
     comp_df = drop_external_ids(comp_df)
     report_dict['values'][tab]['values_diff'] = {}
     for field in comp_df.columns.levels[0]:
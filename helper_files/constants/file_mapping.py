@@ -6,6 +6,18 @@ FILE_MANIFEST_MAPPING = {
     "lane_index": "sequence_file.lane_index"
 }
 
+# Compact dtypes of the file manifest columns, so that large manifests can be streamed in chunks.
+# lane_index is read as text and made Int16 when all its values are integers
+FILE_MANIFEST_DTYPES = {
+    "file_name": "str",
+    "library_ID": "category",
+    "file_format": "category",
+    "read_index": "category",
+    "lane_index": "category"
+}
+
+FILE_MANIFEST_CHUNKSIZE = 100000
+
 TIER_1_MAPPING = {
     "library_id": "cell_suspension.biomaterial_core.biomaterial_id",
     # "library_id_repository": "cell_suspension.biomaterial_core.biosamples_accession",
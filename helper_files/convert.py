@@ -1,16 +1,17 @@
 import os
 import re
+from functools import lru_cache
+
 import requests
 
 import pandas as pd
 from numpy import nan
 from packaging.version import parse as parse_version
 
-from helper_files.constants.tier1_mapping import collection_dict, prot_def_field, tier1_enum, dev_to_age_dict, age_to_dev_dict, tier1
-from helper_files.constants.required_fields import required_fields
-from helper_files.utils import filename_suffixed, BOLD_START, BOLD_END
-
-KEY_COLS = ["donor_id", "sample_id", "dataset_id", "library_id"]
+from helper_files.constants.tier1_mapping import collection_dict, prot_def_field, dev_to_age_dict, age_to_dev_dict, tier1, KEY_COLS
+from helper_files.utils import filename_suffixed, http_get, replace_values, concat_categories, expand_categories, BOLD_START, BOLD_END
+from helper_files.ontology import get_budget, ols_label, ols_labels
+from helper_files.step_graph import run_step_graph, STEP_WORKERS
 
 def read_sample_metadata(label, dir_name):
     sample_metadata_path = filename_suffixed(dir_name, label, "metadata")
@@ -35,30 +36,42 @@ def read_study_metadata(label, dir_name):
     
     return pd.DataFrame()
 
+HCA_TEMPLATE_URL = 'https://github.com/ebi-ait/geo_to_hca/raw/master/template/hca_full_template.xlsx'
+
+# Parsed templates, by path, modification time and read options
+_TEMPLATE_CACHE = {}
+
+def read_template(path, **kwargs):
+    """Read all tabs of the template once per process and return a copy,
+    so that populating a spreadsheet never alters the cached template."""
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    key = (path, mtime, tuple(sorted((k, str(v)) for k, v in kwargs.items())))
+    if key not in _TEMPLATE_CACHE:
+        _TEMPLATE_CACHE[key] = pd.read_excel(path, sheet_name=None, **kwargs)
+    return {tab: df.copy() for tab, df in _TEMPLATE_CACHE[key].items()}
+
 def get_dcp_template(local_path=None):
     # if no internet connection, provide local path
-    hca_template_url = 'https://github.com/ebi-ait/geo_to_hca/raw/master/template/hca_full_template.xlsx'
-    path = local_path if local_path else hca_template_url
+    path = local_path if local_path else HCA_TEMPLATE_URL
     try:
-        return pd.read_excel(path, sheet_name=None, skiprows=[0, 1, 2, 4])
+        return read_template(path, skiprows=[0, 1, 2, 4])
     except FileNotFoundError:
         print(f"Local file path not found: {local_path}")
         return {}
     except ConnectionError:
-        print(f"Could not connect to {hca_template_url}. Please provide local_path instead.")
+        print(f"Could not connect to {HCA_TEMPLATE_URL}. Please provide local_path instead.")
         return {}
 
 def get_dcp_headers(local_path=None):
     # if no internet connection, provide local path
-    hca_template_url = 'https://github.com/ebi-ait/geo_to_hca/raw/master/template/hca_full_template.xlsx'
-    path = local_path if local_path else hca_template_url
+    path = local_path if local_path else HCA_TEMPLATE_URL
     try:
-        dcp_headers = pd.read_excel(path, sheet_name=None, header=None)
+        dcp_headers = read_template(path, header=None)
     except FileNotFoundError:
         print(f"Local file path not found: {path}")
         return {}
     except ConnectionError:
-        print(f"Could not connect to {hca_template_url}. Use provide local_path instead.")
+        print(f"Could not connect to {HCA_TEMPLATE_URL}. Use provide local_path instead.")
         return {}
     for tab in dcp_headers:
         dcp_headers[tab].rename(columns=dcp_headers[tab].iloc[3], inplace= True)
@@ -86,28 +99,6 @@ def tab_to_entity(tab):
 def entity_to_tab(entity):
     return entity.capitalize().replace("_", " ")
 
-# Get the ontology label instead of ontology id from OLS4
-def ols_label(ontology_id, only_label=True, ontology=None):
-    if ontology_id is nan:
-        return ontology_id
-    ontology_id = ontology_id.strip()
-    if re.match(r"\w+_\d+", ontology_id):
-        ontology_id = ontology_id.replace("_", ":")
-    if not re.match(r"\w+:[\w\d]+", ontology_id):
-        return ontology_id
-    ontology_name = ontology if ontology else ontology_id.split(":")[0].lower()
-    ontology_term = ontology_id.replace(":", "_")
-    url = f'https://www.ebi.ac.uk/ols4/api/ontologies/{ontology_name}/terms/http%253A%252F%252Fpurl.obolibrary.org%252Fobo%252F{ontology_term}'
-    if ontology_name == 'efo':
-        url = f'https://www.ebi.ac.uk/ols4/api/ontologies/{ontology_name}/terms/http%253A%252F%252Fwww.ebi.ac.uk%252Fefo%252F{ontology_term}'
-    try:
-        response = requests.get(url, timeout=100)
-        results = response.json()
-    except ConnectionError as e:
-        print(e)
-        return ontology_id
-    return results['label'] if only_label else results
-
 ## Edit sample_metadata
 def edit_collection_relative(sample_metadata):
     if 'sample_collection_relative_time_point' in sample_metadata:
@@ -174,7 +165,7 @@ def edit_ncbitaxon(sample_metadata):
 
 def edit_sex(sample_metadata):
     if 'sex_ontology_term_id' in sample_metadata:
-        sex_dict = {key: ols_label(key) for key in sample_metadata['sex_ontology_term_id'].unique() if key is not nan}
+        sex_dict = ols_labels(sample_metadata['sex_ontology_term_id'].dropna().unique())
         sample_metadata['donor_organism.sex'] = sample_metadata['sex_ontology_term_id'].replace(sex_dict).fillna('unknown')
         allowed_sex_values = ['female', 'male', 'mixed', 'unknown']
         bool_sex_values = sample_metadata['donor_organism.sex'].isin(allowed_sex_values)
@@ -261,7 +252,7 @@ def edit_cell_enrichment(sample_metadata):
         if sample_metadata['cell_enrichment'] == "na":
             return 
         sample_metadata['cell_enrichment_cell_type'] = sample_metadata['cell_enrichment'].str[:-1]
-        enrich_dict = {key: ols_label(key) for key in sample_metadata['cell_enrichment_cell_type'].unique() if key is not nan}
+        enrich_dict = ols_labels(sample_metadata['cell_enrichment_cell_type'].dropna().unique())
         sample_metadata['cell_enrichment_cell_type'] = sample_metadata['cell_enrichment_cell_type'].replace(enrich_dict)
         sample_metadata['cell_suspension.selected_cell_types.ontology'] = sample_metadata['cell_enrichment_cell_type']
         sample_metadata['cell_suspension.selected_cell_types.ontology_label'] = sample_metadata['cell_enrichment_cell_type'].replace(enrich_dict)
@@ -272,7 +263,7 @@ def dev_label(ontology):
     start_id = ['start, days post fertilization', 'start, months post birth', 'start, years post birth']
     end_id = ['end, days post fertilization', 'end, months post birth', 'end, years post birth']
     result = ols_label(ontology, only_label=False)
-    if not 'annotation' in result:
+    if not isinstance(result, dict) or 'annotation' not in result:
         print(f'Ontology {ontology} does not have annotation')
         return ' '
     start_key = [key for key in result['annotation'].keys() if key in start_id]
@@ -339,7 +330,7 @@ def edit_suspension_type(sample_metadata):
     if 'suspension_type' in sample_metadata:
         sample_metadata['library_preparation_protocol.nucleic_acid_source'] = sample_metadata['suspension_type'].replace(suspension_to_nucleic_acid)
         if any(sample_metadata['suspension_type'] == 'na'):
-            technologies = {ols_label(lib) for lib in sample_metadata.loc[sample_metadata['suspension_type'] == 'na', 'assay_ontology_term_id']}
+            technologies = set(ols_labels(sample_metadata.loc[sample_metadata['suspension_type'] == 'na', 'assay_ontology_term_id'].dropna().unique()).values())
             print("Please check if the following technologies use `bulk cell` and not single cell or nucleus:\n" + \
                   f"{'; '.join(technologies)}")
     return sample_metadata
@@ -379,40 +370,43 @@ def not_label(col, dcp_flat):
 
 def fill_ontology_labels(dcp_flat):
     ont_fields = [col for col in dcp_flat if col.endswith('ontology') and (not_text(col, dcp_flat) or not_label(col, dcp_flat))]
+    # resolve the terms of all fields at once, so they are batched per ontology
+    all_terms = {value for field in ont_fields for value in dcp_flat[field].dropna().unique() if value}
+    labels = ols_labels(all_terms)
     for field in ont_fields:
         print(field, end='; ', flush=True)
-        ont_dict = {value: ols_label(value) for value in dcp_flat[field].dropna().unique() if value}
+        ont_dict = {value: labels[value] for value in dcp_flat[field].dropna().unique() if value in labels}
         if not_text(field, dcp_flat):
-            dcp_flat[field.replace("ontology","text")] = dcp_flat[field].replace(ont_dict)
+            dcp_flat[field.replace("ontology","text")] = replace_values(dcp_flat[field], ont_dict)
         if not_label(field, dcp_flat):
-            dcp_flat[field.replace("ontology","ontology_label")] = dcp_flat[field].replace(ont_dict)
+            dcp_flat[field.replace("ontology","ontology_label")] = replace_values(dcp_flat[field], ont_dict)
     print('\t')
     return dcp_flat
 
+@lru_cache(maxsize=None)
 def get_xml_keys(schemas_url="https://schema.humancellatlas.org/"):
-    response = requests.get(schemas_url, timeout=10)
-    return [key.split('</Key>')[0] for key in response.text.split('<Key>')]
+    response = http_get(schemas_url, timeout=10)
+    return tuple(key.split('</Key>')[0] for key in response.text.split('<Key>'))
 
-def get_entity_schema(entity, xml_keys, schemas_url="https://schema.humancellatlas.org/"):
+def get_schema_key(entity, xml_keys):
+    """Return the key of the latest version of the entity schema i.e. type/biomaterial/15.5.0/donor_organism"""
     entity_keys = [key for key in xml_keys if key.split('/')[-1] == entity]
     if not entity_keys:
-        return {}
+        return None
     entity_key_versions = [parse_version(key.split('/')[-2]) for key in entity_keys]
-    # use the latest version
-    key = entity_keys[entity_key_versions.index(max(entity_key_versions))]
-    response = requests.get(schemas_url + key, timeout=10)
-    return response.json()
+    return entity_keys[entity_key_versions.index(max(entity_key_versions))]
 
-def get_enum_restriction(field, xml_keys, schemas_url="https://schema.humancellatlas.org/"):
-    key_schema = {}
-    if field.split('.')[-1] in ['text', 'ontology', 'ontology_label']:
-        field = '.'.join(field.split('.')[:-1])
-    prop = field.split('.')[-1]
-    key = field.split('.')[-2]
-    key_schema = get_entity_schema(key, xml_keys, schemas_url)
-    if key_schema and 'enum' in key_schema['properties'][prop]:
-        return key_schema['properties'][prop]['enum']
-    print(f'Could not retrieve enum restriction for {field}')
+# schemas are cached by their versioned key, so a new schema release is fetched again
+_SCHEMA_CACHE = {}
+
+def get_entity_schema(entity, xml_keys, schemas_url="https://schema.humancellatlas.org/"):
+    key = get_schema_key(entity, xml_keys)
+    if not key:
+        return {}
+    if key not in _SCHEMA_CACHE:
+        response = http_get(schemas_url + key, timeout=10)
+        _SCHEMA_CACHE[key] = response.json()
+    return _SCHEMA_CACHE[key]
 
 def get_ontology_restriction(field, xml_keys, schemas_url="https://schema.humancellatlas.org/"):
     key_schema = {}
@@ -427,33 +421,46 @@ def get_ontology_restriction(field, xml_keys, schemas_url="https://schema.humanc
         prev_key = field.split('.')[-4]
         prev_key_schema = get_entity_schema(prev_key, xml_keys, schemas_url)['properties'][prop]
         if '$ref' in prev_key_schema:
-            key_schema = requests.get(prev_key_schema['$ref'], timeout=10).json()
+            key_schema = get_budget().get(prev_key_schema['$ref']) or {}
         elif 'items' in prev_key_schema and '$ref' in prev_key_schema['items']:
-            key_schema = requests.get(prev_key_schema['items']['$ref'], timeout=10).json()
-    prop_schema = key_schema['properties'][ont_prop]
-    
+            key_schema = get_budget().get(prev_key_schema['items']['$ref']) or {}
+    prop_schema = key_schema.get('properties', {}).get(ont_prop, {})
+
     if not key_schema and not prop_schema:
         print(f'Could not retrieve ontology restriction for {field}')
         return
     if '$ref' in prop_schema:
-        ontology_response = requests.get(prop_schema['$ref'], timeout=10)
+        ontology_response = get_budget().get(prop_schema['$ref'])
     elif 'items' in prop_schema and '$ref' in prop_schema['items']:
-        ontology_response = requests.get(prop_schema['items']['$ref'], timeout=10)
+        ontology_response = get_budget().get(prop_schema['items']['$ref'])
     else:
         print(f'No ontology link found in {key_schema}')
         return
-    if 'ontology' in ontology_response.json()['properties']:
-        return [ont.replace('obo:','') for ont in ontology_response.json()['properties']['ontology']['graph_restriction']['ontologies']]
+    if ontology_response and 'ontology' in ontology_response.get('properties', {}):
+        return [ont.replace('obo:','') for ont in ontology_response['properties']['ontology']['graph_restriction']['ontologies']]
     return
 
-def fill_ontology_ids(term, field, xml_keys, silent=False):
+def fill_ontology_ids(term, field, xml_keys, silent=False, matcher=None):
+    """Ontology ID of the free text term in the ontologies allowed for field. With a TermMatcher,
+    the best local match is used instead of the first OLS search hit of each ontology"""
     ontologies = get_ontology_restriction(field, xml_keys)
     if not ontologies:
         return term
+    if matcher is not None:
+        candidates = matcher.match(term, ontologies, limit=1)
+        if not candidates:
+            print(f"No ontology found for {term} in {'; '.join(ontologies)}")
+            return
+        obo_id, label, _ = candidates[0]
+        if not silent:
+            print(f"Selecting {label}/{obo_id} for {term}")
+        return obo_id
     for ontology in ontologies:
         request_query = 'https://www.ebi.ac.uk/ols4/api/search?q='
-        response = requests.get(request_query + f"{term.replace(' ', '+')}&ontology={ontology}", timeout=10).json()
-        if response["response"]["numFound"] == 0:
+        response = get_budget().get(request_query + f"{term.replace(' ', '+')}&ontology={ontology}")
+        if response is None:
+            return term
+        if response.get("response", {}).get("numFound", 0) == 0:
             print(f"No ontology found for {term} in {ontology}")
             continue
         label = response["response"]["docs"][0]['label']
@@ -462,29 +469,20 @@ def fill_ontology_ids(term, field, xml_keys, silent=False):
             print(f"Selecting {label}/{obo_id} for {term}")
         return obo_id
 
-def fill_missing_ontology_ids(dcp_flat):
+def fill_missing_ontology_ids(dcp_flat, matcher=None):
     fields = [x for x in dcp_flat if x.endswith('text') and x.replace('text','ontology') not in dcp_flat]
     xml_keys = get_xml_keys()
     for field in fields:
         print(field, end='; ', flush=True)
-        ont_dict = {value: fill_ontology_ids(value, field, xml_keys, silent=True) for value in dcp_flat[field].unique() if value is not nan}
-        dcp_flat[field.replace('text','ontology')] = dcp_flat[field].replace(ont_dict)
+        ont_dict = {value: fill_ontology_ids(value, field, xml_keys, silent=True, matcher=matcher) for value in dcp_flat[field].unique() if value is not nan}
+        dcp_flat[field.replace('text','ontology')] = replace_values(dcp_flat[field], ont_dict)
     return dcp_flat
 
-def fill_ontologies(dcp_flat):
-    dcp_flat = fill_missing_ontology_ids(dcp_flat)
+def fill_ontologies(dcp_flat, matcher=None):
+    dcp_flat = fill_missing_ontology_ids(dcp_flat, matcher=matcher)
     dcp_flat = fill_ontology_labels(dcp_flat)
     return dcp_flat
 
-def check_enum_values(dcp_flat):
-    xml_keys = get_xml_keys()
-    for field in tier1_enum:
-        if field in dcp_flat:
-            enum = get_enum_restriction(field, xml_keys)
-            not_in_enum = [value for value in dcp_flat[field].unique() if value not in enum and value is not nan]
-            if not_in_enum:
-                print(f"{BOLD_START}WARNING:{BOLD_END}\n\tValue(s) `{', '.join(not_in_enum)}` are not valid in {field} schema", end='')
-
 def populate_spreadsheet(dcp_spreadsheet, dcp_flat):
     for tab in dcp_spreadsheet:
         keys_union = [key for key in dcp_spreadsheet[tab].keys() if key in dcp_flat.keys()]
@@ -498,10 +496,12 @@ def populate_spreadsheet(dcp_spreadsheet, dcp_flat):
                 df = dcp_flat[dub_cols]
                 dcp_flat.drop(columns=dub_cols, inplace=True)
                 dcp_flat[dub_cols] = df[dub_cols].apply(lambda x: '||'.join(x.dropna().astype(str)),axis=1)
-        # copy dtypes in dcp_spreadsheet
-        dcp_spreadsheet[tab] = dcp_spreadsheet[tab].astype(dcp_flat[keys_union].dtypes.to_dict())
-        # merge the two dataframes
-        dcp_spreadsheet[tab] = pd.concat([dcp_spreadsheet[tab],dcp_flat[keys_union]])
+        # copy dtypes in dcp_spreadsheet, the values' dtype for categorical columns
+        dtypes = {col: dtype.categories.dtype if isinstance(dtype, pd.CategoricalDtype) else dtype
+                  for col, dtype in dcp_flat[keys_union].dtypes.items()}
+        dcp_spreadsheet[tab] = dcp_spreadsheet[tab].astype(dtypes)
+        # merge the two dataframes, keeping compact columns categorical
+        dcp_spreadsheet[tab] = concat_categories([dcp_spreadsheet[tab], dcp_flat[keys_union]])
         dcp_spreadsheet[tab] = dcp_spreadsheet[tab].dropna(how='all').drop_duplicates()
         if tab == 'Analysis file':
             dcp_spreadsheet[tab] = dcp_spreadsheet[tab].groupby('analysis_file.file_core.file_name', as_index=False).agg(collapse_values)
@@ -528,37 +528,16 @@ def add_analysis_file(dcp_flat, label):
         # 'cell_suspension.biomaterial_core.biomaterial_id': [nan]
         }
     
-    dcp_flat = dcp_flat.assign(**{key: value*len(dcp_flat) for key, value in analysis_file_metadata.items()})
+    # literals are broadcast to every row as categories, stored once
+    dcp_flat = dcp_flat.assign(**{key: pd.Categorical(value * len(dcp_flat)) for key, value in analysis_file_metadata.items()})
     if 'dataset_id' not in dcp_flat:
-        dcp_flat['analysis_file.file_core.file_name'] = f"{label}_tier1.h5ad"
+        dcp_flat['analysis_file.file_core.file_name'] = pd.Categorical([f"{label}_tier1.h5ad"] * len(dcp_flat))
     else:
-        dcp_flat['analysis_file.file_core.file_name'] = dcp_flat.apply(lambda x: f"{x['dataset_id']}_tier1.h5ad", axis=1)
+        dataset_ids = dcp_flat['dataset_id'].astype(object).fillna('nan').astype('category')
+        dcp_flat['analysis_file.file_core.file_name'] = dataset_ids.cat.rename_categories(lambda id: f"{id}_tier1.h5ad")
     print('Added `Analysis file` info')
     return dcp_flat
 
-def check_required_fields(dcp_spreadsheet):
-    all_fields = []
-    missing_required = set()
-    missing_dict = {}
-    for tab in dcp_spreadsheet:
-        if dcp_spreadsheet[tab].empty:
-            continue
-        all_fields.extend(dcp_spreadsheet[tab].dropna(axis=1, how='all').columns.tolist())
-    for field in all_fields:
-        # req_modules = [key for key in required_fields if field.startswith(key)]
-        modules = [key for key in required_fields if key in field]
-        for module in modules:
-            missing_required.update([req_field for req_field in required_fields[module] if req_field not in all_fields])
-    for field in missing_required:
-        key = entity_to_tab(field.split('.')[0])
-        if key not in missing_dict:
-            missing_dict[key] = [field]
-        else:
-            missing_dict[key].append(field)
-    print(f"{BOLD_START}MISSING DCP REQUIRED FIELDS: {BOLD_END}")
-    for key, values in missing_dict.items():
-        print(f"\t{key}:\t{', '.join(values)}")
-
 def tiered_suffix(tier2_spreadsheet, file_manifest):
     if tier2_spreadsheet and file_manifest:
         return 'full_dcp'
@@ -574,42 +553,153 @@ def export_to_excel(dcp_spreadsheet, dir_name, label, local_template, suffix='dc
     with pd.ExcelWriter(output_path) as writer:
         for tab_name, data in dcp_spreadsheet.items():
             if not data.empty:
-                pd.concat([dcp_headers[tab_name], data], ignore_index=True).to_excel(writer, sheet_name=tab_name, index=False, header=False)
+                # compact dtypes are only expanded here
+                pd.concat([dcp_headers[tab_name], expand_categories(data.copy())], ignore_index=True).to_excel(writer, sheet_name=tab_name, index=False, header=False)
     print(f'Exported to {output_path}')
 
-def flatten_tiered_spreadsheet(tiered_spreadsheet, merge_type='inner', drop_na=True):
-    flat_df = pd.DataFrame()
-    for tab_name, tab_data in tiered_spreadsheet.items():
-        tab_data = tab_data.rename(columns=str.lower)
-        if tab_data.empty:
-            continue
-        if flat_df.empty:
-            flat_df = tab_data
-            continue
-        key_cols = [col for col in KEY_COLS if col in tab_data.columns and col in flat_df.columns]
-        if len(key_cols) > 1:
-            tab_data = tab_data.drop(columns=key_cols[1:])
-        if not key_cols:
+def is_unique_key(values):
+    try:
+        return values.notna().all() and values.is_unique
+    except TypeError:
+        # unhashable values cannot identify rows
+        return False
+
+def tab_grain(tab):
+    """Finest key column (KEY_COLS go from finest to coarsest) that identifies the rows of tab,
+    or the finest key column present if none is unique"""
+    keys = [col for col in KEY_COLS if col in tab.columns]
+    return next((col for col in keys if is_unique_key(tab[col])), keys[0] if keys else None)
+
+def plan_joins(tabs):
+    """Order tabs from finest to coarsest grain and pick the key each one is joined on.
+    Each tab is joined on the finest key it shares with the tabs before it, preferring a key unique in the tab.
+    Return a list of (tab_name, key), the first tab being the base of the joins."""
+    grain_rank = {tab_name: KEY_COLS.index(tab_grain(tab)) if tab_grain(tab) else len(KEY_COLS)
+                  for tab_name, tab in tabs.items()}
+    remaining = sorted(tabs, key=grain_rank.get)
+    base = remaining.pop(0)
+    plan = [(base, tab_grain(tabs[base]))]
+    joined_cols = set(tabs[base].columns)
+    while remaining:
+        tab_name = next((name for name in remaining if joined_cols.intersection(KEY_COLS, tabs[name].columns)), remaining[0])
+        tab = tabs[tab_name]
+        shared = [col for col in KEY_COLS if col in tab.columns and col in joined_cols]
+        if not shared:
             raise ValueError(f"No common key column found for tab '{tab_name}'. Expected one of {KEY_COLS}.")
-        key_col = key_cols[0]
-        flat_df = pd.merge(flat_df, tab_data, how=merge_type, on=key_col)
+        plan.append((tab_name, next((col for col in shared if is_unique_key(tab[col])), shared[0])))
+        joined_cols.update(tab.columns)
+        remaining.remove(tab_name)
+    return plan
+
+def join_relation(left_keys, right_keys, tab_name):
+    """Cardinality of joining right_keys on left_keys. Raise before a many-to-many join multiplies rows."""
+    left_counts, right_counts = left_keys.value_counts(), right_keys.value_counts()
+    many_to_many = left_counts[left_counts > 1].index.intersection(right_counts[right_counts > 1].index)
+    if not many_to_many.empty:
+        n_rows = int((left_counts * right_counts).sum())
+        raise ValueError(f"Joining tab '{tab_name}' on {left_keys.name} is many-to-many for {list(many_to_many[:5])}. " +
+                         f"This would multiply rows from {len(left_keys)} to {n_rows}. Check for duplicated {left_keys.name}.")
+    return f"{'one' if left_counts.max() <= 1 else 'many'}-to-{'one' if right_counts.max() <= 1 else 'many'}"
+
+def flatten_tiered_spreadsheet(tiered_spreadsheet, merge_type='inner', drop_na=True):
+    tabs = {tab_name: tab_data.rename(columns=str.lower) for tab_name, tab_data in tiered_spreadsheet.items()
+            if not tab_data.empty}
+    if not tabs:
+        return pd.DataFrame()
+    plan = plan_joins(tabs)
+    base, grain = plan[0]
+    flat_df = tabs[base]
+    print(f"Join plan: {base} ({grain}, {len(flat_df)} rows)")
+    for tab_name, key in plan[1:]:
+        # other shared key columns are already in the flat table
+        tab_data = tabs[tab_name].drop(columns=[col for col in KEY_COLS if col != key and col in flat_df.columns], errors='ignore')
+        relation = join_relation(flat_df[key], tab_data[key], tab_name)
+        flat_df = flat_df.join(tab_data.set_index(key), on=key, how=merge_type, lsuffix='_x', rsuffix='_y')
+        print(f"\t<- {tab_name} on {key} ({relation}, {len(flat_df)} rows)")
+    flat_df = flat_df.reset_index(drop=True)
     if drop_na:
         flat_df = flat_df.dropna(axis=1, how="all")
     return flat_df
 
-def edit_all_sample_metadata(sample_metadata, collection_dict):
-    sample_metadata = edit_collection_relative(sample_metadata)
-    sample_metadata = edit_ncbitaxon(sample_metadata)
-    sample_metadata = edit_sex(sample_metadata)
-    sample_metadata = edit_ethnicity(sample_metadata)
-    sample_metadata = edit_sample_source(sample_metadata)
-    sample_metadata = edit_hardy_scale(sample_metadata)
-    sample_metadata = edit_sampled_site(sample_metadata)
-    sample_metadata = edit_alignment_software(sample_metadata)
-    sample_metadata = edit_lib_prep_protocol(sample_metadata)
-    sample_metadata = edit_suspension_type(sample_metadata)
-    # sample_metadata = edit_cell_enrichment(sample_metadata) # not yet functional
-    sample_metadata = edit_dev_stage(sample_metadata)
-    sample_metadata = edit_collection_method(sample_metadata, collection_dict)
-    return sample_metadata
+# Edit steps in their serial order, with the tier 1 columns they read and the columns they write.
+# `code` lists helpers and constants whose change invalidates cached outputs of the step.
+# `network` steps wait on OLS and run concurrently with the steps they do not depend on.
+# Steps with cache False run alone on the full sample metadata every time:
+# edit_lib_prep_protocol merges the cheatsheet rows and edit_collection_method asks the user.
+EDIT_STEPS = {
+    'edit_collection_relative': {
+        'function': edit_collection_relative,
+        'inputs': ['sample_collection_relative_time_point'],
+        'outputs': ['specimen_from_organism.biomaterial_core.timecourse.value',
+                    'specimen_from_organism.biomaterial_core.timecourse.relevance',
+                    'specimen_from_organism.biomaterial_core.timecourse.unit.text']},
+    'edit_ncbitaxon': {
+        'function': edit_ncbitaxon,
+        'inputs': ['organism_ontology_term_id', 'tissue_type'],
+        'outputs': ['donor_organism.biomaterial_core.ncbi_taxon_id',
+                    'specimen_from_organism.biomaterial_core.ncbi_taxon_id',
+                    'cell_suspension.biomaterial_core.ncbi_taxon_id',
+                    'cell_line.biomaterial_core.ncbi_taxon_id',
+                    'organoid.biomaterial_core.ncbi_taxon_id'],
+        'code': [tissue_type_taxon]},
+    'edit_sex': {
+        'function': edit_sex,
+        'inputs': ['sex_ontology_term_id'],
+        'outputs': ['donor_organism.sex'],
+        'network': True},
+    'edit_ethnicity': {
+        'function': edit_ethnicity,
+        'inputs': ['self_reported_ethnicity_ontology_term_id'],
+        'outputs': ['self_reported_ethnicity_ontology_term_id']},
+    'edit_sample_source': {
+        'function': edit_sample_source,
+        'inputs': ['sample_source', 'manner_of_death'],
+        'outputs': ['specimen_from_organism.transplant_organ']},
+    'edit_hardy_scale': {
+        'function': edit_hardy_scale,
+        'inputs': ['manner_of_death'],
+        'outputs': ['donor_organism.is_living', 'donor_organism.death.hardy_scale']},
+    'edit_sampled_site': {
+        'function': edit_sampled_site,
+        'inputs': ['sampled_site_condition', 'disease_ontology_term_id'],
+        'outputs': ['specimen_from_organism.diseases.ontology',
+                    'specimen_from_organism.adjacent_diseases.ontology'],
+        'code': [sampled_site_to_known_diseases]},
+    'edit_alignment_software': {
+        'function': edit_alignment_software,
+        'inputs': ['alignment_software'],
+        'outputs': ['analysis_protocol.alignment_software',
+                    'analysis_protocol.alignment_software_version',
+                    'analysis_protocol.type.text']},
+    'edit_lib_prep_protocol': {
+        'function': edit_lib_prep_protocol,
+        'inputs': ['assay_ontology_term_id', 'assay'],
+        # columns of the cheatsheet
+        'outputs': None,
+        'cache': False},
+    'edit_suspension_type': {
+        'function': edit_suspension_type,
+        'inputs': ['suspension_type', 'assay_ontology_term_id'],
+        'outputs': ['library_preparation_protocol.nucleic_acid_source'],
+        'network': True},
+    # 'edit_cell_enrichment' not yet functional
+    'edit_dev_stage': {
+        'function': edit_dev_stage,
+        'inputs': ['development_stage_ontology_term_id', 'donor_organism.organism_age', 'age'],
+        'outputs': ['donor_organism.organism_age', 'donor_organism.organism_age_unit.text'],
+        'code': [dev_label, age_to_dev_dict],
+        'network': True},
+    'edit_collection_method': {
+        'function': edit_collection_method,
+        'inputs': ['sample_collection_method', 'manner_of_death', 'tissue_ontology_term_id', 'sample_id'],
+        'outputs': ['collection_protocol.method.text'],
+        'cache': False},
+}
+
+def edit_all_sample_metadata(sample_metadata, collection_dict, cache_dir=None, max_workers=STEP_WORKERS, durations=None):
+    """Run the EDIT_STEPS as a dependency graph (see run_step_graph). With a cache_dir, cacheable steps
+    whose input columns did not change since a previous run reuse their stored outputs."""
+    return run_step_graph(sample_metadata, EDIT_STEPS, cache_dir=cache_dir, max_workers=max_workers,
+                          step_kwargs={'edit_collection_method': {'collection_dict': collection_dict}},
+                          durations=durations)
 
@@ -0,0 +1,230 @@
+import os
+import re
+import gzip
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from helper_files.utils import BOLD_START, BOLD_END
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+BUFFER_SIZE = 8 * 1024 * 1024
+CHECKSUM_ALGORITHMS = ['md5', 'sha256', 'crc32c']
+# hex digest length of each algorithm, to recognise provided checksums
+CHECKSUM_LENGTHS = {32: 'md5', 64: 'sha256', 8: 'crc32c'}
+FASTQ_CHECKSUM_FIELD = 'sequence_file.file_core.checksum'
+
+SNIFF_RECORDS = 100
+# @<instrument>:<run>:<flowcell>:<lane>:<tile>:<x>:<y> <read>:<is filtered>:<control>:<index>
+ILLUMINA_HEADER = re.compile(rb'^@(?P<instrument>[^:\s]+):(?P<run>\d+):(?P<flowcell>[^:\s]+):(?P<lane>\d+):\d+:\d+:\d+(?:\s+(?P<read>\d):)?')
+# older Illumina headers, @<instrument>:<lane>:<tile>:<x>:<y>#<index>/<read>
+LEGACY_HEADER = re.compile(rb'^@(?P<instrument>[^:\s]+):(?P<lane>\d+):\d+:\d+:\d+(?:#\S*?)?(?:/(?P<read>\d))?(?:\s|$)')
+FILENAME_READ = re.compile(r'_(?P<read>[RI][1-4])(?:_\d{3})?\.f(?:ast)?q', re.IGNORECASE)
+FILENAME_LANE = re.compile(r'_L(?P<lane>\d{3})_')
+READ_INDEX = {'R1': 'read1', 'R2': 'read2', 'R3': 'read3', 'R4': 'read4', 'I1': 'index1', 'I2': 'index2'}
+# sniffed columns and the Sequence file fields they fill
+SNIFFED_FIELDS = {
+    'read_index': 'sequence_file.read_index',
+    'lane_index': 'sequence_file.lane_index',
+    'read_length': 'sequence_file.read_length'
+}
+
+def file_checksums(path, buffer_size=BUFFER_SIZE):
+    """Return size, md5, sha256 and crc32c (if the crc32c package is installed) of a file, read in one pass"""
+    md5, sha256, crc = hashlib.md5(), hashlib.sha256(), 0
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n_bytes = f.readinto(buffer)
+            if not n_bytes:
+                break
+            md5.update(view[:n_bytes])
+            sha256.update(view[:n_bytes])
+            if crc32c is not None:
+                crc = crc32c.crc32c(view[:n_bytes], crc)
+    return {'size': os.path.getsize(path), 'md5': md5.hexdigest(), 'sha256': sha256.hexdigest(),
+            'crc32c': f'{crc:08x}' if crc32c is not None else None}
+
+def load_checksum_cache(cache_path):
+    if not cache_path or not os.path.exists(cache_path):
+        return {}
+    with open(cache_path) as f:
+        return json.load(f)
+
+def save_checksum_cache(cache, cache_path):
+    if not cache_path:
+        return
+    with open(cache_path, 'w') as f:
+        json.dump(cache, f, indent=1)
+
+def is_cached(cache, path):
+    """Cached checksums are valid if the file has the same mtime and size, and crc32c was computed if possible"""
+    entry = cache.get(os.path.abspath(path))
+    stat = os.stat(path)
+    return entry is not None and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size \
+        and (entry['crc32c'] is not None or crc32c is None)
+
+def compute_checksums(paths, cache_path=None, max_workers=None):
+    """Return a table of file_name, path, size, md5, sha256 and crc32c for paths.
+    Files not in the cache are read in parallel processes, and the cache is updated."""
+    cache = load_checksum_cache(cache_path)
+    pending = [path for path in paths if not is_cached(cache, path)]
+    if pending:
+        print(f"Computing checksums of {len(pending)} files ({len(paths) - len(pending)} cached)")
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for path, checksums in zip(pending, executor.map(file_checksums, pending)):
+                cache[os.path.abspath(path)] = {'mtime': os.stat(path).st_mtime_ns, **checksums}
+        save_checksum_cache(cache, cache_path)
+    rows = [{'file_name': os.path.basename(path), 'path': path,
+             **{key: cache[os.path.abspath(path)][key] for key in ['size'] + CHECKSUM_ALGORITHMS}}
+            for path in paths]
+    return pd.DataFrame(rows, columns=['file_name', 'path', 'size'] + CHECKSUM_ALGORITHMS)
+
+def find_fastqs(fastq_dir, file_names):
+    """Return {file_name: path} for the file names found under fastq_dir"""
+    if not os.path.isdir(fastq_dir):
+        raise FileNotFoundError(f"Directory not found at {fastq_dir}")
+    file_names = set(file_names)
+    paths = {}
+    for root, _, files in os.walk(fastq_dir):
+        paths.update({file: os.path.join(root, file) for file in files if file in file_names and file not in paths})
+    missing = file_names - set(paths)
+    if missing:
+        print(f"{BOLD_START}WARNING:{BOLD_END} {len(missing)} fastqs not found in {fastq_dir}: {sorted(missing)[:10]}")
+    return paths
+
+def checksum_algorithm(checksum):
+    return CHECKSUM_LENGTHS.get(len(checksum)) if isinstance(checksum, str) else None
+
+def read_checksum_file(checksum_path):
+    """Read provided checksums into a table of file_name, algorithm, checksum.
+    Either md5sum/sha256sum output (`<checksum>  <file_name>`) or a csv/tsv with a file_name column
+    and md5, sha256 or crc32c columns."""
+    if not os.path.exists(checksum_path):
+        raise FileNotFoundError(f"File not found at {checksum_path}")
+    if checksum_path.endswith(('.csv', '.tsv')):
+        checksums = pd.read_csv(checksum_path, sep=',' if checksum_path.endswith('.csv') else '\t', dtype=str)
+        checksums = checksums.melt(id_vars='file_name', value_vars=[col for col in CHECKSUM_ALGORITHMS if col in checksums],
+                                   var_name='algorithm', value_name='checksum')
+    else:
+        checksums = pd.read_csv(checksum_path, sep=r'\s+\*?', header=None, names=['checksum', 'file_name'],
+                                dtype=str, engine='python')
+        checksums['file_name'] = checksums['file_name'].map(os.path.basename)
+        checksums['algorithm'] = checksums['checksum'].map(checksum_algorithm)
+    checksums['checksum'] = checksums['checksum'].str.lower()
+    return checksums.dropna(subset=['checksum', 'algorithm'])[['file_name', 'algorithm', 'checksum']]
+
+def find_mismatches(computed, provided):
+    """Return the provided checksums that differ from the computed ones"""
+    computed = computed.melt(id_vars='file_name', value_vars=CHECKSUM_ALGORITHMS,
+                             var_name='algorithm', value_name='computed').dropna(subset=['computed'])
+    compared = provided.merge(computed, on=['file_name', 'algorithm'], how='inner')
+    return compared.loc[compared['checksum'] != compared['computed']].reset_index(drop=True)
+
+def print_mismatches(mismatches):
+    print(f"{BOLD_START}WARNING:{BOLD_END} {len(mismatches)} checksums do not match the fastq files")
+    print('\t' + mismatches.to_string(index=False).replace('\n', '\n\t'))
+
+def add_checksums(seq_tab, paths, checksum_path=None, cache_path=None, max_workers=None):
+    """Compute checksums of the Sequence file tab fastqs at paths ({file_name: path}) and fill the sha256 in file_core.checksum.
+    Checksums already in the tab or in checksum_path are compared with the computed ones.
+    Return the Sequence file tab and the computed checksums with a mismatch column."""
+    computed = compute_checksums(list(paths.values()), cache_path=cache_path, max_workers=max_workers)
+
+    provided = [read_checksum_file(checksum_path)] if checksum_path else []
+    if FASTQ_CHECKSUM_FIELD in seq_tab:
+        existing = seq_tab[['sequence_file.file_core.file_name', FASTQ_CHECKSUM_FIELD]].dropna()
+        existing.columns = ['file_name', 'checksum']
+        existing = existing.assign(checksum=existing['checksum'].str.lower(),
+                                   algorithm=existing['checksum'].map(checksum_algorithm))
+        provided.append(existing.dropna(subset=['algorithm']))
+    mismatches = find_mismatches(computed, pd.concat(provided)) if provided else pd.DataFrame(columns=['file_name'])
+    if not mismatches.empty:
+        print_mismatches(mismatches)
+    computed['mismatch'] = computed['file_name'].isin(mismatches['file_name'])
+
+    sha256 = computed.set_index('file_name')['sha256']
+    seq_tab[FASTQ_CHECKSUM_FIELD] = seq_tab['sequence_file.file_core.file_name'].map(sha256)\
+        .combine_first(seq_tab.get(FASTQ_CHECKSUM_FIELD, pd.Series(index=seq_tab.index, dtype=object)))
+    return seq_tab, computed
+
+def parse_fastq_header(header):
+    """Return instrument, run, flowcell, lane and read number of an Illumina read header"""
+    match = ILLUMINA_HEADER.match(header) or LEGACY_HEADER.match(header)
+    if not match:
+        return {}
+    return {key: value.decode() for key, value in match.groupdict().items() if value is not None}
+
+def sniff_fastq(path, n_records=SNIFF_RECORDS):
+    """Read only the first n_records of a fastq(.gz) and infer read index, lane, read length, instrument and run"""
+    file_name = os.path.basename(path)
+    opener = gzip.open if path.endswith('.gz') else open
+    headers, lengths = [], []
+    try:
+        with opener(path, 'rb') as f:
+            for i, line in enumerate(f):
+                if i >= 4 * n_records:
+                    break
+                if i % 4 == 0:
+                    headers.append(line.rstrip())
+                elif i % 4 == 1:
+                    lengths.append(len(line.rstrip()))
+    except (OSError, EOFError) as e:
+        return {'file_name': file_name, 'error': str(e)}
+    if not headers or not headers[0].startswith(b'@'):
+        return {'file_name': file_name, 'error': 'not a fastq file'}
+
+    header = parse_fastq_header(headers[0])
+    filename_read = FILENAME_READ.search(file_name)
+    filename_lane = FILENAME_LANE.search(file_name)
+    if filename_read:
+        read_index = READ_INDEX[filename_read.group('read').upper()]
+    else:
+        read_index = f"read{header['read']}" if 'read' in header else None
+    lane = int(filename_lane.group('lane')) if filename_lane else int(header['lane']) if 'lane' in header else None
+    return {'file_name': file_name, 'n_records': len(headers), 'read_index': read_index, 'lane_index': lane,
+            'read_length': max(lengths), 'instrument': header.get('instrument'), 'run': header.get('run'),
+            'flowcell': header.get('flowcell'), 'first_read': headers[0].split()[0].split(b'/')[0].decode(), 'error': None}
+
+def sniff_fastqs(paths, n_records=SNIFF_RECORDS, max_workers=None):
+    """Sniff the headers of many fastqs in parallel processes"""
+    columns = ['file_name', 'n_records', 'read_index', 'lane_index', 'read_length',
+               'instrument', 'run', 'flowcell', 'first_read', 'error']
+    if not paths:
+        return pd.DataFrame(columns=columns)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        sniffed = list(executor.map(sniff_fastq, paths, [n_records] * len(paths), chunksize=32))
+    sniffed = pd.DataFrame(sniffed, columns=columns)
+    sniffed['lane_index'] = sniffed['lane_index'].astype('Int64')
+    sniffed['read_length'] = sniffed['read_length'].astype('Int64')
+    if sniffed['error'].notna().any():
+        print(f"{BOLD_START}WARNING:{BOLD_END} Could not read fastq headers of {sniffed.loc[sniffed['error'].notna(), 'file_name'].tolist()[:10]}")
+    return sniffed
+
+def add_fastq_headers(seq_tab, paths, n_records=SNIFF_RECORDS, max_workers=None):
+    """Fill read index, lane index and read length of the Sequence file tab from the fastq headers.
+    Existing values are kept, and the ones that disagree with the headers are reported.
+    Return the Sequence file tab and the sniffed headers."""
+    sniffed = sniff_fastqs(list(paths.values()), n_records=n_records, max_workers=max_workers)
+    sniffed_by_file = sniffed.set_index('file_name')
+    file_names = seq_tab['sequence_file.file_core.file_name']
+    for col, field in SNIFFED_FIELDS.items():
+        values = file_names.map(sniffed_by_file[col])
+        if field not in seq_tab:
+            seq_tab[field] = values
+            continue
+        existing = seq_tab[field]
+        conflict = existing.notna() & values.notna() & (existing.astype(str) != values.astype(str))
+        if conflict.any():
+            print(f"{BOLD_START}WARNING:{BOLD_END} {field} differs from fastq headers for {conflict.sum()} files:")
+            conflicts = pd.DataFrame({'file_name': file_names[conflict], 'spreadsheet': existing[conflict], 'fastq': values[conflict]})
+            print('\t' + conflicts.to_string(index=False).replace('\n', '\n\t'))
+        seq_tab[field] = existing.where(existing.notna(), values.astype(object))
+    return seq_tab, sniffed
@@ -0,0 +1,108 @@
+import os
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import h5py
+from anndata.experimental import read_elem
+
+# pandas keeps several copies of a chunk while coding and writing it to csv
+CHUNK_OVERHEAD = 4
+SAMPLE_ROWS = 1000
+READ_WORKERS = 4
+
+def is_zarr(path):
+    return os.path.isdir(path) or str(path).rstrip('/').endswith('.zarr')
+
+@contextmanager
+def open_anndata(path):
+    """Open an .h5ad file or a .zarr store read-only, without reading any of it"""
+    if is_zarr(path):
+        try:
+            import zarr
+        except ImportError as e:
+            raise ImportError("Reading .zarr stores requires zarr. Install it or convert the store to .h5ad.") from e
+        yield zarr.open_group(str(path), mode='r')
+    else:
+        with h5py.File(path, 'r') as h5ad:
+            yield h5ad
+
+def read_strings(array, start=None, stop=None):
+    values = array.asstr()[start:stop] if isinstance(array, h5py.Dataset) else array[start:stop]
+    return pd.Index(values, dtype=object).to_numpy()
+
+def read_obs_column(elem, start, stop):
+    """Rows start:stop of an obs column of an h5ad or zarr store, as anndata reads it"""
+    encoding = elem.attrs.get('encoding-type', '')
+    if encoding == 'categorical':
+        categories = elem['categories']
+        categories = read_strings(categories) if categories.dtype.kind in 'OS' else categories[:]
+        return pd.Categorical.from_codes(elem['codes'][start:stop], categories,
+                                         ordered=bool(elem.attrs.get('ordered', False)))
+    if encoding == 'nullable-integer':
+        return pd.arrays.IntegerArray(elem['values'][start:stop], elem['mask'][start:stop])
+    if encoding == 'nullable-boolean':
+        return pd.arrays.BooleanArray(elem['values'][start:stop], elem['mask'][start:stop])
+    if encoding == 'string-array':
+        return read_strings(elem, start, stop)
+    if encoding == 'array' and hasattr(elem, 'dtype'):
+        return elem[start:stop]
+    raise ValueError(f"Unsupported obs column encoding '{encoding}' of {elem.name}")
+
+def obs_columns(group):
+    """obs column names of an open h5ad or zarr store, in order"""
+    return [str(col) for col in group['obs'].attrs['column-order']]
+
+def obs_index(group):
+    obs = group['obs']
+    return obs[obs.attrs['_index']]
+
+def read_obs(group, start=None, stop=None, columns=None):
+    """Rows start:stop of the obs frame of an open h5ad or zarr store"""
+    obs = group['obs']
+    index_key = obs.attrs['_index']
+    index = pd.Index(read_obs_column(obs[index_key], start, stop), name=None if index_key == '_index' else index_key)
+    columns = obs_columns(group) if columns is None else columns
+    return pd.DataFrame({col: read_obs_column(obs[col], start, stop) for col in columns}, index=index)
+
+def read_uns(group, keys):
+    """{key: value} of the given uns keys present in an open h5ad or zarr store, leaving the rest of uns unread"""
+    uns = group['uns'] if 'uns' in group else {}
+    return {key: read_elem(uns[key]) for key in keys if key in uns}
+
+def obs_row_bytes(group):
+    """Estimated bytes per obs row in memory, from the first SAMPLE_ROWS rows"""
+    sample = read_obs(group, 0, SAMPLE_ROWS)
+    return max(1, int(sample.memory_usage(index=True, deep=True).sum() / max(1, len(sample))))
+
+def obs_chunk_rows(group, max_memory):
+    """Rows per chunk keeping an obs chunk, with its copies, under max_memory MB.
+    Rounded down to whole chunks of the store, if it is chunked, so no store chunk is decoded twice."""
+    rows = max(1, int(max_memory * 1024 ** 2 / (obs_row_bytes(group) * CHUNK_OVERHEAD)))
+    store_chunks = getattr(obs_index(group), 'chunks', None)
+    if store_chunks and rows > store_chunks[0]:
+        rows -= rows % store_chunks[0]
+    return rows
+
+def iter_obs_chunks(group, chunk_rows, columns=None, workers=1):
+    """Yield the obs frame of an open h5ad or zarr store in chunks of chunk_rows rows, in order.
+    Zarr chunks are read ahead by up to `workers` threads; h5py reads hold a global lock, so h5ad chunks are read one by one."""
+    n_rows = obs_index(group).shape[0]
+    # an empty obs still gives one (empty) chunk
+    starts = range(0, max(n_rows, 1), chunk_rows)
+
+    def read(start):
+        return read_obs(group, start, min(start + chunk_rows, n_rows), columns)
+
+    if workers <= 1 or isinstance(group, h5py.Group):
+        yield from map(read, starts)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        ahead = deque()
+        for start in starts:
+            ahead.append(executor.submit(read, start))
+            if len(ahead) >= workers:
+                yield ahead.popleft().result()
+        while ahead:
+            yield ahead.popleft().result()
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from os.path import isfile, getsize
+
+from helper_files.collect import h5ad_path, remote_file_size, download_h5ad_file
+from helper_files.utils import BOLD_START, BOLD_END
+
+H5AD_STORE = 'h5ads'
+STORE_BUDGET_GB = 100
+
+def find_dataset(collection, dataset_id):
+    for dataset in collection['datasets']:
+        if dataset['dataset_id'] == dataset_id:
+            return dataset
+    return None
+
+def h5ad_asset(dataset):
+    """H5AD asset of a dataset of the CELLxGENE curation API, None if there is none."""
+    assets = [asset for asset in dataset.get('assets', []) if asset['filetype'] == 'H5AD']
+    return assets[0] if assets else None
+
+def store_key(collection_id, dataset):
+    """Content address of a dataset H5AD. The dataset version ID changes with every re-publication
+    and stays the same across labels, so it is used when the API provides it."""
+    return dataset.get('dataset_version_id') or f"{collection_id}_{dataset['dataset_id']}"
+
+def asset_size(asset):
+    """Size in bytes of an H5AD asset, as listed by the API or from the remote headers."""
+    if asset.get('filesize'):
+        return int(asset['filesize'])
+    return remote_file_size(asset['url'])
+
+class H5adStore:
+    """Content-addressed store of downloaded H5ADs, `<root>/<key>.h5ad`, with a JSON index of
+    sizes and last use. When a download would exceed `budget_gb`, least recently used files are
+    evicted first. Pinned files, i.e. the ones being converted or prefetched for conversion,
+    are never evicted. Pins are kept in memory, per process."""
+    def __init__(self, root=H5AD_STORE, budget_gb=STORE_BUDGET_GB):
+        self.root = root
+        self.budget = budget_gb * 1024 ** 3
+        self.index_path = os.path.join(root, 'index.json')
+        self.lock = threading.RLock()
+        self.pins = Counter()
+        os.makedirs(root, exist_ok=True)
+        self.entries = self.load()
+
+    def load(self):
+        if not isfile(self.index_path):
+            return {}
+        with open(self.index_path, 'r', encoding='utf-8') as index:
+            entries = json.load(index)
+        # drop entries whose file was removed by hand
+        return {key: entry for key, entry in entries.items() if isfile(self.path(key))}
+
+    def save(self):
+        with open(self.index_path + '.tmp', 'w', encoding='utf-8') as index:
+            json.dump(self.entries, index, indent=2)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def path(self, key):
+        return os.path.join(self.root, f'{key}.h5ad')
+
+    def used(self):
+        return sum(entry['size'] for entry in self.entries.values())
+
+    def has(self, key, size=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and isfile(self.path(key)) and \
+                getsize(self.path(key)) == (size if size is not None else entry['size'])
+
+    def missing_bytes(self, key, size, legacy_path=None):
+        """Bytes to download for key, 0 if the store, or a complete legacy download, already holds it."""
+        if self.has(key, size) or (legacy_path is not None and isfile(legacy_path) and getsize(legacy_path) == size):
+            return 0
+        return size
+
+    def pin(self, key):
+        with self.lock:
+            self.pins[key] += 1
+
+    def unpin(self, key):
+        with self.lock:
+            self.pins[key] -= 1
+            if self.pins[key] <= 0:
+                del self.pins[key]
+
+    @contextmanager
+    def pinned(self, key):
+        self.pin(key)
+        try:
+            yield self.path(key)
+        finally:
+            self.unpin(key)
+
+    def evict(self, size):
+        """Remove least recently used, unpinned files until size bytes fit in the budget.
+        Return the evicted keys."""
+        evicted = []
+        with self.lock:
+            for key in sorted(self.entries, key=lambda key: self.entries[key]['last_used']):
+                if self.used() + size <= self.budget:
+                    break
+                if self.pins[key]:
+                    continue
+                if isfile(self.path(key)):
+                    os.remove(self.path(key))
+                del self.entries[key]
+                evicted.append(key)
+            if evicted:
+                self.save()
+                print(f"Evicted {len(evicted)} H5AD(s) from {self.root}: {', '.join(evicted)}")
+            if self.used() + size > self.budget:
+                print(f"{BOLD_START}WARNING:{BOLD_END} H5AD store {self.root} is over its budget of {self.budget / 1024 ** 3:.1f} GB with pinned files.")
+        return evicted
+
+    def adopt(self, key, legacy_path, size):
+        """Move an H5AD downloaded before the store existed under its key, if complete."""
+        if not isfile(legacy_path) or getsize(legacy_path) != size or self.has(key, size):
+            return False
+        os.replace(legacy_path, self.path(key))
+        return True
+
+    def fetch(self, url, key, size, legacy_path=None, quiet=False):
+        """Return the store path of key, downloading url if it is not stored yet.
+        The key is pinned while downloading, so a concurrent eviction does not remove it."""
+        with self.pinned(key) as path:
+            with self.lock:
+                hit = self.has(key, size) or (legacy_path is not None and self.adopt(key, legacy_path, size))
+                if not hit:
+                    self.evict(size)
+            if not hit:
+                if isfile(path):
+                    # stale or incomplete copy
+                    os.remove(path)
+                download_h5ad_file(url, path, quiet=quiet)
+            elif not quiet:
+                print(f"Using stored H5AD {path}")
+            with self.lock:
+                self.entries[key] = {'size': getsize(path), 'last_used': time.time(), 'url': url}
+                self.save()
+        return path
+
+def dataset_h5ad(store, collection, collection_id, dataset_id):
+    """Return (url, key, size, legacy_path) of the H5AD of dataset_id, None if the dataset has no H5AD."""
+    dataset = find_dataset(collection, dataset_id)
+    asset = h5ad_asset(dataset) if dataset else None
+    if asset is None:
+        return None
+    return asset['url'], store_key(collection_id, dataset), asset_size(asset), \
+        h5ad_path(collection_id, dataset_id, store.root)
+
+def fetch_dataset_h5ad(store, collection, collection_id, dataset_id, quiet=False):
+    """Fetch the H5AD of dataset_id through the store. Return its (key, path), (None, None) if the dataset has no H5AD."""
+    h5ad = dataset_h5ad(store, collection, collection_id, dataset_id)
+    if h5ad is None:
+        return None, None
+    url, key, size, legacy_path = h5ad
+    return key, store.fetch(url, key, size, legacy_path=legacy_path, quiet=quiet)
@@ -1,36 +1,117 @@
+import os
 import re
 from collections import defaultdict
-from numpy import nan
+from numpy import nan, arange
 import pandas as pd
+from pandas.util import hash_pandas_object
 
-from helper_files.constants.file_mapping import FASTQ_STANDARD_FIELDS
-from helper_files.utils import open_spreadsheet
+from helper_files.constants.file_mapping import FASTQ_STANDARD_FIELDS, FILE_MANIFEST_DTYPES, FILE_MANIFEST_CHUNKSIZE
+from helper_files.utils import open_spreadsheet, expand_categories
 from helper_files.constants.tier1_mapping import KEY_COLS
 from helper_files.constants.tier2_mapping import LUNG_DIGESTION, TIER2_MANUAL_FIX, TIER2_TO_DCP, TIER2_TO_DCP_UPDATE
-from helper_files.constants.dcp_required import dcp_required_entities
 from helper_files.convert import flatten_tiered_spreadsheet
+from helper_files.validate import check_required_fields, check_enum_values
 
 LAST_BIOMATERIAL = 'cell_suspension.biomaterial_core.biomaterial_id'
+FASTQ_EXTENSIONS = ['fastq.gz', 'fastq', 'fq.gz', 'fq']
+FASTQ_EXT_REGEX = '(' + '|'.join(re.escape(ext) for ext in FASTQ_EXTENSIONS) + ')$'
+# read marker of a fastq name, i.e. _R1 in S1_L001_R1_001.fastq.gz or _2 in SRR1_2.fastq.gz
+READ_MARKER_REGEX = re.compile(r'_[RI]?[1-3](?=(_\d+)?\.' + FASTQ_EXT_REGEX + ')', re.IGNORECASE)
+
+def lane_indexes(lanes):
+    """Lanes as Int16 if all of them are integers, else as read (i.e. L001 or 1,2)"""
+    numeric = pd.to_numeric(lanes.astype(object), errors='coerce')
+    if (numeric.notna() == lanes.notna()).all() and (numeric.dropna() % 1 == 0).all():
+        return numeric.astype('Int16')
+    return lanes
+
+def manifest_chunk(chunk, dtypes):
+    chunk = chunk.astype({col: dtype for col, dtype in dtypes.items() if col in chunk})
+    if 'lane_index' in chunk:
+        chunk['lane_index'] = lane_indexes(chunk['lane_index'])
+    return chunk
+
+def read_file_manifest(file_manifest, columns, chunksize=FILE_MANIFEST_CHUNKSIZE):
+    """Yield chunks of the file manifest with only the given columns, in compact dtypes.
+    csv, tsv and parquet manifests are streamed chunksize rows at a time, excel manifests are read at once."""
+    ext = os.path.splitext(file_manifest)[1].lower()
+    dtypes = {col: dtype for col, dtype in FILE_MANIFEST_DTYPES.items() if col in columns}
+    if ext in ['.csv', '.tsv', '.txt']:
+        if not os.path.exists(file_manifest):
+            raise FileNotFoundError(f"File not found at {file_manifest}")
+        for chunk in pd.read_csv(file_manifest, sep=',' if ext == '.csv' else '\t', usecols=lambda col: col in columns,
+                                 dtype=dtypes, chunksize=chunksize):
+            yield manifest_chunk(chunk, dtypes)
+    elif ext == '.parquet':
+        try:
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("Reading parquet file manifests requires pyarrow. Install it or convert the manifest to tsv.") from e
+        parquet = pq.ParquetFile(file_manifest)
+        present = [col for col in parquet.schema_arrow.names if col in columns]
+        for batch in parquet.iter_batches(batch_size=chunksize, columns=present):
+            yield manifest_chunk(batch.to_pandas(), dtypes)
+    else:
+        chunk = open_spreadsheet(spreadsheet_path=file_manifest, tab_name="File_manifest", columns=lambda col: col in columns)
+        yield manifest_chunk(chunk, dtypes)
+
 def merge_file_manifest(wrangled_seq_tab, file_manifest, file_mapping_dictionary):
-    """Merge file manifest tab into dcp spreadsheet and return wrangled_spreadsheet"""
-    file_manifest = file_manifest[file_mapping_dictionary.keys()].rename(columns=file_mapping_dictionary)
-    wrangled_seq_tab = wrangled_seq_tab.merge(file_manifest, on='cell_suspension.biomaterial_core.biomaterial_id', how='left')
-    return wrangled_seq_tab
+    """Merge file manifest tab into dcp spreadsheet and return wrangled_spreadsheet.
+    file_manifest is a dataframe or an iterable of chunks, joined on a biomaterial id index of wrangled_seq_tab."""
+    chunks = [file_manifest] if isinstance(file_manifest, pd.DataFrame) else file_manifest
+    # same suffixes as a merge for fields in both tables
+    overlap = set(file_mapping_dictionary.values()).intersection(wrangled_seq_tab.columns) - {LAST_BIOMATERIAL}
+    seq_tab = wrangled_seq_tab.rename(columns={col: f'{col}_x' for col in overlap})
+    manifest_cols = {col: f'{col}_y' if col in overlap else col for col in file_mapping_dictionary.values()}
+    # position keeps the row order of a left merge
+    seq_index = seq_tab.assign(_position=arange(len(seq_tab))).set_index(LAST_BIOMATERIAL)
+    merged, matched = [], set()
+    for chunk in chunks:
+        chunk = chunk[list(file_mapping_dictionary.keys())].rename(columns=file_mapping_dictionary).rename(columns=manifest_cols)
+        merged.append(chunk.join(seq_index, on=LAST_BIOMATERIAL, how='inner'))
+        matched.update(chunk[LAST_BIOMATERIAL].dropna().unique())
+    unmatched = seq_index[~seq_index.index.isin(list(matched))].reset_index()
+    merged = pd.concat(merged + [unmatched], ignore_index=True).sort_values('_position', kind='stable')
+    columns = list(seq_tab.columns) + [col for col in manifest_cols.values() if col not in seq_tab]
+    # the manifest's compact dtypes stay internal to the merge, the table keeps its own
+    return expand_categories(merged[columns].reset_index(drop=True), [col for col in manifest_cols.values() if col not in seq_tab])
 
 def get_fastq_ext(row):
-    for suffix in ['fastq.gz', 'fastq', 'fq.gz', 'fq']:
+    for suffix in FASTQ_EXTENSIONS:
         if row.endswith(suffix):
             return suffix 
     raise KeyError(f'filename {row} does not have known extension [`fastq.gz`, `fastq`, `fq.gz`, `fq`] for fastq file.')
 
+def get_fastq_exts(file_names):
+    """Vectorised get_fastq_ext for a series of file names"""
+    exts = file_names.astype(object).str.extract(FASTQ_EXT_REGEX, expand=False)
+    if exts.isna().any():
+        raise KeyError(f'filename(s) {file_names[exts.isna()].unique()[:10]} do not have known extension [`fastq.gz`, `fastq`, `fq.gz`, `fq`] for fastq file.')
+    return exts
+
 def add_standard_fields(wrangled_seq_tab, standard_values_dictionary):
     """Add standard fields like content description which for fastqs will always be DNA sequence"""
     if 'sequence_file.file_core.format' not in wrangled_seq_tab:
-        wrangled_seq_tab['sequence_file.file_core.format'] = wrangled_seq_tab['sequence_file.file_core.file_name'].apply(get_fastq_ext)
+        wrangled_seq_tab['sequence_file.file_core.format'] = get_fastq_exts(wrangled_seq_tab['sequence_file.file_core.file_name'])
     for key, value in standard_values_dictionary.items():
         wrangled_seq_tab[key] = value
     return wrangled_seq_tab
 
+def merge_overlap_chunks(wrangled_tab, chunks, key, suffix='fm'):
+    """merge_overlap for a file manifest read in chunks. Each chunk is merged with the rows of wrangled_tab
+    sharing its keys, found through a hash lookup, so only one chunk is merged at a time.
+    A key repeated in later chunks is merged again, and rows repeated across chunks only once, as in merge_overlap."""
+    merged, used, seen = [], pd.Series(False, index=wrangled_tab.index), set()
+    for chunk in chunks:
+        chunk = expand_categories(chunk.copy())
+        hashes = hash_pandas_object(chunk, index=False)
+        chunk = chunk[~(hashes.duplicated() | hashes.isin(seen)).to_numpy()]
+        seen.update(hashes)
+        in_chunk = wrangled_tab[key].isin(chunk[key])
+        merged.append(merge_overlap(wrangled_tab[in_chunk], chunk, list(chunk.columns), key=key, suffix=suffix))
+        used |= in_chunk
+    merged.append(wrangled_tab[~used])
+    return pd.concat(merged, ignore_index=True).sort_values(key, kind='stable', ignore_index=True)
 
 def add_tier1_fields(wrangled_spreadsheet, tier1_spreadsheet, tier1_to_file_dictionary):
     """Add info from tier1 into seq file tab."""
@@ -92,8 +173,34 @@ def check_10x_n_files(wrangled_spreadsheet):
         if any(n_per_lib < 2):
             raise ValueError("10x fastqs should include at least 2 read files per read")
 
-def perform_checks(wrangled_spreadsheet):
+def pair_stem(file_name):
+    """File name without its read marker, shared by the read1 and read2 fastqs of a pair. Empty if it has no marker"""
+    return READ_MARKER_REGEX.sub('', file_name, count=1) if READ_MARKER_REGEX.search(file_name) else ''
+
+def check_10x_read_pairs(wrangled_spreadsheet, sniffed):
+    """Check with the sniffed fastq headers that 10x libraries have read1 and read2 in each lane
+    and that paired fastqs start with the same read. A library sequenced in several runs or files
+    has one pair per run, flowcell and file name stem"""
+    lib_key = 'library_preparation_protocol.library_construction_method.text'
+    lib_id = get_protocol_id(lib_key)
+    libs_10x = [key for key, value in map_key_to_id(lib_key, wrangled_spreadsheet, key_to_id=False).items() if '10x' in value]
+    seq_tab = wrangled_spreadsheet['Sequence file']
+    seq_tab = seq_tab.loc[seq_tab[lib_id].isin(libs_10x), [LAST_BIOMATERIAL, 'sequence_file.file_core.file_name']]
+    reads = seq_tab.merge(sniffed.dropna(subset=['read_index']), left_on='sequence_file.file_core.file_name', right_on='file_name')
+    reads['pair'] = reads['file_name'].map(pair_stem)
+    pair_keys = [LAST_BIOMATERIAL, 'lane_index'] + [col for col in ['run', 'flowcell'] if col in reads] + ['pair']
+    for (library, lane, *_), pair_reads in reads.groupby(pair_keys, dropna=False):
+        first_reads = pair_reads.set_index('read_index')['first_read']
+        files = ', '.join(pair_reads['file_name'])
+        if not {'read1', 'read2'}.issubset(first_reads.index):
+            raise ValueError(f"10x library {library} lane {lane} should include read1 and read2 fastqs, found {sorted(first_reads.index)} in {files}")
+        if first_reads[['read1', 'read2']].nunique() > 1:
+            raise ValueError(f"read1 and read2 fastqs of library {library} lane {lane} are not paired: {first_reads[['read1', 'read2']].tolist()} in {files}")
+
+def perform_checks(wrangled_spreadsheet, sniffed=None):
     check_10x_n_files(wrangled_spreadsheet)
+    if sniffed is not None:
+        check_10x_read_pairs(wrangled_spreadsheet, sniffed)
     # if wrangled_spreadsheet['fastq']['biomaterials'] not in wrangled_spreadsheet['biomaterials']['id']:
     #     raise KeyError("IDs in sequence file tab, are not listed in biomaterial tab")
 
@@ -105,6 +212,12 @@ def rename_tier2_columns(tier2_df, tier2_to_dcp):
         raise ValueError(f"Tier 2 fields missing in mapping: {set(tier2_df.columns) - set(mapped_fields)}")
     return tier2_df.rename(columns=tier2_to_dcp)
 
+def lung_digestion_table(lung_digest_dict):
+    """One row per digestion protocol, one column per dissociation field"""
+    return pd.DataFrame(list(lung_digest_dict.values()), index=list(lung_digest_dict), dtype=object)
+
+LUNG_DIGESTION_TABLE = lung_digestion_table(LUNG_DIGESTION)
+
 def split_lung_dissociation(tier2_df, lung_digest_dict):
     if tier2_df['protocol_tissue_dissociation'].isna().all():
         if not tier2_df['protocol_tissue_dissociation_free_text'].isna().all():
@@ -112,38 +225,26 @@ def split_lung_dissociation(tier2_df, lung_digest_dict):
         else:
             print("Only NA values. Skipping tissue_dissociation conversion")
         return tier2_df
-    all_diss_fields = set().union(*[lung_digest_dict[prot].keys() for prot in tier2_df['protocol_tissue_dissociation'].unique()])
-    for diss in all_diss_fields:
-        tier2_df[diss] = pd.Series([nan] * len(tier2_df), dtype="object")
-    for i, row in tier2_df.iterrows():
-        prot = row['protocol_tissue_dissociation']
-        if pd.isna(prot):
-            continue
-        if prot not in lung_digest_dict:
-            raise ValueError(f"Digestion protocol {prot} not in pre-defined enum. Should be under `protocol_tissue_dissociation`")
-        for diss in all_diss_fields:
-            tier2_df.loc[i, diss] = lung_digest_dict[prot].get(diss, nan)
+    digest_table = lung_digest_dict if isinstance(lung_digest_dict, pd.DataFrame) else lung_digestion_table(lung_digest_dict)
+    protocols = tier2_df['protocol_tissue_dissociation'].dropna().unique()
+    unknown = [prot for prot in protocols if prot not in digest_table.index]
+    if unknown:
+        raise ValueError(f"Digestion protocol {unknown} not in pre-defined enum. Should be under `protocol_tissue_dissociation`")
+    # keep only the fields described by the protocols in use and join them on the protocol name
+    digest_table = digest_table.loc[protocols].dropna(axis=1, how='all')
+    tier2_df = tier2_df.drop(columns=digest_table.columns, errors='ignore')\
+        .join(digest_table, on='protocol_tissue_dissociation')
     del tier2_df['protocol_tissue_dissociation']
     return tier2_df
 
 def manual_fixes(tier2_df):
     if tier2_df.columns.isin(['protocol_tissue_dissociation', 'protocol_tissue_dissociation_free_text']).any():
-        tier2_df = split_lung_dissociation(tier2_df, LUNG_DIGESTION)
+        tier2_df = split_lung_dissociation(tier2_df, LUNG_DIGESTION_TABLE)
     # TODO add gut diet fields mapping to diet_meat_consumption
     return tier2_df
 
 def flatten_tier2_spreadsheet(tier2_excel, drop_na=True):
-    key_cols = ['donor_id', 'sample_id', 'dataset_id', 'library_id']
-    flat_t2_df = pd.DataFrame()
-    for tab_name, tab_data in tier2_excel.items():
-        tab_data.columns = [col.lower() for col in tab_data.columns]
-        if flat_t2_df.empty:
-            flat_t2_df = tab_data
-            continue
-        key_col = next((col for col in key_cols if col in tab_data.columns and col in flat_t2_df.columns), None)
-        if key_col is None:
-            raise ValueError(f"No common key column found for tab {tab_name} for merging among: {key_cols}")
-        flat_t2_df = pd.merge(flat_t2_df, tab_data, how='outer', on=key_col)
+    flat_t2_df = flatten_tiered_spreadsheet(tier2_excel, merge_type='outer', drop_na=False)
     if flat_t2_df.columns.isin(TIER2_MANUAL_FIX['tier2']).any():
         flat_t2_df = manual_fixes(flat_t2_df)
     if drop_na:
@@ -209,10 +310,13 @@ def add_protocol_targets(tier2_df, wrangled_spreadsheet):
         input_b = apl[prot_id]['from']
         output_b = apl[prot_id]['to']
         output_e = get_entity_type(output_b)
-        b2p = {row[input_b]: row[prot_id] for _, row in tier2_df[[input_b, prot_id]].iterrows()}
+        b2p = tier2_df.drop_duplicates(subset=input_b, keep='last').set_index(input_b)[prot_id]
+        input_ids = wrangled_spreadsheet[output_e][input_b]
+        if not input_ids.isin(b2p.index).all():
+            raise KeyError(f'{input_b} {input_ids[~input_ids.isin(b2p.index)].unique()} not found in tier 2 metadata')
         if not wrangled_spreadsheet[output_e][prot_id].isna().any():
             print(f'Merging {get_entity_type(prot_id)} with existing values. Investigate for potential need for merging.')
-        wrangled_spreadsheet[output_e][prot_id] = wrangled_spreadsheet[output_e].apply(lambda x: '||'.join([b2p[x[input_b]], x[prot_id]]), axis=1)
+        wrangled_spreadsheet[output_e][prot_id] = input_ids.map(b2p) + '||' + wrangled_spreadsheet[output_e][prot_id]
     return wrangled_spreadsheet
 
 def lower_list_values(l):
@@ -265,16 +369,7 @@ def check_matching_keys(tier2_df, wrangled_spreadsheet, tab_name, key):
         raise ValueError(f"No matching keys found between Tier 2 metadata and DCP spreadsheet for tab {tab_name}: key {key}.")
     
 def check_dcp_required_fields(df):
-    req_ent = []
-    for tab_name, tab in df.items():
-        if tab_name == 'Schemas':
-            continue
-        req_ent.extend([req for req in dcp_required_entities[tab_name] if req not in tab])
-        # req_mod = [tab for req_mod in dcp_required_modules[tab_name] if tab.columns.isin(req_mod)]
-    if req_ent:
-        print(f"Missing DCP required field(s) {'; '.join(req_ent)}")
-        # if req_mod:
-        #     print(f"Missing DCP required module field(s) {'; '.join(req_mod)}")
+    return check_required_fields(df)
 
 def merge_tier2_with_flat_dcp(tier2_spreadsheet, dcp_flat, tier1_to_dcp):
     tier2_df = open_spreadsheet(tier2_spreadsheet)
@@ -285,13 +380,15 @@ def merge_tier2_with_flat_dcp(tier2_spreadsheet, dcp_flat, tier1_to_dcp):
     tier2_flat = manual_fixes(tier2_flat)
     print(f'\nConverting {"; ".join([col for col in tier2_flat])} tier 2 values')
     tier2_flat = rename_tier2_columns(tier2_flat, all_tier2)
+    check_enum_values(tier2_flat, fields=tier2_flat.columns)
     dcp_flat = dcp_flat.merge(tier2_flat, how='outer', on=tier2_low_key, suffixes=('_dcp', ''))
     if dcp_flat.filter(like='_dcp').shape[1]:
         print(f"Conflicts between tier 1 and tier 2 for {'; '.join(dcp_flat.filter(like='_dcp').columns.tolist())}. Kept tier 2 values.")
     return dcp_flat.drop(columns=dcp_flat.filter(like='_dcp').columns, errors='ignore')
 
-def merge_file_manifest_with_flat_dcp(dcp_flat, file_manifest, file_mapping_dictionary):
-    file_manifest = open_spreadsheet(spreadsheet_path=file_manifest, tab_name="File_manifest")
+def merge_file_manifest_with_flat_dcp(dcp_flat, file_manifest, file_mapping_dictionary, chunksize=FILE_MANIFEST_CHUNKSIZE):
+    file_manifest = read_file_manifest(file_manifest, columns=file_mapping_dictionary.keys(), chunksize=chunksize)
     dcp_flat = merge_file_manifest(dcp_flat, file_manifest, file_mapping_dictionary)
+    check_enum_values(dcp_flat, fields=file_mapping_dictionary.values())
     dcp_flat = add_standard_fields(dcp_flat, FASTQ_STANDARD_FIELDS)
     return dcp_flat
\ No newline at end of file
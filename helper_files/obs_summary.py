@@ -0,0 +1,115 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from helper_files.constants.tier1_mapping import tier1_list, tier1_to_dcp
+from helper_files.utils import filename_suffixed, BOLD_START, BOLD_END
+
+CELL_COUNT = tier1_to_dcp['cell_number_loaded']
+
+def obs_key(obs):
+    return 'library_id' if 'library_id' in obs else 'donor_id'
+
+class ObsSummary:
+    """Tier 1 columns of obs summarized per library (or donor, if there is no library_id), fed in row chunks.
+    Columns are reduced to integer codes, shared by all chunks: the categorical codes, or codes of the
+    values in order of appearance. Only the distinct code rows and the cell counts are kept,
+    so memory does not grow with the number of cells."""
+
+    def __init__(self, fields, key):
+        self.fields, self.key = fields, key
+        self.values = {col: {} for col in fields}
+        self.categories = {}
+        self.distinct, self.rows = None, None
+        self.cells = np.zeros(1, dtype=np.int64)
+        self.n_cells = 0
+
+    def codes(self, column):
+        """Integer codes of a column chunk, -1 for missing values"""
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            self.categories[column.name] = column.cat.categories
+            return column.cat.codes.to_numpy()
+        codes, uniques = pd.factorize(column)
+        values = self.values[column.name]
+        known = np.array([values.setdefault(value, len(values)) for value in uniques], dtype=np.int64)
+        return np.where(codes < 0, -1, known[codes] if len(known) else codes)
+
+    def key_values(self):
+        return self.categories.get(self.key, pd.Index(list(self.values[self.key])))
+
+    def add(self, obs):
+        codes = pd.DataFrame({col: self.codes(obs[col]) for col in self.fields},
+                             index=pd.RangeIndex(self.n_cells, self.n_cells + len(obs)))
+        new = codes.drop_duplicates()
+        if self.distinct is not None:
+            new = new[~pd.concat([self.distinct, new]).duplicated().iloc[len(self.distinct):]]
+        rows = obs[self.fields].iloc[new.index - self.n_cells]
+        self.distinct = new if self.distinct is None else pd.concat([self.distinct, new])
+        self.rows = rows if self.rows is None else pd.concat([self.rows, rows])
+        # missing keys are counted under the last code
+        n_keys = len(self.key_values())
+        key_codes = codes[self.key].to_numpy()
+        cells = np.bincount(np.where(key_codes < 0, n_keys, key_codes), minlength=n_keys + 1)
+        self.cells = np.concatenate([self.cells[:-1], np.zeros(n_keys + 1 - len(self.cells), dtype=np.int64),
+                                     self.cells[-1:]]) + cells
+        self.n_cells += len(obs)
+
+    def result(self):
+        """The distinct tier 1 rows, in the order drop_duplicates would keep them,
+        the number of cells per library and the number of values of each column per library."""
+        key_values = self.key_values()
+        cell_count = pd.Series(self.cells[:-1], index=pd.Index(key_values, name=self.key), name=CELL_COUNT)
+        if self.cells[-1]:
+            cell_count.loc[np.nan] = self.cells[-1]
+        nunique = self.distinct.groupby(self.key).nunique()
+        nunique.index = nunique.index.map(lambda code: key_values[code] if code >= 0 else np.nan)
+        return self.rows, cell_count[cell_count > 0], nunique.rename_axis(self.key)
+
+def obs_fields(columns):
+    return [col for col in columns if col in tier1_list]
+
+def summarize_obs(obs, key=None):
+    """Summarize the tier 1 columns of obs per library without comparing cell values (see ObsSummary)."""
+    summary = ObsSummary(obs_fields(obs.columns), key or obs_key(obs))
+    summary.add(obs)
+    return summary.result()
+
+def inconsistent_fields(rows, nunique):
+    """Report of the fields with more than one value within a library: one line per library and field,
+    with the values found"""
+    key = nunique.index.name
+    report = []
+    for field in nunique.columns:
+        for library in nunique.index[nunique[field] > 1]:
+            found = rows.loc[rows[key].isna() if pd.isna(library) else rows[key] == library, field]
+            report.append({key: library, 'field': field, 'n_values': nunique.loc[library, field],
+                           'values': '||'.join(str(value) for value in found.unique())})
+    return pd.DataFrame(report, columns=[key, 'field', 'n_values', 'values'])
+
+def save_obs_summary(obs, label=None, output_dir='metadata'):
+    """Save the tier 1 metadata of obs, one row per library, with the number of cells as
+    cell_suspension.estimated_cell_count when cell_number_loaded is not given,
+    and an `<label>_inconsistent_fields.csv` report of fields varying within a library."""
+    return save_summary(summarize_obs(obs), label, output_dir)
+
+def save_summary(summary, label=None, output_dir='metadata'):
+    """Save the result of an ObsSummary (see save_obs_summary)"""
+    rows, cell_count, nunique = summary
+    key = nunique.index.name
+    if key == 'donor_id':
+        print("No library_id information. Saving tier 1 with donor_id index.\n")
+    metadata = pd.DataFrame(rows).set_index(key)
+    if key == 'library_id' and 'cell_number_loaded' not in rows:
+        metadata[CELL_COUNT] = metadata.index.map(cell_count)
+    metadata.to_csv(filename_suffixed(output_dir, label, 'metadata'))
+
+    report = inconsistent_fields(rows, nunique)
+    report_path = filename_suffixed(output_dir, label, 'inconsistent_fields')
+    if report.empty and os.path.exists(report_path):
+        os.remove(report_path)
+    if not report.empty:
+        report.to_csv(report_path, index=False)
+        print(f"{BOLD_START}WARNING:{BOLD_END} {report['field'].nunique()} fields vary within a {key}, "
+              f"giving {len(metadata)} rows for {metadata.index.nunique()} {key}s. See {report_path}")
+    return metadata, report
@@ -0,0 +1,319 @@
+import os
+import re
+import time
+import threading
+from collections import defaultdict, Counter
+
+import requests
+import pandas as pd
+from numpy import nan
+
+from helper_files.utils import filename_suffixed, http_get, BOLD_START, BOLD_END
+
+OLS_SEARCH = 'https://www.ebi.ac.uk/ols4/api/search'
+# ontology IDs queried per OLS search request
+OLS_CHUNK = 50
+# lowest trigram similarity of a text to an ontology label or synonym accepted by TermMatcher
+MATCH_MIN_SCORE = 0.6
+
+class LookupBudget:
+    """Time and failure budget shared by all ontology lookups of a run.
+    Each request gets at most `timeout` seconds and never more than what is left of `deadline`.
+    After `max_failures` consecutive failed requests, or once the deadline passes, the budget is degraded:
+    no more requests are sent and terms are kept as their IDs, recorded in `needs_label` to backfill later."""
+    def __init__(self, deadline=600, timeout=10, max_failures=5):
+        self.deadline = deadline
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.start = time.monotonic()
+        self.failures = 0
+        self.degraded = False
+        self.needs_label = set()
+
+    def remaining(self):
+        return self.deadline - (time.monotonic() - self.start)
+
+    def trip(self, reason):
+        if not self.degraded:
+            print(f"\n{BOLD_START}WARNING:{BOLD_END} {reason}. Ontology lookups continue in degraded mode, keeping IDs.")
+        self.degraded = True
+
+    def get(self, url, **kwargs):
+        """Return the json response of url, {} if the server rejects the request (i.e. unknown term)
+        or None if the lookup failed or the budget is degraded."""
+        if self.degraded:
+            return None
+        remaining = self.remaining()
+        if remaining <= 0:
+            self.trip(f"Ontology lookup deadline of {self.deadline}s reached")
+            return None
+        try:
+            response = http_get(url, timeout=min(self.timeout, remaining), **kwargs)
+            response.raise_for_status()
+            result = response.json()
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code < 500:
+                return {}
+            return self.failed(e)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            return self.failed(e)
+        self.failures = 0
+        return result
+
+    def failed(self, error):
+        self.failures += 1
+        print(f"\nOntology lookup failed ({self.failures}/{self.max_failures}): {error}")
+        if self.failures >= self.max_failures:
+            self.trip(f"{self.failures} consecutive ontology lookups failed")
+        return None
+
+_BUDGET = LookupBudget()
+# budgets of runs started in other threads, i.e. concurrent jobs of the conversion service
+_THREAD_BUDGET = threading.local()
+
+def start_lookup_budget(deadline=600, timeout=10, max_failures=5):
+    """Start a new lookup budget for this run and return it.
+    A run started in a thread other than the main one gets its own budget."""
+    global _BUDGET
+    budget = LookupBudget(deadline=deadline, timeout=timeout, max_failures=max_failures)
+    if threading.current_thread() is threading.main_thread():
+        _BUDGET = budget
+    else:
+        _THREAD_BUDGET.budget = budget
+    return budget
+
+def end_lookup_budget():
+    """Drop the budget of a run started in this thread, i.e. when a service job ends on a pool thread"""
+    _THREAD_BUDGET.__dict__.pop('budget', None)
+
+def get_budget():
+    return getattr(_THREAD_BUDGET, 'budget', _BUDGET)
+
+def use_budget(budget):
+    """Share budget with the current thread, i.e. a worker running a step of the caller's run"""
+    _THREAD_BUDGET.budget = budget
+
+def export_needs_label(dir_name, label):
+    """Write terms that were kept as IDs in a `<label>_needs_label.csv` side-file"""
+    needs_label = get_budget().needs_label
+    if not needs_label:
+        return None
+    output_path = filename_suffixed(dir_name, label, 'needs_label')
+    pd.DataFrame({'term': sorted(needs_label), 'needs_label': True}).to_csv(output_path, index=False)
+    print(f"{len(needs_label)} ontology terms need labels. Backfill them with backfill_ontology_labels.py -nl {output_path}")
+    return output_path
+
+def read_needs_label(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"File not found at {path}")
+    needs_label = pd.read_csv(path)
+    return set(needs_label.loc[needs_label['needs_label'], 'term'])
+
+def normalise_ontology_id(term):
+    term = term.strip()
+    if re.match(r"\w+_\d+", term):
+        term = term.replace("_", ":")
+    return term
+
+def is_ontology_id(term):
+    return re.match(r"\w+:[\w\d]+", term) is not None
+
+# Get the ontology label instead of ontology id from OLS4
+def ols_label(ontology_id, only_label=True, ontology=None):
+    if ontology_id is nan:
+        return ontology_id
+    ontology_id = normalise_ontology_id(ontology_id)
+    if not is_ontology_id(ontology_id):
+        return ontology_id
+    ontology_name = ontology if ontology else ontology_id.split(":")[0].lower()
+    ontology_term = ontology_id.replace(":", "_")
+    url = f'https://www.ebi.ac.uk/ols4/api/ontologies/{ontology_name}/terms/http%253A%252F%252Fpurl.obolibrary.org%252Fobo%252F{ontology_term}'
+    if ontology_name == 'efo':
+        url = f'https://www.ebi.ac.uk/ols4/api/ontologies/{ontology_name}/terms/http%253A%252F%252Fwww.ebi.ac.uk%252Fefo%252F{ontology_term}'
+    results = get_budget().get(url)
+    if results is None:
+        # lookup failed or budget is degraded, keep the ID and mark it for backfilling
+        get_budget().needs_label.add(ontology_id)
+        return ontology_id
+    if 'label' not in results:
+        return ontology_id
+    return results['label'] if only_label else results
+
+# Labels of resolved ontology IDs, shared by all lookups of the process
+_LABEL_CACHE = {}
+
+def chunked(values, size):
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+def search_ids_query(ontology_ids):
+    """OLS search q matching any of ontology_ids: each ID is quoted, so its colon is not read as a field,
+    and the IDs are OR'd, instead of one phrase of all IDs"""
+    return ' OR '.join(f'"{ontology_id}"' for ontology_id in ontology_ids)
+
+def search_terms(ontology, ontology_ids, chunk_size=OLS_CHUNK):
+    """{obo_id: search doc} of the ontology_ids of one ontology found by one OLS search query, following its pages.
+    Docs of other terms are ignored; IDs of failed pages are missing from the result."""
+    wanted = set(ontology_ids)
+    terms = {}
+    start = 0
+    while True:
+        result = get_budget().get(OLS_SEARCH, params={
+            'q': search_ids_query(ontology_ids), 'queryFields': 'obo_id', 'ontology': ontology,
+            'fieldList': 'obo_id,label', 'rows': chunk_size, 'start': start})
+        if not result or 'response' not in result:
+            return terms
+        docs = result['response'].get('docs', [])
+        terms.update({doc['obo_id']: doc for doc in docs if doc.get('obo_id') in wanted and 'label' in doc})
+        start += len(docs)
+        if not docs or len(terms) == len(wanted) or start >= result['response'].get('numFound', 0):
+            return terms
+
+def fetch_terms(ontology_ids, chunk_size=OLS_CHUNK):
+    """Resolve many ontology IDs with a few OLS search requests, grouping them per ontology
+    and querying chunk_size IDs at a time. IDs the search did not return (failed pages, unknown terms)
+    are looked up one by one with ols_label, which records failed lookups in needs_label.
+    Return {obo_id: term} for the IDs found."""
+    per_ontology = defaultdict(list)
+    for ontology_id in dict.fromkeys(ontology_ids):
+        per_ontology[ontology_id.split(':')[0].lower()].append(ontology_id)
+    terms = {}
+    for ontology, ids in per_ontology.items():
+        for chunk in chunked(ids, chunk_size):
+            terms.update(search_terms(ontology, chunk, chunk_size))
+    for ontology_id in dict.fromkeys(ontology_ids):
+        if ontology_id not in terms:
+            term = ols_label(ontology_id, only_label=False)
+            if isinstance(term, dict):
+                terms[ontology_id] = term
+    return terms
+
+def ols_labels(terms, chunk_size=OLS_CHUNK):
+    """Batched ols_label: return {term: label} for terms, looking up uncached IDs in batches"""
+    normalised = {term: normalise_ontology_id(term) for term in terms if isinstance(term, str)}
+    pending = [ont_id for ont_id in set(normalised.values())
+               if is_ontology_id(ont_id) and ont_id not in _LABEL_CACHE]
+    if pending:
+        _LABEL_CACHE.update({ont_id: term['label'] for ont_id, term in fetch_terms(sorted(pending), chunk_size).items()})
+    return {term: _LABEL_CACHE.get(ont_id, ont_id) for term, ont_id in normalised.items()}
+
+def label_columns(tab):
+    """Columns that hold a label of an ontology column of the same tab"""
+    return [col for col in tab.columns
+            if col.endswith(('.text', '.ontology_label'))
+            and col.rsplit('.', 1)[0] + '.ontology' in tab.columns]
+
+def normalise_text(text):
+    return ' '.join(re.findall(r'[a-z0-9]+', str(text).lower()))
+
+def trigrams(text):
+    padded = f' {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class TermMatcher:
+    """Local text-to-ontology matching over the labels and synonyms of ontology terms, without OLS.
+    Names are indexed by their character trigrams and candidates are ranked by the Dice similarity of trigrams,
+    1 for an exact (case and punctuation insensitive) match. Ties are broken by ID, so results are deterministic."""
+    def __init__(self, terms=(), min_score=MATCH_MIN_SCORE):
+        self.min_score = min_score
+        self.labels = {}
+        self.names = []
+        self.exact = defaultdict(list)
+        self.index = defaultdict(list)
+        self.matches = {}
+        self.add(terms)
+
+    def add(self, terms):
+        """Index terms, (obo_id, label, synonyms, ontology) tuples. The ontology defaults to the ID prefix"""
+        for obo_id, label, synonyms, ontology in terms:
+            self.labels.setdefault(obo_id, label)
+            ontology = (ontology or obo_id.split(':')[0]).lower()
+            for name in dict.fromkeys(normalise_text(name) for name in [label, *synonyms]):
+                if not name:
+                    continue
+                position = len(self.names)
+                grams = trigrams(name)
+                self.names.append((obo_id, ontology, len(grams)))
+                self.exact[name].append(position)
+                for gram in grams:
+                    self.index[gram].append(position)
+        self.matches.clear()
+        return self
+
+    def allowed(self, position, ontologies):
+        return ontologies is None or self.names[position][1] in ontologies
+
+    def scores(self, query, ontologies=None):
+        """{name position: similarity} of the names of the given ontologies sharing trigrams with query,
+        only exact names if any"""
+        exact = [position for position in self.exact.get(query, ()) if self.allowed(position, ontologies)]
+        if exact:
+            return dict.fromkeys(exact, 1.0)
+        grams = trigrams(query)
+        shared = Counter(position for gram in grams for position in self.index.get(gram, ()))
+        return {position: 2 * count / (len(grams) + self.names[position][2]) for position, count in shared.items()
+                if self.allowed(position, ontologies)}
+
+    def match(self, text, ontologies=None, limit=5):
+        """Ranked [(obo_id, label, score)] of the terms matching text, in the given ontologies only if any"""
+        allowed = frozenset(ontology.lower() for ontology in ontologies) if ontologies else None
+        key = (normalise_text(text), allowed, limit)
+        if key not in self.matches:
+            best = {}
+            for position, score in self.scores(key[0], allowed).items():
+                obo_id = self.names[position][0]
+                if score >= self.min_score:
+                    best[obo_id] = max(score, best.get(obo_id, 0))
+            ranked = sorted(best.items(), key=lambda item: (-item[1], item[0]))[:limit]
+            self.matches[key] = [(obo_id, self.labels[obo_id], round(score, 3)) for obo_id, score in ranked]
+        return self.matches[key]
+
+def read_obo_terms(path):
+    """(obo_id, label, synonyms, ontology) of the non obsolete terms of an .obo file"""
+    ontology, terms, term = None, [], None
+    with open(path, encoding='utf-8') as obo:
+        for line in obo:
+            line = line.strip()
+            if line.startswith('['):
+                term = {'synonyms': []} if line == '[Term]' else None
+                if term is not None:
+                    terms.append(term)
+            elif term is None:
+                if line.startswith('ontology:') and ontology is None:
+                    ontology = line.split(':', 1)[1].strip()
+            elif line.startswith(('id:', 'name:')):
+                term[line.split(':', 1)[0]] = line.split(':', 1)[1].strip()
+            elif line.startswith('synonym:'):
+                synonym = re.match(r'synonym:\s*"((?:[^"\\]|\\.)*)"', line)
+                if synonym:
+                    term['synonyms'].append(synonym.group(1).replace('\\"', '"'))
+            elif line == 'is_obsolete: true':
+                term['obsolete'] = True
+    return [(term['id'], term['name'], term['synonyms'], ontology) for term in terms
+            if 'id' in term and 'name' in term and not term.get('obsolete')]
+
+def read_ontology_dump(path):
+    """Terms of an ontology dump: an .obo file, or a csv/tsv with obo_id and label columns
+    and optional synonyms ('||' separated) and ontology columns"""
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"File not found at {path}")
+    if path.endswith('.obo'):
+        return read_obo_terms(path)
+    dump = pd.read_csv(path, sep='\t' if path.endswith(('.tsv', '.txt')) else ',', dtype=str)
+    missing = {'obo_id', 'label'}.difference(dump.columns)
+    if missing:
+        raise ValueError(f"Ontology dump {path} has no {' nor '.join(sorted(missing))} column")
+    synonyms = dump['synonyms'].fillna('').str.split('||', regex=False) if 'synonyms' in dump else [[]] * len(dump)
+    ontologies = dump['ontology'] if 'ontology' in dump else [None] * len(dump)
+    return [(obo_id, label, [synonym for synonym in synonym_list if synonym], ontology if isinstance(ontology, str) else None)
+            for obo_id, label, synonym_list, ontology in zip(dump['obo_id'], dump['label'], synonyms, ontologies)
+            if isinstance(obo_id, str) and isinstance(label, str)]
+
+def build_matcher(dump_paths=()):
+    """TermMatcher over the terms of the ontology dumps and the labels already resolved in this process"""
+    matcher = TermMatcher()
+    for path in dump_paths:
+        terms = read_ontology_dump(path)
+        matcher.add(terms)
+        print(f"Indexed {len(terms)} ontology terms of {path}")
+    matcher.add((obo_id, label, (), None) for obo_id, label in dict(_LABEL_CACHE).items())
+    return matcher
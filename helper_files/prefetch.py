@@ -0,0 +1,128 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from helper_files.collect import get_collection_data
+from helper_files.h5ad_store import H5adStore, dataset_h5ad
+from helper_files.utils import BOLD_START, BOLD_END
+
+PREFETCH_DEPTH = 2
+DISK_BUDGET_GB = 50
+
+class DiskBudget:
+    """Bytes of prefetched H5ADs that are on disk but not yet converted.
+    Reservations are granted in ticket order, so the dataset being converted next is never
+    starved by the ones behind it. A file larger than the whole budget is still granted once
+    nothing else is reserved."""
+    def __init__(self, limit):
+        self.limit = limit
+        self.reserved = 0
+        self.turn = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def acquire(self, ticket, size):
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or (self.turn == ticket and
+                                    (not self.reserved or self.reserved + size <= self.limit)))
+            if self.closed:
+                raise RuntimeError("Prefetch stopped")
+            self.reserved += size
+            self.turn += 1
+            self.condition.notify_all()
+
+    def release(self, size):
+        with self.condition:
+            self.reserved -= size
+            self.condition.notify_all()
+
+    def close(self):
+        """Wake up and stop the downloads still waiting for their turn."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+def prefetch_dataset(collection_id, dataset_id, budget, ticket, store):
+    """Fetch collection metadata and the H5AD of a dataset into the store in the background.
+    The H5AD size is read from the collection assets, so disk budget is reserved before downloading,
+    and the H5AD stays pinned in the store until the dataset is converted.
+    Datasets that need an interactive selection only get their collection prefetched."""
+    size, h5ad = 0, None
+    try:
+        collection = get_collection_data(collection_id)
+        dataset_ids = [dataset['dataset_id'] for dataset in collection['datasets']]
+        if pd.isna(dataset_id) and len(dataset_ids) == 1:
+            dataset_id = dataset_ids[0]
+        h5ad = dataset_h5ad(store, collection, collection_id, dataset_id) if dataset_id in dataset_ids else None
+        if h5ad:
+            url, key, full_size, legacy_path = h5ad
+            size = store.missing_bytes(key, full_size, legacy_path)
+    finally:
+        budget.acquire(ticket, size)
+    prefetched = {'collection': collection, 'dataset_id': dataset_id, 'reserved': size, 'key': None}
+    if h5ad:
+        store.pin(key)
+        try:
+            store.fetch(url, key, full_size, legacy_path=legacy_path, quiet=True)
+        except Exception:
+            store.unpin(key)
+            budget.release(size)
+            raise
+        prefetched['key'] = key
+    return prefetched
+
+def release(prefetched, budget, store):
+    budget.release(prefetched['reserved'])
+    if prefetched['key']:
+        store.unpin(prefetched['key'])
+
+def prefetch_rows(rows, depth=PREFETCH_DEPTH, disk_budget_gb=DISK_BUDGET_GB, store=None):
+    """Yield (index, row, prefetched) for the rows of the input spreadsheet, in order,
+    while the next `depth` datasets are fetched in background threads.
+    prefetched is None for rows without collection_id or when prefetching failed,
+    in which case the dataset is collected in the foreground as usual."""
+    budget = DiskBudget(disk_budget_gb * 1024 ** 3)
+    store = H5adStore() if store is None else store
+    rows = iter(rows)
+    pending = deque()
+    ticket = 0
+
+    def submit(executor):
+        nonlocal ticket
+        for index, row in rows:
+            if pd.isnull(row['collection_id']):
+                pending.append((index, row, None))
+            else:
+                pending.append((index, row, executor.submit(
+                    prefetch_dataset, row['collection_id'], row['dataset_id'], budget, ticket, store)))
+                ticket += 1
+                return
+
+    if depth < 1:
+        for index, row in rows:
+            yield index, row, None
+        return
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        try:
+            for _ in range(depth):
+                submit(executor)
+            while pending:
+                index, row, future = pending.popleft()
+                prefetched = None
+                if future is not None:
+                    try:
+                        prefetched = future.result()
+                    except Exception as e:
+                        print(f"{BOLD_START}WARNING:{BOLD_END} Prefetch of collection {row['collection_id']} failed ({e}). Collecting in the foreground.")
+                # keep `depth` datasets in flight while this one converts
+                submit(executor)
+                yield index, row, prefetched
+                if prefetched:
+                    release(prefetched, budget, store)
+        finally:
+            for _, _, future in pending:
+                if future is not None:
+                    future.cancel()
+            budget.close()
@@ -0,0 +1,85 @@
+import io
+import os
+import hashlib
+import inspect
+
+import pandas as pd
+from pandas.util import hash_pandas_object
+
+from helper_files.ontology import get_budget
+from helper_files.utils import captured_output, cell_hashes
+
+STEP_CACHE_DIR = os.path.join('metadata', 'step_cache')
+# bump to invalidate all cached step outputs
+CACHE_VERSION = 2
+
+def code_hash(objects):
+    """sha256 of the source of functions, or the repr of constants, a step depends on"""
+    sha256 = hashlib.sha256()
+    for obj in objects:
+        source = inspect.getsource(obj) if callable(obj) else repr(obj)
+        sha256.update(source.encode())
+    return sha256.hexdigest()
+
+def step_key(step, code, inputs):
+    """Cache key of a step run: its name and code, the names, dtypes and cell values of its input columns."""
+    sha256 = hashlib.sha256(f"{CACHE_VERSION}:{step}:{code}".encode())
+    sha256.update(repr([(col, str(dtype)) for col, dtype in inputs.dtypes.items()]).encode())
+    sha256.update(hash_pandas_object(inputs.index).to_numpy().tobytes())
+    sha256.update(cell_hashes(inputs).to_numpy().tobytes())
+    return sha256.hexdigest()
+
+def step_path(cache_dir, step, key):
+    return os.path.join(cache_dir, step, f"{key}.pkl")
+
+def load_step(cache_dir, step, key):
+    path = step_path(cache_dir, step, key)
+    return pd.read_pickle(path) if os.path.exists(path) else None
+
+def save_step(cache_dir, step, key, outputs):
+    path = step_path(cache_dir, step, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pd.to_pickle(outputs, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+def step_outputs(before, after):
+    """Columns a step added or changed, in the order of its result, and the input columns it deleted"""
+    changed = [col for col in after.columns if col not in before or not after[col].equals(before[col])]
+    return {'columns': after[changed], 'deleted': [col for col in before.columns if col not in after]}
+
+def apply_outputs(df, outputs):
+    df = df.drop(columns=outputs['deleted'])
+    for col in outputs['columns']:
+        df[col] = outputs['columns'][col]
+    return df
+
+def step_inputs(df, input_cols):
+    return df[[col for col in input_cols if col in df]]
+
+def cached_outputs(step, function, inputs, cache_dir=None, code=(), **kwargs):
+    """Outputs of function on the inputs frame (see step_outputs). With a cache_dir, the outputs are
+    stored under a key of the step code and input values, and reused on the next run with the same inputs.
+    What the step printed (i.e. warnings on its input values) is stored with them and printed again on reuse.
+    Runs whose ontology lookups failed are not stored, so their IDs get labelled on a later run."""
+    key = step_key(step, code_hash([function, *code]), inputs) if cache_dir else None
+    outputs = load_step(cache_dir, step, key) if cache_dir else None
+    if outputs is not None:
+        print(f'`{step.removeprefix("edit_")}` (cached)', end='; ', flush=True)
+        print(outputs.get('log', ''), end='', flush=True)
+        return outputs
+    unlabelled = len(get_budget().needs_label)
+    log = io.StringIO()
+    try:
+        with captured_output(log):
+            result = function(inputs.copy(), **kwargs)
+    finally:
+        print(log.getvalue(), end='', flush=True)
+    outputs = {**step_outputs(inputs, result), 'log': log.getvalue()}
+    if cache_dir and len(get_budget().needs_label) == unlabelled:
+        save_step(cache_dir, step, key, outputs)
+    return outputs
+
+def run_cached_step(step, function, input_cols, df, cache_dir=None, code=(), **kwargs):
+    """Run function on the input columns of df that are present and apply the columns it adds,
+    changes or deletes to df, reusing cached outputs (see cached_outputs)."""
+    return apply_outputs(df, cached_outputs(step, function, step_inputs(df, input_cols), cache_dir, code, **kwargs))
@@ -0,0 +1,172 @@
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from helper_files.ontology import get_budget, use_budget
+from helper_files.step_cache import step_inputs, cached_outputs, apply_outputs
+from helper_files.utils import captured_output
+
+STEP_WORKERS = 4
+
+def is_barrier(spec):
+    """Steps with unknown outputs or that must see the full frame (row-changing or interactive)
+    run alone, after every step before them and before every step after them."""
+    return spec['outputs'] is None or not spec.get('cache', True)
+
+def step_graph(steps):
+    """{step: set of steps it waits for}. A step waits for the earlier steps that write a column it reads
+    or writes, or that read a column it writes, and for the barriers."""
+    names = list(steps)
+    graph = {}
+    for i, step in enumerate(names):
+        spec = steps[step]
+        graph[step] = set()
+        for prev in names[:i]:
+            prev_spec = steps[prev]
+            if is_barrier(spec) or is_barrier(prev_spec) or \
+                    set(prev_spec['outputs']) & set(spec['inputs'] + spec['outputs']) or \
+                    set(prev_spec['inputs']) & set(spec['outputs']):
+                graph[step].add(prev)
+    return graph
+
+def transitive_reduction(graph):
+    """Graph without the edges implied by a longer path, for rendering"""
+    def ancestors(step):
+        seen, stack = set(), list(graph[step])
+        while stack:
+            dep = stack.pop()
+            if dep not in seen:
+                seen.add(dep)
+                stack.extend(graph[dep])
+        return seen
+    return {step: {dep for dep in deps if not any(dep in ancestors(other) for other in deps - {dep})}
+            for step, deps in graph.items()}
+
+def critical_path(graph, durations=None):
+    """Longest chain of dependent steps, weighted by durations in seconds (1 per step if not given).
+    Return (steps, total duration)."""
+    durations = durations or {}
+    finish, previous = {}, {}
+    # graph keys are in a topological order
+    for step, deps in graph.items():
+        start = max((finish[dep] for dep in deps), default=0)
+        previous[step] = max(deps, key=lambda dep: finish[dep]) if deps else None
+        finish[step] = start + durations.get(step, 1)
+    step = max(finish, key=finish.get)
+    total = finish[step]
+    path = []
+    while step is not None:
+        path.append(step)
+        step = previous[step]
+    return path[::-1], total
+
+def render_mermaid(graph, steps=None, durations=None):
+    """Mermaid flowchart of the step graph, with the critical path highlighted"""
+    steps = steps or {}
+    durations = durations or {}
+    path, total = critical_path(graph, durations)
+    lines = ['flowchart TD']
+    for step in graph:
+        label = step.removeprefix('edit_')
+        if step in durations:
+            label += f' {durations[step]:.2f}s'
+        if steps.get(step, {}).get('network'):
+            label += ' (network)'
+        lines.append(f'    {step}["{label}"]')
+    for step, deps in transitive_reduction(graph).items():
+        lines.extend(f'    {dep} --> {step}' for dep in sorted(deps, key=list(graph).index))
+    lines.append('    classDef critical stroke:#d00,stroke-width:3px')
+    lines.append(f'    class {",".join(path)} critical')
+    lines.append(f'%% critical path: {" -> ".join(path)} ({total:.2f})')
+    return '\n'.join(lines) + '\n'
+
+def serial_order(df, base_columns, created):
+    """Columns of df in the order a serial run produces: columns present before the steps first,
+    then the new ones by step order and their position in the step outputs."""
+    base = [col for col in base_columns if col in df]
+    return df[base + sorted((col for col in df if col not in base_columns), key=created.get)]
+
+def timed_outputs(budget, step, spec, inputs, cache_dir, kwargs):
+    """Outputs of a step run in a worker thread, with its duration, what it printed and the error it raised if any.
+    The output is captured here and replayed by the calling thread, so it reaches the caller's stdout (i.e. a job log)"""
+    use_budget(budget)
+    start = time.monotonic()
+    outputs, error, log = None, None, io.StringIO()
+    with captured_output(log):
+        try:
+            outputs = cached_outputs(step, spec['function'], inputs, cache_dir, spec.get('code', []), **kwargs)
+        except Exception as e:
+            error = e
+    return outputs, time.monotonic() - start, log.getvalue(), error
+
+def run_step_graph(df, steps, cache_dir=None, max_workers=STEP_WORKERS, step_kwargs=None, durations=None):
+    """Run steps in dependency order. Network-bound steps whose dependencies are done run concurrently
+    in threads, the others in the calling thread; barriers run alone on the full frame.
+    Steps without any of their input columns are skipped. The result is the same as a serial run
+    in the order of steps, columns included. What worker steps print is replayed by the calling thread, in step order.
+    durations, if given, is filled with seconds per step."""
+    graph = step_graph(steps)
+    step_kwargs = step_kwargs or {}
+    durations = {} if durations is None else durations
+    order = list(steps)
+    done, running = set(), {}
+    base_columns, created = list(df.columns), {}
+    budget = get_budget()
+
+    def apply(step, outputs):
+        nonlocal df
+        for position, col in enumerate(outputs['columns']):
+            if col not in df:
+                created.setdefault(col, (order.index(step), position))
+        df = apply_outputs(df, outputs)
+        done.add(step)
+
+    # output of finished worker steps, printed in step order once no earlier step is running
+    logs = {}
+
+    def replay(all_logs=False):
+        for step in sorted(logs, key=order.index):
+            if not all_logs and any(order.index(other) < order.index(step) for other in running.values()):
+                break
+            print(logs.pop(step), end='', flush=True)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(done) < len(order):
+            ready = [step for step in order if step not in done and step not in running.values()
+                     and graph[step] <= done]
+            for step in ready:
+                spec = steps[step]
+                kwargs = step_kwargs.get(step, {})
+                start = time.monotonic()
+                if is_barrier(spec):
+                    # nothing else is ready or running when a barrier is
+                    df = serial_order(df, base_columns, created)
+                    df = spec['function'](df, **kwargs)
+                    base_columns, created = list(df.columns), {}
+                    done.add(step)
+                elif not any(col in df for col in spec['inputs']):
+                    done.add(step)
+                    durations[step] = 0
+                    continue
+                elif spec.get('network') and max_workers > 1:
+                    future = executor.submit(timed_outputs, budget, step, spec,
+                                             step_inputs(df, spec['inputs']), cache_dir, kwargs)
+                    running[future] = step
+                    continue
+                else:
+                    apply(step, cached_outputs(step, spec['function'], step_inputs(df, spec['inputs']),
+                                               cache_dir, spec.get('code', []), **kwargs))
+                durations[step] = time.monotonic() - start
+            if running and not [step for step in order if step not in done and step not in running.values()
+                                and graph[step] <= done]:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                # merge in step order, so concurrent steps finishing together apply deterministically
+                for future in sorted(finished, key=lambda future: order.index(running[future])):
+                    step = running.pop(future)
+                    outputs, durations[step], logs[step], error = future.result()
+                    if error is not None:
+                        replay(all_logs=True)
+                        raise error
+                    apply(step, outputs)
+                replay()
+    return serial_order(df, base_columns, created)
@@ -1,13 +1,79 @@
 import os
 import re
+import sys
+import threading
+from contextlib import contextmanager
 from pathlib import Path
+
+import requests
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+from pandas.util import hash_pandas_object
 
 from helper_files.constants.tier1_mapping import KEY_COLS
 
 BOLD_START = '\033[1m'
 BOLD_END = '\033[0;0m'
 
+# Shared HTTP session, only started by long-running processes to reuse connections across jobs
+_SESSION = None
+
+def start_session():
+    """Start a requests Session shared by all HTTP requests of the process and return it"""
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = requests.Session()
+    return _SESSION
+
+class ThreadLocalStdout:
+    """sys.stdout replacement that writes what a capturing thread prints to its own buffer,
+    i.e. the output of each job of the conversion service. Threads that are not capturing write to the original stdout."""
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def target(self):
+        return getattr(self.local, 'buffer', None) or self.stdout
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+    def isatty(self):
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+    @contextmanager
+    def capture(self, buffer):
+        # captures nest, i.e. a step of a job, and restore the enclosing buffer
+        previous = getattr(self.local, 'buffer', None)
+        self.local.buffer = buffer
+        try:
+            yield buffer
+        finally:
+            self.local.buffer = previous
+
+def thread_local_stdout():
+    """Install ThreadLocalStdout as sys.stdout, if not yet, and return it"""
+    if not isinstance(sys.stdout, ThreadLocalStdout):
+        sys.stdout = ThreadLocalStdout(sys.stdout)
+    return sys.stdout
+
+def captured_output(buffer):
+    """Context manager writing what the current thread prints to buffer, leaving the output of other threads untouched"""
+    return thread_local_stdout().capture(buffer)
+
+def http_get(url, **kwargs):
+    """requests.get through the shared session if one was started"""
+    if _SESSION is not None:
+        return _SESSION.get(url, **kwargs)
+    return requests.get(url, **kwargs)
+
 def get_label(filename: str) -> str:
     label = Path(filename).stem  # strip extension
     label = re.sub(r'hca[_\s-]*tier[_\s-]*1[_\s-]*metadata', '', label, flags=re.I)
@@ -28,11 +94,13 @@ def filename_suffixed(
 def detect_excel_format(spreadsheet_path, tab_name=None):
     """DCP, HLCA, Gut, Tracker and dcp-to-tier1 use small variations of the DCP spreadsheet.
     here we want to detect which variation is automatically and open to have programmatic name as header and from row 1+ the values"""
-    df = pd.read_excel(spreadsheet_path, sheet_name=None, nrows=10, header=None)
-
+    excel = spreadsheet_path if isinstance(spreadsheet_path, pd.ExcelFile) else pd.ExcelFile(spreadsheet_path)
     donor_file_tab = re.compile(r'donor', re.IGNORECASE)
-    tab_name = next((k for k in df.keys() if donor_file_tab.search(k)), list(df.keys())[0]) if not tab_name else tab_name
-    df = {k: d.fillna('').astype(str) for k,d in df.items()}
+    tab_name = next((k for k in excel.sheet_names if donor_file_tab.search(k)), excel.sheet_names[0]) if not tab_name else tab_name
+    # only the first rows of the chosen tab are parsed
+    df = {tab_name: excel.parse(tab_name, nrows=10, header=None).fillna('').astype(str)}
+    if excel is not spreadsheet_path:
+        excel.close()
 
     if len(df[tab_name]) < 4:
         # if less than 3 rows in sheet, dcp headers are missing, so it's dcp-to-tier1 format
@@ -75,20 +143,126 @@ def merge_same_key_tabs(df):
     return df
 
 
-def open_spreadsheet(spreadsheet_path, tab_name=None):
+def select_tabs(sheet_names, tabs=None):
+    """Sheet names allowed by tabs, a list of exact names or compiled regex patterns. All sheets if tabs is None"""
+    if tabs is None:
+        return list(sheet_names)
+    return [sheet for sheet in sheet_names
+            if any(sheet == tab if isinstance(tab, str) else tab.search(sheet) for tab in tabs)]
+
+def spreadsheet_tabs(spreadsheet_path):
+    """Tab names of a spreadsheet, without parsing any tab"""
+    if not os.path.exists(spreadsheet_path):
+        raise FileNotFoundError(f"File not found at {spreadsheet_path}")
+    with pd.ExcelFile(spreadsheet_path) as excel:
+        return [sheet for sheet in excel.sheet_names if sheet != 'validation_sheet']
+
+def open_spreadsheet(spreadsheet_path, tab_name=None, tabs=None, columns=None):
+    """Open a spreadsheet tab (tab_name) or a dictionary of tabs.
+    tabs restricts the parsed sheets (see select_tabs) and columns the parsed columns of each sheet,
+    either as a predicate on the column name or as a {tab: predicate} dictionary."""
     if not os.path.exists(spreadsheet_path):
         raise FileNotFoundError(f"File not found at {spreadsheet_path}")
-    skiprows = detect_excel_format(spreadsheet_path)
-    df = pd.read_excel(
-        spreadsheet_path,
-        sheet_name=tab_name,
-        skiprows=skiprows,
-        index_col=None
-    )
-    if not tab_name and 'Donor organism' not in df:
+    with pd.ExcelFile(spreadsheet_path) as excel:
+        skiprows = detect_excel_format(excel)
+        sheet_names = [tab_name] if tab_name else select_tabs(excel.sheet_names, tabs)
+        df = {sheet: excel.parse(sheet, skiprows=skiprows, index_col=None,
+                                 usecols=columns.get(sheet) if isinstance(columns, dict) else columns)
+              for sheet in sheet_names}
+        is_dcp = 'Donor organism' in excel.sheet_names
+    if tab_name:
+        df = df[tab_name]
+    elif not is_dcp:
         df = merge_same_key_tabs(df)
     if 'validation_sheet' in df:
         df.pop('validation_sheet')
     if check_empty_sheet(df):
         raise ValueError(f'Spreadsheet {spreadsheet_path} has empty sheet')
     return drop_empty_cols(df) if tab_name else {k: drop_empty_cols(d) for k, d in df.items() if not d.empty}
+
+# string columns with at most this share of distinct values are kept as categories
+COMPACT_RATIO = 0.5
+
+def compact_categories(df, max_ratio=COMPACT_RATIO):
+    """Turn low-cardinality string columns into categories, i.e. literals broadcast to every row,
+    taxon IDs and ontology labels. Columns with unhashable values are left as they are."""
+    for col in df.columns[(df.dtypes == object) | df.dtypes.map(pd.api.types.is_string_dtype)].unique():
+        if isinstance(df[col], pd.DataFrame) or isinstance(df[col].dtype, pd.CategoricalDtype):
+            continue
+        try:
+            n_values = df[col].nunique()
+        except TypeError:
+            continue
+        if n_values <= max_ratio * len(df):
+            df[col] = df[col].astype('category')
+    return df
+
+def expand_categories(df, columns=None):
+    """Turn categorical columns, or the given ones, back to their values' dtype"""
+    for col in df.select_dtypes('category'):
+        if columns is None or col in columns:
+            df[col] = df[col].astype(df[col].cat.categories.dtype)
+    return df
+
+def concat_categories(frames):
+    """Concatenate frames, keeping columns that are categorical in any of them categorical,
+    with the union of their categories"""
+    frames = list(frames)
+    if not frames:
+        return pd.DataFrame()
+    for col in dict.fromkeys(col for frame in frames for col in frame.select_dtypes('category')):
+        categories = union_categoricals([frame[col].astype('category') for frame in frames if col in frame]).categories
+        for frame in frames:
+            if col in frame:
+                frame[col] = frame[col].astype(pd.CategoricalDtype(categories))
+    return pd.concat(frames, ignore_index=True)
+
+def replace_values(values, mapping):
+    """values.replace(mapping), which for a categorical only replaces its categories, merging the ones
+    replaced by the same value"""
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        return values.replace(mapping)
+    new_codes, categories = pd.factorize(values.cat.categories.to_series().replace(mapping))
+    codes = values.cat.codes.to_numpy()
+    if len(new_codes):
+        codes = np.where(codes >= 0, new_codes[codes], -1)
+    return pd.Series(pd.Categorical.from_codes(codes, categories), index=values.index, name=values.name)
+
+def frame_memory(df):
+    """MB of df in memory, and MB it would take with its categorical columns expanded"""
+    usage = df.memory_usage(deep=True, index=False)
+    expanded = usage.to_numpy().copy()
+    for position, dtype in enumerate(df.dtypes):
+        if isinstance(dtype, pd.CategoricalDtype):
+            expanded[position] = df.iloc[:, position].astype(dtype.categories.dtype).memory_usage(deep=True, index=False)
+    return usage.sum() / 1024 ** 2, expanded.sum() / 1024 ** 2
+
+def memory_row(stage, frames):
+    """Memory report line of a stage, for a frame or a dictionary of frames (i.e. spreadsheet tabs)"""
+    frames = frames.values() if isinstance(frames, dict) else [frames]
+    compact, expanded = (sum(values) for values in zip(*[frame_memory(frame) for frame in frames]))
+    return {'stage': stage, 'rows': sum(len(frame) for frame in frames), 'columns': sum(frame.shape[1] for frame in frames),
+            'MB': round(compact, 3), 'MB expanded': round(expanded, 3),
+            'saving %': round(100 * (1 - compact / expanded), 1) if expanded else 0.0}
+
+def record_memory(report, stage, frames):
+    """Append the memory report line of a stage to report, unless it is None"""
+    if report is not None:
+        report.append(memory_row(stage, frames))
+
+def hash_column(values):
+    try:
+        return hash_pandas_object(values, index=False).to_numpy()
+    except TypeError:
+        # unhashable values like lists
+        return hash_pandas_object(values.astype(str), index=False).to_numpy()
+
+def cell_hashes(df):
+    """uint64 fingerprint of every cell of df. Object columns also hash the type of each value,
+    since hash_pandas_object hashes 1 and '1' the same"""
+    hashes = {}
+    for col in df.columns:
+        hashes[col] = hash_column(df[col])
+        if df[col].dtype == object:
+            hashes[col] = hashes[col] ^ hash_column(df[col].map(lambda value: type(value).__name__))
+    return pd.DataFrame(hashes, index=df.index, columns=df.columns)
@@ -0,0 +1,146 @@
+from functools import lru_cache
+
+import pandas as pd
+
+from helper_files.constants.required_fields import required_fields
+from helper_files.constants.dcp_required import dcp_required_entities
+from helper_files.constants.tier1_mapping import tier1_enum
+from helper_files.convert import get_xml_keys, get_schema_key, get_entity_schema, entity_to_tab
+from helper_files.utils import BOLD_START, BOLD_END
+
+# Both requirement tables are compiled once at import:
+# module keys go into a character trie so every module key contained in a field
+# is found in a single scan of the field, requirements become frozensets.
+_END = object()
+
+def build_trie(keys):
+    trie = {}
+    for key in keys:
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[_END] = key
+    return trie
+
+REQUIRED_MODULES = {module: frozenset(fields) for module, fields in required_fields.items()}
+REQUIRED_ENTITIES = {tab: frozenset(fields) for tab, fields in dcp_required_entities.items()}
+MODULE_TRIE = build_trie(REQUIRED_MODULES)
+
+@lru_cache(maxsize=None)
+def field_modules(field):
+    """Return the required_fields module keys contained in field, same as `key in field` for each key."""
+    modules = set()
+    for start in range(len(field)):
+        node = MODULE_TRIE
+        for char in field[start:]:
+            if char not in node:
+                break
+            node = node[char]
+            if _END in node:
+                modules.add(node[_END])
+    return frozenset(modules)
+
+def field_prefixes(fields):
+    """Set of all fields and their dotted prefixes, so `donor_organism.sex` is satisfied by
+    `donor_organism.sex` and `donor_organism.development_stage` by `donor_organism.development_stage.text`"""
+    prefixes = set()
+    for field in fields:
+        parts = field.split('.')
+        prefixes.update('.'.join(parts[:i]) for i in range(1, len(parts) + 1))
+    return prefixes
+
+def filled_fields(tab):
+    return tab.dropna(axis=1, how='all').columns
+
+def validate_required_fields(spreadsheet):
+    """Return {tab: [missing required fields]} for a dcp spreadsheet dictionary of tabs.
+    Module requirements (required_fields) are triggered by any filled field of that module across the spreadsheet,
+    entity requirements (dcp_required_entities) apply to every non-empty tab."""
+    tabs = {tab_name: tab for tab_name, tab in spreadsheet.items() if tab_name != 'Schemas' and not tab.empty}
+    all_fields = set()
+    for tab in tabs.values():
+        all_fields.update(filled_fields(tab))
+
+    missing = set()
+    for field in all_fields:
+        for module in field_modules(field):
+            missing.update(REQUIRED_MODULES[module] - all_fields)
+
+    missing_dict = {}
+    for field in missing:
+        missing_dict.setdefault(entity_to_tab(field.split('.')[0]), set()).add(field)
+
+    for tab_name, tab in tabs.items():
+        tab_prefixes = field_prefixes(filled_fields(tab))
+        missing_ent = {req for req in REQUIRED_ENTITIES.get(tab_name, frozenset()) - tab_prefixes
+                       if not any(field == req or field.startswith(req + '.') for field in missing_dict.get(tab_name, ()))}
+        if missing_ent:
+            missing_dict.setdefault(tab_name, set()).update(missing_ent)
+    return {tab_name: sorted(fields) for tab_name, fields in missing_dict.items()}
+
+def print_missing_fields(missing_dict):
+    print(f"{BOLD_START}MISSING DCP REQUIRED FIELDS: {BOLD_END}")
+    for key, values in missing_dict.items():
+        print(f"\t{key}:\t{', '.join(values)}")
+
+def check_required_fields(spreadsheet):
+    missing_dict = validate_required_fields(spreadsheet)
+    if missing_dict:
+        print_missing_fields(missing_dict)
+    return missing_dict
+
+# Enum restrictions, keyed by (versioned schema key, property)
+ENUM_CACHE = {}
+
+def enum_property(field):
+    """Split a programmatic field into the schema holding it and the enum property,
+    i.e. specimen_from_organism.preservation_storage.storage_method -> (preservation_storage, storage_method)"""
+    parts = field.split('.')
+    if parts[-1] in ['text', 'ontology', 'ontology_label'] or parts[-1].endswith('_id') or len(parts) < 2:
+        return None, None
+    return parts[-2], parts[-1]
+
+def get_enum_values(field, xml_keys):
+    schema, prop = enum_property(field)
+    if not schema:
+        return None
+    schema_key = get_schema_key(schema, xml_keys)
+    if not schema_key:
+        return None
+    if (schema_key, prop) not in ENUM_CACHE:
+        prop_schema = get_entity_schema(schema, xml_keys).get('properties', {}).get(prop, {})
+        prop_schema = prop_schema.get('items', prop_schema)
+        ENUM_CACHE[(schema_key, prop)] = frozenset(prop_schema['enum']) if 'enum' in prop_schema else None
+    return ENUM_CACHE[(schema_key, prop)]
+
+def load_enum_restrictions(fields):
+    """Return {field: frozenset of allowed values} for the fields that are enums in the DCP schema"""
+    xml_keys = get_xml_keys()
+    enums = {field: get_enum_values(field, xml_keys) for field in dict.fromkeys(fields)}
+    return {field: enum for field, enum in enums.items() if enum is not None}
+
+def validate_enum_values(df, fields=None):
+    """Return a table of field, value, n_rows for every value of df not allowed by the schema enum"""
+    fields = tier1_enum if fields is None else fields
+    enums = load_enum_restrictions([field for field in fields if field in df])
+    violations = []
+    for field, enum in enums.items():
+        values = df[field]
+        invalid = values[values.notna() & ~values.isin(enum)]
+        if invalid.empty:
+            continue
+        counts = invalid.astype(str).value_counts(sort=False)
+        violations.append(pd.DataFrame({'field': field, 'value': counts.index, 'n_rows': counts.values}))
+    if not violations:
+        return pd.DataFrame(columns=['field', 'value', 'n_rows'])
+    return pd.concat(violations, ignore_index=True)
+
+def print_enum_violations(violations):
+    print(f"{BOLD_START}WARNING:{BOLD_END} Value(s) not valid in schema enum")
+    print('\t' + violations.to_string(index=False).replace('\n', '\n\t'))
+
+def check_enum_values(df, fields=None):
+    violations = validate_enum_values(df, fields)
+    if not violations.empty:
+        print_enum_violations(violations)
+    return violations
@@ -5,23 +5,29 @@ import pandas as pd
 from helper_files.constants.file_mapping import (
     FILE_MANIFEST_MAPPING,
     TIER_1_MAPPING,
-    FASTQ_STANDARD_FIELDS
+    FASTQ_STANDARD_FIELDS,
+    FILE_MANIFEST_CHUNKSIZE
 )
 from helper_files.merge import (
-    merge_overlap,
+    merge_overlap_chunks,
+    read_file_manifest,
     open_spreadsheet,
     flatten_tiered_spreadsheet,
     merge_file_manifest,
     add_standard_fields,
     add_tier1_fields,
-    perform_checks
+    perform_checks,
+    check_dcp_required_fields,
+    check_enum_values
 )
+from helper_files.constants.tier1_mapping import KEY_COLS
+from helper_files.fastq import find_fastqs, add_checksums, add_fastq_headers
 
 def define_parse():
     parser = argparse.ArgumentParser(description="Merge Tier 2 metadata into DCP format.")
     parser.add_argument("-fm", "--file_manifest", action='store', 
                         dest="file_manifest", type=str, required=True,
-                        help="File manifest path")
+                        help="File manifest path (xlsx, csv, tsv or parquet)")
     parser.add_argument("-dt", "--dcp_tier1_spreadsheet", action="store",
                         dest="dt_spreadsheet", type=str, required=True,
                         help="DCP formeted tier 1 spreadsheet path")
@@ -31,22 +37,45 @@ def define_parse():
     parser.add_argument("-o", "--output_dir", action="store",
                         dest="output_dir", type=str, required=False, default='metadata/fm/',
                         help="Directory for the output files")
+    parser.add_argument("--chunksize", action="store",
+                        dest="chunksize", type=int, required=False, default=FILE_MANIFEST_CHUNKSIZE,
+                        help="Rows of csv, tsv or parquet file manifests read at a time")
+    parser.add_argument("--fastq_dir", action="store",
+                        dest="fastq_dir", type=str, required=False, default=None,
+                        help="Directory of local fastqs, to compute checksums and sizes and read the fastq headers")
+    parser.add_argument("--checksums", action="store",
+                        dest="checksums", type=str, required=False, default=None,
+                        help="Provided checksums (md5sum/sha256sum output or csv/tsv with file_name, md5, sha256 columns) to check against the local fastqs")
     return parser
 
-def main(file_manifest, dt_spreadsheet, tier1_spreadsheet, output_dir):
+def main(file_manifest, dt_spreadsheet, tier1_spreadsheet, output_dir, chunksize=FILE_MANIFEST_CHUNKSIZE,
+         fastq_dir=None, checksums=None):
 
-    file_manifest = open_spreadsheet(spreadsheet_path=file_manifest, tab_name="File_manifest")
+    file_manifest = read_file_manifest(file_manifest, columns=FILE_MANIFEST_MAPPING.keys(), chunksize=chunksize)
     dt_df = open_spreadsheet(dt_spreadsheet)
     # if 'Sequence file' in dt_df:
     #     del dt_df['Sequence file']
-    tier1_spreadsheet = open_spreadsheet(tier1_spreadsheet)
+    # only key columns and the ones mapped to the Sequence file tab are needed from tier 1
+    tier1_columns = set(KEY_COLS) | set(TIER_1_MAPPING.keys())
+    tier1_spreadsheet = open_spreadsheet(tier1_spreadsheet, columns=lambda col: str(col).lower() in tier1_columns)
     tier1_spreadsheet = flatten_tiered_spreadsheet(tier1_spreadsheet)
 
-    file_manifest = file_manifest.rename(columns=FILE_MANIFEST_MAPPING)
-    dt_df['Sequence file'] = merge_overlap(dt_df['Sequence file'], file_manifest, list(file_manifest.columns), key='sequence_file.file_core.file_name', suffix='fm')
+    file_manifest = (chunk.rename(columns=FILE_MANIFEST_MAPPING) for chunk in file_manifest)
+    dt_df['Sequence file'] = merge_overlap_chunks(dt_df['Sequence file'], file_manifest, key='sequence_file.file_core.file_name', suffix='fm')
+    check_enum_values(dt_df['Sequence file'], fields=FILE_MANIFEST_MAPPING.values())
     dt_df['Sequence file'] = add_standard_fields(dt_df['Sequence file'], FASTQ_STANDARD_FIELDS)
+    sniffed = None
+    if fastq_dir:
+        paths = find_fastqs(fastq_dir, dt_df['Sequence file']['sequence_file.file_core.file_name'].dropna())
+        dt_df['Sequence file'], checksums_df = add_checksums(dt_df['Sequence file'], paths, checksums,
+                                                             cache_path=os.path.join(output_dir, 'fastq_checksums.json'))
+        checksums_path = os.path.join(output_dir, os.path.basename(dt_spreadsheet).replace(".xlsx", "_checksums.csv"))
+        checksums_df.to_csv(checksums_path, index=False)
+        print(f"Checksums and sizes of fastqs saved in {checksums_path}.")
+        dt_df['Sequence file'], sniffed = add_fastq_headers(dt_df['Sequence file'], paths)
     dt_df['Sequence file'] = add_tier1_fields(dt_df, tier1_spreadsheet, TIER_1_MAPPING)
-    perform_checks(dt_df)
+    perform_checks(dt_df, sniffed)
+    check_dcp_required_fields(dt_df)
 
     output_filename = os.path.basename(dt_spreadsheet).replace(".xlsx", "_fastqed.xlsx")
     with pd.ExcelWriter(os.path.join(output_dir, output_filename), engine='openpyxl') as writer:
@@ -60,4 +89,5 @@ def main(file_manifest, dt_spreadsheet, tier1_spreadsheet, output_dir):
 if __name__ == "__main__":
     args = define_parse().parse_args()
     main(file_manifest=args.file_manifest, dt_spreadsheet=args.dt_spreadsheet,
-         tier1_spreadsheet=args.tier1_spreadsheet, output_dir=args.output_dir)
\ No newline at end of file
+         tier1_spreadsheet=args.tier1_spreadsheet, output_dir=args.output_dir, chunksize=args.chunksize,
+         fastq_dir=args.fastq_dir, checksums=args.checksums)
\ No newline at end of file
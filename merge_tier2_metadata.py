@@ -5,6 +5,7 @@ import pandas as pd
 
 from helper_files.constants.tier2_mapping import TIER2_TO_DCP, TIER2_TO_DCP_UPDATE
 from helper_files.utils import open_spreadsheet
+from helper_files.ontology import build_matcher, start_lookup_budget, export_needs_label
 from helper_files.convert import (
     fill_ontologies,
     flatten_tiered_spreadsheet
@@ -14,7 +15,8 @@ from helper_files.merge import (
     rename_tier2_columns,
     merge_tier2_with_dcp,
     add_protocol_targets,
-    check_dcp_required_fields
+    check_dcp_required_fields,
+    check_enum_values
 )
 
 def define_parse():
@@ -28,10 +30,19 @@ def define_parse():
     parser.add_argument("-o", "--output_dir", action="store",
                         dest="output_dir", type=str, required=False, default='metadata/t2/',
                         help="Directory for the output files")
+    parser.add_argument("--ols_deadline", action="store",
+                        dest="ols_deadline", type=float, required=False, default=600,
+                        help="Total seconds allowed for ontology lookups before keeping IDs unlabelled")
+    parser.add_argument("--ols_timeout", action="store",
+                        dest="ols_timeout", type=float, required=False, default=10,
+                        help="Timeout in seconds of a single ontology lookup")
+    parser.add_argument("--ontology_dump", action="store", nargs='+',
+                        dest="ontology_dump", type=str, required=False,
+                        help="Ontology dumps (.obo, or csv/tsv with obo_id, label and synonyms) to match free text to ontology IDs locally instead of OLS search")
     return parser
 
-def main(tier2_spreadsheet, dt_spreadsheet, output_dir='metadata'):
-    
+def main(tier2_spreadsheet, dt_spreadsheet, output_dir='metadata', ontology_dump=None, ols_deadline=600, ols_timeout=10):
+    start_lookup_budget(deadline=ols_deadline, timeout=ols_timeout)
     all_tier2 = {**TIER2_TO_DCP, **TIER2_TO_DCP_UPDATE}
 
     tier2_df = open_spreadsheet(tier2_spreadsheet)
@@ -40,7 +51,8 @@ def main(tier2_spreadsheet, dt_spreadsheet, output_dir='metadata'):
     tier2_flat = flatten_tiered_spreadsheet(tier2_df, merge_type='outer')
     tier2_flat = manual_fixes(tier2_flat)
     tier2_flat = rename_tier2_columns(tier2_flat, all_tier2)
-    tier2_flat = fill_ontologies(tier2_flat)
+    check_enum_values(tier2_flat, fields=tier2_flat.columns)
+    tier2_flat = fill_ontologies(tier2_flat, matcher=build_matcher(ontology_dump) if ontology_dump else None)
     
     merged_df = merge_tier2_with_dcp(tier2_flat, dt_df)
     merged_df = add_protocol_targets(tier2_flat, merged_df)
@@ -53,7 +65,9 @@ def main(tier2_spreadsheet, dt_spreadsheet, output_dir='metadata'):
             df = df.reindex(index=[-1] + list(df.index)).reset_index(drop=True)
             df.to_excel(writer, sheet_name=tab_name, index=False, startrow=3)
     print(f"Tier 2 metadata has been added to {os.path.join(output_dir, output_filename)}.")
+    export_needs_label(output_dir, os.path.splitext(output_filename)[0])
 
 if __name__ == "__main__":
     args = define_parse().parse_args()
-    main(tier2_spreadsheet=args.tier2_spreadsheet, dt_spreadsheet=args.dt_spreadsheet, output_dir=args.output_dir)
\ No newline at end of file
+    main(tier2_spreadsheet=args.tier2_spreadsheet, dt_spreadsheet=args.dt_spreadsheet, output_dir=args.output_dir,
+         ontology_dump=args.ontology_dump, ols_deadline=args.ols_deadline, ols_timeout=args.ols_timeout)
\ No newline at end of file
@@ -115,3 +115,20 @@ def test_doi_search_ingest_found(mock_get, mock_request):
     }
     mock_request.return_value.raise_for_status.return_value = None
     doi_search_ingest("10.1234/example", token="fake")
+
+
+@mock.patch("requests.get")
+def test_download_h5ad_file_interrupted(mock_get, tmp_path):
+    def broken_stream(chunk_size):
+        yield b"123"
+        raise ConnectionError("reset")
+    mock_resp = mock.Mock()
+    mock_resp.iter_content = broken_stream
+    mock_resp.headers = {"Content-Length": "5"}
+    mock_get.return_value.__enter__.return_value = mock_resp
+
+    out_file = tmp_path / "test.h5ad"
+    with pytest.raises(ConnectionError):
+        download_h5ad_file("http://example.com/file.h5ad", str(out_file), quiet=True)
+    # partial download is not left under the final name
+    assert not out_file.exists()
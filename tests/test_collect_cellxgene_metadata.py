@@ -3,6 +3,8 @@ import pandas as pd
 import pytest
 
 import collect_cellxgene_metadata
+from helper_files import h5ad_store
+from helper_files.h5ad_store import H5adStore
 from tests.test_collect import dummy_collection
 
 @pytest.fixture
@@ -14,8 +16,10 @@ def mock_all(mocker, dummy_collection):
         collect_cellxgene_metadata, "get_collection_data", return_value=dummy_collection_copy
     )
     mock_download = mocker.patch.object(
-        collect_cellxgene_metadata, "download_h5ad_file"
+        h5ad_store, "download_h5ad_file",
+        side_effect=lambda url, path, quiet=False: open(path, "wb").close()
     )
+    mocker.patch.object(h5ad_store, "remote_file_size", return_value=0)
 
     # Fake AnnData object with obs DataFrame
     obs_df = pd.DataFrame({
@@ -39,7 +43,8 @@ def mock_all(mocker, dummy_collection):
 def test_main_integration_real_extract(mock_all, tmp_path):
     # Run main with mocked dependencies
     label = collect_cellxgene_metadata.main(
-        collection_id="cid", dataset_id="ds1", output_dir=str(tmp_path)
+        collection_id="cid", dataset_id="ds1", output_dir=str(tmp_path),
+        store=H5adStore(str(tmp_path / "h5ads"))
     )
 
     # Check output files exist
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import anndata
+import pytest
+
+import collect_local_metadata
+from helper_files.collect import extract_and_save_metadata
+from helper_files.h5ad_obs import open_anndata, obs_chunk_rows
+
+
+def local_adata():
+    # anndata 0.10 cannot write pandas str arrays
+    with pd.option_context("future.infer_string", False):
+        obs = pd.DataFrame({
+            "library_id": pd.Categorical(["lib1", "lib1", "lib2", "lib2"]),
+            "donor_id": pd.Categorical(["don1", "don1", "don2", "don2"]),
+            "tissue_type": np.array(["tissue", "tissue", "tissue", "organoid"], dtype=object),
+            "cell_type_ontology_term_id": pd.Categorical(["CL:1", "CL:2", "CL:1", "CL:1"]),
+        }, index=pd.Index(np.array(["c1", "c2", "c3", "c4"], dtype=object)))
+        return anndata.AnnData(obs=obs, uns={"title": "Local study", "study_pi": ["Doe,Jane"],
+                                             "batch_condition": np.array(["donor_id", "library_id"], dtype=object),
+                                             "unrelated": {"nested": np.arange(3)}})
+
+
+@pytest.fixture
+def no_network(mocker):
+    return mocker.patch("requests.Session.request", side_effect=AssertionError("network access"))
+
+
+def test_collect_local_h5ad(tmp_path, no_network, capsys):
+    path = tmp_path / "lung_atlas.h5ad"
+    with pd.option_context("future.infer_string", False):
+        local_adata().write_h5ad(path)
+    label = collect_local_metadata.main(str(path), output_dir=str(tmp_path / "t1"))
+    assert label == "lung_atlas"
+    study = pd.read_csv(tmp_path / "t1" / "lung_atlas_study_metadata.csv", header=None, index_col=0).T
+    assert study[["title", "study_pi", "batch_condition"]].values.tolist() == [["Local study", "Doe,Jane", "donor_id||library_id"]]
+
+    # same obs outputs as the in-memory path
+    expected = tmp_path / "expected"
+    expected.mkdir()
+    extract_and_save_metadata(anndata.read_h5ad(path), label, str(expected))
+    for name in ["metadata", "cell_obs", "inconsistent_fields"]:
+        assert (tmp_path / "t1" / f"lung_atlas_{name}.csv").read_bytes() == (expected / f"lung_atlas_{name}.csv").read_bytes()
+    no_network.assert_not_called()
+
+
+def test_collect_local_zarr(tmp_path, no_network):
+    pytest.importorskip("zarr")
+    path = tmp_path / "lung_atlas.zarr"
+    with pd.option_context("future.infer_string", False):
+        local_adata().write_zarr(path, chunks=[2])
+    collect_local_metadata.main(str(path), output_dir=str(tmp_path / "t1"), max_memory=0.001, workers=2)
+    metadata = pd.read_csv(tmp_path / "t1" / "lung_atlas_metadata.csv")
+    assert metadata["library_id"].tolist() == ["lib1", "lib2", "lib2"]
+    assert metadata["cell_suspension.estimated_cell_count"].tolist() == [2, 2, 2]
+
+    # read ahead in chunks of the store, same outputs as the in-memory path
+    expected = tmp_path / "expected"
+    expected.mkdir()
+    extract_and_save_metadata(anndata.read_zarr(path), "lung_atlas", str(expected))
+    for name in ["metadata", "cell_obs", "inconsistent_fields"]:
+        assert (tmp_path / "t1" / f"lung_atlas_{name}.csv").read_bytes() == (expected / f"lung_atlas_{name}.csv").read_bytes()
+    with open_anndata(str(path)) as group:
+        assert obs_chunk_rows(group, 1) % 2 == 0
+
+
+def test_missing_input(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        collect_local_metadata.main(str(tmp_path / "missing.h5ad"), output_dir=str(tmp_path))
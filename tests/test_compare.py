@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+
+from helper_files.compare import (
+    init_report_dict,
+    compare_v_ids,
+    get_unmatched_ids,
+    compare_filled_fields,
+    pair_rows,
+    diff_frames,
+    index_report,
+    query_field_diffs
+)
+
+ID = "cell_suspension.biomaterial_core.biomaterial_id"
+
+def spreadsheets(tier1_ids, wrangled_ids):
+    tier1 = {"Cell suspension": pd.DataFrame({ID: tier1_ids, "cell_suspension.cell_number": range(len(tier1_ids))})}
+    wrangled = {"Cell suspension": pd.DataFrame({ID: wrangled_ids, "cell_suspension.cell_number": range(len(wrangled_ids))})}
+    return tier1, wrangled
+
+def test_compare_v_ids_report(capsys):
+    tier1, wrangled = spreadsheets([f"lib{i}" for i in range(5000)], [f"lib{i}" for i in range(4999, -1, -1)])
+    report_dict = compare_v_ids("Cell suspension", init_report_dict(), tier1, wrangled)
+    assert report_dict["ids"]["values"]["Cell suspension"]["tier1"] == tier1["Cell suspension"][ID].tolist()
+    assert report_dict["ids"]["values"]["Cell suspension"]["wrangled"] == wrangled["Cell suspension"][ID].tolist()
+    assert "not identical" not in capsys.readouterr().out
+
+def test_unmatched_ids(capsys):
+    tier1, wrangled = spreadsheets(["lib1", "lib2", None], ["lib2", "lib3"])
+    report_dict = compare_v_ids("Cell suspension", init_report_dict(), tier1, wrangled)
+    assert "not identical" in capsys.readouterr().out
+    assert get_unmatched_ids(report_dict, "Cell suspension", "tier1") == {"lib1"}
+    assert get_unmatched_ids(report_dict, "Cell suspension", "wrangled") == {"lib3"}
+
+def test_compare_filled_fields_partial_overlap(capsys):
+    tier1, wrangled = spreadsheets(["lib1", "lib2"], ["lib2", "lib3"])
+    report_dict = compare_v_ids("Cell suspension", init_report_dict(), tier1, wrangled)
+    report_dict = compare_filled_fields("Cell suspension", report_dict, tier1, wrangled)
+    assert "comparing values of the 1 shared IDs" in capsys.readouterr().out
+    # lib2 has cell_number 1 in tier 1 and 0 in wrangled
+    assert report_dict["values"]["Cell suspension"]["values_diff"] == {
+        "cell_suspension.cell_number": {"lib2": {"tier1": 1, "wrangled": 0}}}
+
+def test_diff_frames_matches_compare():
+    rng = np.random.default_rng(0)
+    n = 2000
+    tier1 = pd.DataFrame({"n": rng.integers(0, 5, n), "s": rng.choice(["a", "b", None], n),
+                          "o": pd.Series(rng.choice(["1", 1, "x"], n), dtype=object)},
+                         index=[f"id{i}" for i in range(n)])
+    wrangled = tier1.copy()
+    changed = rng.choice(n, 100, replace=False)
+    wrangled.iloc[changed[:50], 0] = 9
+    wrangled.iloc[changed[50:], 2] = 1
+    wrangled["n"] = wrangled["n"].astype(float)
+    expected = tier1.compare(wrangled, result_names=("tier1", "wrangled"), align_axis=1)
+    result = diff_frames(tier1, wrangled)
+    pd.testing.assert_frame_equal(result, expected)
+    assert diff_frames(tier1, tier1).empty
+
+def test_pair_rows_unequal_rows():
+    tier1 = pd.DataFrame({"method": ["enzymatic", "mechanical", "none"]})
+    wrangled = pd.DataFrame({"method": ["mechanical", "enzymatic"]})
+    paired_tier1, paired_wrang = pair_rows(tier1, wrangled)
+    assert paired_tier1["method"].tolist() == ["enzymatic", "mechanical"]
+    assert paired_wrang["method"].tolist() == ["enzymatic", "mechanical"]
+    assert diff_frames(paired_tier1, paired_wrang).empty
+
+def test_index_report_and_query(tmp_path):
+    db_path = str(tmp_path / "index.sqlite")
+    tier1, wrangled = spreadsheets(["lib1", "lib2"], ["lib2", "lib3"])
+    tier1["Cell suspension"]["cell_suspension.cell_number"] = [5, 7]
+    report_dict = compare_v_ids("Cell suspension", init_report_dict(), tier1, wrangled)
+    report_dict = compare_filled_fields("Cell suspension", report_dict, tier1, wrangled)
+    report_dict["tabs"]["intersect"] = ["Cell suspension"]
+    index_report(report_dict, "project_a", db_path=db_path)
+    # indexing again replaces the previous results of the label
+    index_report(report_dict, "project_a", db_path=db_path)
+    field_diffs = query_field_diffs("cell_suspension.cell_number", db_path=db_path)
+    assert field_diffs.to_dict(orient="records") == [
+        {"label": "project_a", "tab": "Cell suspension", "n_ids": 1, "ids": "lib2"}]
+    assert query_field_diffs("donor_organism.sex", db_path=db_path).empty
+
+def test_compare_filled_fields_duplicated_ids(capsys):
+    tier1, wrangled = spreadsheets(["lib1", "lib2"], ["lib1", "lib2", "lib2"])
+    report_dict = compare_v_ids("Cell suspension", init_report_dict(), tier1, wrangled)
+    report_dict = compare_filled_fields("Cell suspension", report_dict, tier1, wrangled)
+    assert "Wrangled Cell suspension duplicated IDs: lib2" in capsys.readouterr().out
+    assert report_dict["values"]["Cell suspension"]["duplicated_ids"] == {"wrangled": ["lib2"]}
+    assert report_dict["values"]["Cell suspension"]["values_diff"] == {}
@@ -0,0 +1,128 @@
+import sys
+import json
+import time
+import threading
+import urllib.request
+import urllib.error
+
+import pytest
+
+import conversion_service
+from conversion_service import JobRunner, create_server, job_arguments, no_input
+from helper_files.ontology import get_budget
+
+
+def chatty_job(name, n=3, local_template=None):
+    for i in range(n):
+        print(f"{name} {i}")
+        time.sleep(0.01)
+    return local_template
+
+
+def failing_job():
+    raise ValueError("broken")
+
+
+def degrading_job():
+    budget = get_budget()
+    degraded = budget.degraded
+    budget.degraded = True
+    return budget, degraded
+
+
+@pytest.fixture
+def jobs(mocker, monkeypatch):
+    # the runner replaces sys.stdout, restore it after the test
+    monkeypatch.setattr(sys, "stdout", sys.stdout)
+    return mocker.patch.dict(conversion_service.JOBS, {"chatty": chatty_job, "failing": failing_job}, clear=True)
+
+
+def wait_for(runner, job_id):
+    for _ in range(500):
+        status = runner.status(job_id)
+        if status["status"] in ("done", "failed"):
+            return status
+        time.sleep(0.01)
+    raise TimeoutError(job_id)
+
+
+def test_job_arguments(jobs):
+    assert job_arguments("chatty", {"name": "a"}, "template.xlsx") == {"name": "a", "local_template": "template.xlsx"}
+    assert job_arguments("chatty", {"name": "a", "local_template": "mine.xlsx"}, "template.xlsx")["local_template"] == "mine.xlsx"
+    with pytest.raises(TypeError):
+        job_arguments("chatty", {"label": "a"})
+    with pytest.raises(ValueError):
+        job_arguments("collect", {})
+
+
+def test_runner_captures_output_per_job(jobs):
+    runner = JobRunner(workers=2, local_template="template.xlsx")
+    ids = [runner.submit("chatty", {"name": name}) for name in ["a", "b"]]
+    status_a, status_b = (wait_for(runner, job_id) for job_id in ids)
+    runner.shutdown()
+    assert status_a["log"] == "a 0\na 1\na 2\n"
+    assert status_b["log"] == "b 0\nb 1\nb 2\n"
+    assert status_a["result"] == "template.xlsx"
+
+
+def test_runner_failed_job(jobs):
+    runner = JobRunner(workers=1)
+    status = wait_for(runner, runner.submit("failing", {}))
+    runner.shutdown()
+    assert status["status"] == "failed"
+    assert status["error"] == "ValueError: broken"
+
+
+def test_runner_fresh_budget_per_job(jobs):
+    jobs["degrading"] = degrading_job
+    runner = JobRunner(workers=1)
+    first, second = (wait_for(runner, runner.submit("degrading", {}))["result"] for _ in range(2))
+    runner.shutdown()
+    # the second job on the same pool thread does not inherit the degraded budget of the first
+    assert first[0] is not second[0]
+    assert not first[1] and not second[1]
+    assert get_budget() is not first[0]
+
+
+def test_no_input():
+    with pytest.raises(RuntimeError, match="service mode"):
+        no_input("Please select the index")
+
+
+def request(url, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data), timeout=5) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_http_api(jobs):
+    server = create_server(port=0, workers=1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        assert request(f"{url}/health") == (200, {"status": "ok", "jobs": ["chatty", "failing"]})
+        code, body = request(f"{url}/jobs", {"job": "chatty", "args": {"name": "x", "n": 1}})
+        assert code == 202
+        wait_for(server.RequestHandlerClass.runner, body["id"])
+        code, status = request(f"{url}/jobs/{body['id']}")
+        assert (code, status["status"], status["log"]) == (200, "done", "x 0\n")
+        assert request(f"{url}/jobs", {"job": "unknown"})[0] == 400
+        assert request(f"{url}/jobs/missing")[0] == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.RequestHandlerClass.runner.shutdown()
+
+
+def test_runner_keeps_recent_finished_jobs(jobs):
+    runner = JobRunner(workers=1, max_finished=2)
+    ids = [runner.submit("chatty", {"name": name, "n": 1}) for name in ["a", "b", "c"]]
+    runner.shutdown()
+    # the oldest finished job and its log are dropped
+    assert runner.status(ids[0]) is None
+    assert [job["id"] for job in runner.summary()] == ids[1:]
+    assert runner.status(ids[2])["log"] == "c 0\n"
+
@@ -11,8 +11,18 @@ from helper_files.convert import (
     make_protocol_name,
     collapse_values,
     ols_label,
-    flatten_tiered_spreadsheet
+    flatten_tiered_spreadsheet,
+    plan_joins,
+    get_dcp_template,
+    edit_all_sample_metadata,
+    fill_ontologies,
+    add_analysis_file,
+    create_protocol_ids,
+    populate_spreadsheet
 )
+from helper_files.constants.tier1_mapping import tier1_to_dcp
+from helper_files.ontology import start_lookup_budget
+from helper_files.utils import compact_categories, expand_categories
 
 def test_tab_entity_roundtrip():
     assert entity_to_tab(tab_to_entity("Cell suspension")) == "Cell suspension"
@@ -44,9 +54,78 @@ def test_ols_label(mock_get, term, expected):
     assert label == expected
 
 from tests.test_merge import tier1_spreadsheet
+from tests.test_step_cache import sample_metadata
+from helper_files import convert
 def test_flatten_tier1(tier1_spreadsheet):
     flat = flatten_tiered_spreadsheet(tier1_spreadsheet)
     assert "dataset_id" in flat
     assert "sample_id" in flat
     assert "donor_id" in flat
 
+
+def test_plan_joins_finest_first():
+    tabs = {
+        "Dataset": pd.DataFrame({"dataset_id": ["D1"]}),
+        "Donor": pd.DataFrame({"dataset_id": ["D1", "D1"], "donor_id": ["d1", "d2"]}),
+        "Sample": pd.DataFrame({"sample_id": ["s1", "s2", "s3"], "donor_id": ["d1", "d1", "d2"], "dataset_id": ["D1"] * 3})
+    }
+    assert plan_joins(tabs) == [("Sample", "sample_id"), ("Donor", "donor_id"), ("Dataset", "dataset_id")]
+    flat = flatten_tiered_spreadsheet(tabs)
+    assert flat.shape[0] == 3
+
+def test_flatten_raises_on_many_to_many():
+    tabs = {
+        "Sample": pd.DataFrame({"sample_id": ["s1", "s2"], "donor_id": ["d1", "d1"]}),
+        "Donor": pd.DataFrame({"donor_id": ["d1", "d1"], "age": [30, 40]})
+    }
+    with pytest.raises(ValueError, match="many-to-many"):
+        flatten_tiered_spreadsheet(tabs)
+
+def test_template_cached_copies(tmp_path):
+    template = tmp_path / "template.xlsx"
+    with pd.ExcelWriter(template) as writer:
+        pd.DataFrame([["x"]] * 3 + [["donor_organism.sex"], ["x"], ["female"]]).to_excel(
+            writer, sheet_name="Donor organism", header=False, index=False)
+    with patch("helper_files.convert.pd.read_excel", wraps=pd.read_excel) as mock_read:
+        first = get_dcp_template(str(template))
+        first["Donor organism"].loc[0, "donor_organism.sex"] = "male"
+        second = get_dcp_template(str(template))
+    assert mock_read.call_count == 1
+    assert second["Donor organism"].loc[0, "donor_organism.sex"] == "female"
+
+def compacted_pipeline(dcp_flat, compact):
+    tabs = ['Donor organism', 'Specimen from organism', 'Cell suspension', 'Analysis file',
+            'Library preparation protocol', 'Sequencing protocol', 'Collection protocol', 'Analysis protocol']
+    if compact:
+        dcp_flat = compact_categories(dcp_flat)
+    dcp_flat = fill_ontologies(dcp_flat)
+    dcp_flat = add_analysis_file(dcp_flat, 'label')
+    dcp_flat = create_protocol_ids({tab: None for tab in tabs}, dcp_flat)
+    template = {tab: pd.DataFrame(columns=[col for col in dcp_flat if col.startswith(tab_to_entity(tab) + '.')])
+                for tab in tabs}
+    return dcp_flat, populate_spreadsheet(template, dcp_flat.copy())
+
+
+def plain(df):
+    df = expand_categories(df.copy()).reset_index(drop=True)
+    return df.astype(object).where(df.notna(), None)
+
+
+def test_compact_dtypes_same_spreadsheet(mocker):
+    mocker.patch.object(convert, 'ols_labels', side_effect=lambda terms: {term: f'label of {term}' for term in terms})
+    mocker.patch.object(convert, 'get_xml_keys', return_value=())
+    mocker.patch.object(convert, 'fill_ontology_ids', side_effect=lambda term, *args, **kwargs: f'ID:{term}')
+    start_lookup_budget()
+    samples = pd.concat([sample_metadata()] * 20, ignore_index=True)
+    samples['library_id'] = [f'l{i}' for i in range(len(samples))]
+    samples['tissue_ontology_term_id'] = 'UBERON:0002048'
+    samples['sample_collection_method'] = 'biopsy'
+    dcp_flat = edit_all_sample_metadata(samples, {}).rename(columns=tier1_to_dcp)
+
+    expected_flat, expected = compacted_pipeline(dcp_flat.copy(), compact=False)
+    compact_flat, spreadsheet = compacted_pipeline(dcp_flat.copy(), compact=True)
+    assert len(compact_flat.select_dtypes('category').columns) > compact_flat.shape[1] / 2
+    pd.testing.assert_frame_equal(plain(compact_flat), plain(expected_flat))
+    for tab in expected:
+        assert len(spreadsheet[tab]), tab
+        pd.testing.assert_frame_equal(plain(spreadsheet[tab]), plain(expected[tab]))
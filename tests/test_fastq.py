@@ -0,0 +1,94 @@
+import gzip
+import hashlib
+
+import pandas as pd
+
+from helper_files import fastq
+from helper_files.fastq import (
+    file_checksums,
+    compute_checksums,
+    read_checksum_file,
+    find_fastqs,
+    add_checksums,
+    sniff_fastq,
+    add_fastq_headers
+)
+
+def write_fastq(path, content):
+    path.write_bytes(content)
+    return str(path)
+
+def test_file_checksums_small_buffer(tmp_path):
+    content = b"@read1\nACGT\n+\nIIII\n" * 100
+    path = write_fastq(tmp_path / "a_R1.fastq.gz", content)
+    checksums = file_checksums(path, buffer_size=7)
+    assert checksums["size"] == len(content)
+    assert checksums["md5"] == hashlib.md5(content).hexdigest()
+    assert checksums["sha256"] == hashlib.sha256(content).hexdigest()
+
+def test_compute_checksums_uses_cache(tmp_path, mocker):
+    path = write_fastq(tmp_path / "a_R1.fastq.gz", b"ACGT")
+    cache_path = str(tmp_path / "cache.json")
+    first = compute_checksums([path], cache_path=cache_path, max_workers=1)
+    spy = mocker.patch.object(fastq, "ProcessPoolExecutor")
+    second = compute_checksums([path], cache_path=cache_path)
+    spy.assert_not_called()
+    pd.testing.assert_frame_equal(first, second)
+
+def test_read_checksum_file(tmp_path):
+    md5 = hashlib.md5(b"ACGT").hexdigest()
+    path = tmp_path / "md5sums.txt"
+    path.write_text(f"{md5}  fastqs/a_R1.fastq.gz\n")
+    assert read_checksum_file(str(path)).to_dict(orient="records") == [
+        {"file_name": "a_R1.fastq.gz", "algorithm": "md5", "checksum": md5}]
+
+def test_add_checksums_flags_mismatch(tmp_path):
+    fastq_dir = tmp_path / "fastqs"
+    fastq_dir.mkdir()
+    write_fastq(fastq_dir / "a_R1.fastq.gz", b"ACGT")
+    write_fastq(fastq_dir / "a_R2.fastq.gz", b"TTTT")
+    provided = tmp_path / "md5sums.txt"
+    provided.write_text(f"{hashlib.md5(b'ACGT').hexdigest()}  a_R1.fastq.gz\n{hashlib.md5(b'AAAA').hexdigest()}  a_R2.fastq.gz\n")
+    seq_tab = pd.DataFrame({"sequence_file.file_core.file_name": ["a_R1.fastq.gz", "a_R2.fastq.gz", "b_R1.fastq.gz"]})
+    paths = find_fastqs(str(fastq_dir), seq_tab["sequence_file.file_core.file_name"])
+    seq_tab, computed = add_checksums(seq_tab, paths, str(provided), max_workers=1)
+    assert seq_tab["sequence_file.file_core.checksum"].tolist()[:2] == [
+        hashlib.sha256(b"ACGT").hexdigest(), hashlib.sha256(b"TTTT").hexdigest()]
+    assert pd.isna(seq_tab.loc[2, "sequence_file.file_core.checksum"])
+    assert computed.set_index("file_name")["mismatch"].to_dict() == {"a_R1.fastq.gz": False, "a_R2.fastq.gz": True}
+
+def write_gz_fastq(path, header, n_records, read_length=28):
+    with gzip.open(path, "wt") as f:
+        for i in range(n_records):
+            f.write(f"@{header.format(i=i)}\n{'A' * read_length}\n+\n{'I' * read_length}\n")
+    return str(path)
+
+def test_sniff_fastq_reads_only_first_records(tmp_path):
+    path = write_gz_fastq(tmp_path / "lib1_S1_L002_R2_001.fastq.gz",
+                          "A00123:8:HFWJ2DSXY:2:1101:{i}:1000 2:N:0:ACGT", 1000, read_length=91)
+    sniffed = sniff_fastq(path, n_records=10)
+    assert sniffed["n_records"] == 10
+    assert sniffed["read_index"] == "read2"
+    assert sniffed["lane_index"] == 2
+    assert sniffed["read_length"] == 91
+    assert (sniffed["instrument"], sniffed["run"], sniffed["flowcell"]) == ("A00123", "8", "HFWJ2DSXY")
+
+def test_sniff_fastq_header_only(tmp_path):
+    path = write_gz_fastq(tmp_path / "reads.fq.gz", "HWUSI-EAS100R:6:73:941:{i}#0/1", 5)
+    sniffed = sniff_fastq(path)
+    assert (sniffed["read_index"], sniffed["lane_index"], sniffed["instrument"]) == ("read1", 6, "HWUSI-EAS100R")
+
+def test_sniff_fastq_not_fastq(tmp_path):
+    path = tmp_path / "broken.fastq.gz"
+    path.write_bytes(b"not gzipped")
+    assert sniff_fastq(str(path))["error"]
+
+def test_add_fastq_headers_keeps_existing(tmp_path, capsys):
+    paths = {name: write_gz_fastq(tmp_path / name, "A00123:8:HFWJ2DSXY:1:1101:{i}:1000 1:N:0:ACGT", 3)
+             for name in ["lib1_S1_L001_R1_001.fastq.gz", "lib1_S1_L001_I1_001.fastq.gz"]}
+    seq_tab = pd.DataFrame({"sequence_file.file_core.file_name": list(paths),
+                            "sequence_file.read_index": ["read1", "read2"]})
+    seq_tab, sniffed = add_fastq_headers(seq_tab, paths, max_workers=1)
+    assert seq_tab["sequence_file.read_index"].tolist() == ["read1", "read2"]
+    assert seq_tab["sequence_file.lane_index"].tolist() == [1, 1]
+    assert "differs from fastq headers" in capsys.readouterr().out
@@ -1,7 +1,20 @@
+import re
+
 import pandas as pd
 import pytest
 from pathlib import Path
-from helper_files.utils import open_spreadsheet, drop_empty_cols, detect_excel_format, get_label
+from helper_files.utils import (
+    open_spreadsheet,
+    spreadsheet_tabs,
+    drop_empty_cols,
+    detect_excel_format,
+    get_label,
+    compact_categories,
+    expand_categories,
+    replace_values,
+    concat_categories,
+    memory_row
+)
 
 @pytest.mark.parametrize(
     "filename,expected",
@@ -43,6 +56,24 @@ def test_open_spreadsheet_multisheet(tmp_path):
     assert sheets['Donor'].shape == (2, 2)
     assert sheets['Sample'].shape == (1, 2)
 
+def test_open_spreadsheet_selected_tabs_and_columns(tmp_path):
+    file = tmp_path / "multi.xlsx"
+    with pd.ExcelWriter(file) as writer:
+        pd.DataFrame({'donor_id': ['donor_1'], 'age': [30]}).to_excel(writer, sheet_name="Donor", index=False)
+        pd.DataFrame({'sample_id': ['s1'], 'donor_id': ['donor_1'], 'tissue': ['lung']}).to_excel(writer, sheet_name="Sample", index=False)
+        pd.DataFrame({'project_title': ['title']}).to_excel(writer, sheet_name="Project", index=False)
+        pd.DataFrame().to_excel(writer, sheet_name="Empty", index=False)
+
+    assert spreadsheet_tabs(str(file)) == ["Donor", "Sample", "Project", "Empty"]
+    # the empty tab is never parsed, so it does not raise
+    sheets = open_spreadsheet(str(file), tabs=["Donor", re.compile("^Samp")],
+                              columns={"Sample": lambda col: col != "tissue"})
+    assert list(sheets) == ["Donor", "Sample"]
+    assert list(sheets["Sample"].columns) == ["sample_id", "donor_id"]
+    assert list(sheets["Donor"].columns) == ["donor_id", "age"]
+    with pytest.raises(ValueError):
+        open_spreadsheet(str(file))
+
 def test_drop_empty_cols_basic():
     df = pd.DataFrame({
         'Unnamed: 0': [1, 2],
@@ -102,3 +133,29 @@ def test_detect_excel_format_dcp_to_tier1(tmp_path):
     file_path = create_excel_for_format(tmp_path, "dcp_to_tier1.xlsx", rows)
     skiprows = detect_excel_format(file_path)
     assert skiprows is None
+
+def test_compact_and_expand_categories():
+    df = pd.DataFrame({'taxon': ['9606'] * 4, 'id': ['a', 'b', 'c', 'd'], 'n': [1, 2, 3, 4],
+                       'lists': [['x'], ['x'], ['x'], ['x']]})
+    compact = compact_categories(df.copy())
+    assert compact.dtypes.astype(str).to_dict() == {'taxon': 'category', 'id': 'str', 'n': 'int64', 'lists': 'object'}
+    pd.testing.assert_frame_equal(expand_categories(compact), df)
+
+def test_replace_values_categorical():
+    values = pd.Series(['PATO:1', 'PATO:2', None, 'PATO:1'], dtype='category')
+    replaced = replace_values(values, {'PATO:1': 'female', 'PATO:2': 'female'})
+    assert isinstance(replaced.dtype, pd.CategoricalDtype)
+    assert list(replaced.cat.categories) == ['female']
+    assert replaced.astype(object).where(replaced.notna(), None).tolist() == ['female', 'female', None, 'female']
+
+def test_concat_categories():
+    template = pd.DataFrame({'a': ['t']})
+    flat = pd.DataFrame({'a': pd.Categorical(['x', 'x'])})
+    merged = concat_categories([template, flat])
+    assert isinstance(merged['a'].dtype, pd.CategoricalDtype)
+    assert merged['a'].tolist() == ['t', 'x', 'x']
+
+def test_memory_row():
+    df = pd.DataFrame({'label': ['a long ontology label'] * 1000})
+    row = memory_row('stage', compact_categories(df))
+    assert row['rows'] == 1000 and row['MB'] < row['MB expanded'] and row['saving %'] > 50
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import anndata
+import h5py
+import pytest
+
+from helper_files.collect import extract_and_save_metadata, extract_and_save_metadata_chunked
+from helper_files.h5ad_obs import read_obs, iter_obs_chunks, obs_chunk_rows
+
+
+@pytest.fixture
+def h5ad_file(tmp_path):
+    n_cells = 500
+    rng = np.random.default_rng(0)
+    libraries = rng.integers(0, 7, n_cells)
+    # anndata 0.10 cannot write pandas str arrays
+    with pd.option_context("future.infer_string", False):
+        obs = pd.DataFrame({
+            "library_id": pd.Categorical.from_codes(libraries, [f"lib{i}" for i in range(8)]),
+            "donor_id": np.array([f"don{i // 3}" for i in libraries], dtype=object),
+            "sex_ontology_term_id": pd.Categorical.from_codes(np.where(libraries == 2, -1, libraries % 2),
+                                                              ["PATO:0000383", "PATO:0000384"]),
+            # varies within lib3
+            "tissue_type": np.array(["organoid" if lib == 3 and i % 2 else "tissue" for i, lib in enumerate(libraries)], dtype=object),
+            "cell_viability_percentage": np.where(libraries == 4, np.nan, libraries * 10.5),
+            "sample_collection_year": pd.array(np.where(libraries == 5, None, 2020 + libraries), dtype="Int64"),
+            "is_primary_data": libraries % 3 == 0,
+            "cell_type_ontology_term_id": pd.Categorical.from_codes(rng.integers(0, 3, n_cells), ["CL:1", "CL:2", "CL:3"]),
+        }, index=pd.Index(np.array([f"cell{i}" for i in range(n_cells)], dtype=object), name="barcode"))
+        path = tmp_path / "dataset.h5ad"
+        anndata.AnnData(obs=obs).write_h5ad(path)
+    return path
+
+
+def test_read_obs_matches_anndata(h5ad_file):
+    expected = anndata.read_h5ad(h5ad_file).obs
+    with h5py.File(h5ad_file) as h5ad:
+        pd.testing.assert_frame_equal(read_obs(h5ad), expected)
+        chunks = list(iter_obs_chunks(h5ad, 64))
+    assert len(chunks) == 8
+    pd.testing.assert_frame_equal(pd.concat(chunks), expected)
+
+
+def test_chunk_rows_follow_memory(h5ad_file):
+    with h5py.File(h5ad_file) as h5ad:
+        assert obs_chunk_rows(h5ad, 1) > obs_chunk_rows(h5ad, 0.1) >= 1
+
+
+@pytest.mark.parametrize("max_memory", [0.01, 1])
+def test_chunked_outputs_identical(h5ad_file, tmp_path, max_memory, capsys):
+    in_memory, chunked = tmp_path / "in_memory", tmp_path / "chunked"
+    in_memory.mkdir()
+    chunked.mkdir()
+    extract_and_save_metadata(anndata.read_h5ad(h5ad_file, backed="r"), "cid_ds1", str(in_memory))
+    columns = extract_and_save_metadata_chunked(h5ad_file, "cid_ds1", str(chunked), max_memory=max_memory)
+    assert "library_id" in columns
+    outputs = sorted(path.name for path in in_memory.iterdir())
+    assert outputs == ["cid_ds1_cell_obs.csv", "cid_ds1_inconsistent_fields.csv", "cid_ds1_metadata.csv"]
+    assert sorted(path.name for path in chunked.iterdir()) == outputs
+    for name in outputs:
+        assert (chunked / name).read_bytes() == (in_memory / name).read_bytes(), name
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+from helper_files import h5ad_store
+from helper_files.h5ad_store import H5adStore, fetch_dataset_h5ad, store_key
+
+
+def fake_download(url, path, quiet=False):
+    with open(path, "wb") as h5ad:
+        h5ad.write(b"0" * 4)
+
+
+@pytest.fixture
+def mock_download(mocker):
+    return mocker.patch.object(h5ad_store, "download_h5ad_file", side_effect=fake_download)
+
+
+def gb(n_bytes):
+    return n_bytes / 1024 ** 3
+
+
+def test_store_key():
+    assert store_key("cid", {"dataset_id": "ds1", "dataset_version_id": "v1"}) == "v1"
+    assert store_key("cid", {"dataset_id": "ds1"}) == "cid_ds1"
+
+
+def test_fetch_reuses_stored_version(mock_download, tmp_path):
+    store = H5adStore(str(tmp_path), budget_gb=gb(100))
+    collection = {"datasets": [{"dataset_id": "ds1", "dataset_version_id": "v1",
+                                "assets": [{"filetype": "H5AD", "url": "http://cxg/v1.h5ad", "filesize": 4}]}]}
+    assert fetch_dataset_h5ad(store, collection, "cid", "ds1") == ("v1", store.path("v1"))
+    assert fetch_dataset_h5ad(store, collection, "cid", "ds1") == ("v1", store.path("v1"))
+    mock_download.assert_called_once()
+    # index survives a new process
+    assert H5adStore(str(tmp_path)).has("v1", 4)
+    assert fetch_dataset_h5ad(store, {"datasets": []}, "cid", "ds1") == (None, None)
+
+
+def test_lru_eviction_skips_pinned(mock_download, tmp_path):
+    store = H5adStore(str(tmp_path), budget_gb=gb(8))
+    store.fetch("http://cxg/a", "a", 4)
+    store.fetch("http://cxg/b", "b", 4)
+    # a is used again, so b is the least recently used
+    store.fetch("http://cxg/a", "a", 4)
+    store.fetch("http://cxg/c", "c", 4)
+    assert sorted(store.entries) == ["a", "c"]
+    assert not os.path.exists(store.path("b"))
+    with store.pinned("a"), store.pinned("c"):
+        store.fetch("http://cxg/d", "d", 4)
+    assert sorted(store.entries) == ["a", "c", "d"]
+    store.fetch("http://cxg/e", "e", 4)
+    assert sorted(store.entries) == ["d", "e"]
+
+
+def test_adopt_legacy_download(mock_download, tmp_path):
+    store = H5adStore(str(tmp_path), budget_gb=gb(100))
+    legacy_path = os.path.join(str(tmp_path), "cid_ds1.h5ad")
+    fake_download(None, legacy_path)
+    assert store.missing_bytes("v1", 4, legacy_path) == 0
+    assert store.fetch("http://cxg/v1", "v1", 4, legacy_path=legacy_path) == store.path("v1")
+    mock_download.assert_not_called()
+    assert not os.path.exists(legacy_path)
@@ -1,3 +1,4 @@
+
 import pytest
 import pandas as pd
 import numpy as np
@@ -6,11 +7,15 @@ from helper_files.constants.tier2_mapping import TIER2_TO_DCP
 from helper_files.merge import (
     LAST_BIOMATERIAL,
     get_fastq_ext,
+    get_fastq_exts,
+    read_file_manifest,
+    merge_overlap_chunks,
     get_tab_value,
     get_protocol_id,
     map_key_to_id,
     get_files_per_library,
     check_10x_n_files,
+    check_10x_read_pairs,
     add_standard_fields,
     merge_file_manifest,
     tab_is_protocol,
@@ -18,7 +23,11 @@ from helper_files.merge import (
     flatten_tier2_spreadsheet,
     merge_overlap,
     merge_sheets,
-    merge_tier2_with_dcp
+    merge_tier2_with_dcp,
+    LUNG_DIGESTION,
+    LUNG_DIGESTION_TABLE,
+    split_lung_dissociation,
+    add_protocol_targets
 )
 
 @pytest.fixture
@@ -177,6 +186,56 @@ def test_check_10x_n_files_fail():
         check_10x_n_files(wrangled)
 
 
+def test_check_10x_read_pairs():
+    wrangled = {
+        "Library preparation protocol": pd.DataFrame({
+            "library_preparation_protocol.library_construction_method.text": ["10x v2"],
+            "library_preparation_protocol.protocol_core.protocol_id": ["LP1"]
+        }),
+        "Sequence file": pd.DataFrame({
+            LAST_BIOMATERIAL: ["Bio1", "Bio1"],
+            "sequence_file.file_core.file_name": ["r1", "r2"],
+            "library_preparation_protocol.protocol_core.protocol_id": ["LP1", "LP1"]
+        })
+    }
+    sniffed = pd.DataFrame({"file_name": ["r1", "r2"], "read_index": ["read1", "read2"],
+                            "lane_index": [1, 1], "first_read": ["@A:1", "@A:1"]})
+    check_10x_read_pairs(wrangled, sniffed)
+    sniffed["first_read"] = ["@A:1", "@B:1"]
+    with pytest.raises(ValueError, match="not paired"):
+        check_10x_read_pairs(wrangled, sniffed)
+    sniffed["read_index"] = ["read1", "index1"]
+    with pytest.raises(ValueError, match="read1 and read2"):
+        check_10x_read_pairs(wrangled, sniffed)
+
+
+def test_check_10x_read_pairs_several_runs():
+    files = ["S1_L001_R1_001.fastq.gz", "S1_L001_R2_001.fastq.gz", "S1b_L001_R1_001.fastq.gz", "S1b_L001_R2_001.fastq.gz"]
+    wrangled = {
+        "Library preparation protocol": pd.DataFrame({
+            "library_preparation_protocol.library_construction_method.text": ["10x v3"],
+            "library_preparation_protocol.protocol_core.protocol_id": ["LP1"]
+        }),
+        "Sequence file": pd.DataFrame({
+            LAST_BIOMATERIAL: ["Bio1"] * 4,
+            "sequence_file.file_core.file_name": files,
+            "library_preparation_protocol.protocol_core.protocol_id": ["LP1"] * 4
+        })
+    }
+    # two runs of the same library and lane, each pair starting with its own read
+    sniffed = pd.DataFrame({"file_name": files, "read_index": ["read1", "read2"] * 2, "lane_index": [1] * 4,
+                            "run": [1, 1, 2, 2], "flowcell": ["FC1", "FC1", "FC2", "FC2"],
+                            "first_read": ["@A:1", "@A:1", "@B:1", "@B:1"]})
+    check_10x_read_pairs(wrangled, sniffed)
+    # same run and flowcell, paired by file stem
+    check_10x_read_pairs(wrangled, sniffed.assign(run=1, flowcell="FC1"))
+    sniffed.loc[3, "first_read"] = "@C:1"
+    with pytest.raises(ValueError, match="not paired"):
+        check_10x_read_pairs(wrangled, sniffed)
+    with pytest.raises(ValueError, match="read1 and read2"):
+        check_10x_read_pairs(wrangled, sniffed.drop(index=3))
+
+
 ### TEST MERGE TIER 2
 
 
@@ -364,3 +423,97 @@ def test_flatten_rename_and_merge():
     assert merged_df['Specimen from organism'].loc[0, "specimen_from_organism.biomaterial_core.biomaterial_id"] == "sample_1"
     assert merged_df['Donor organism'].loc[0, "donor_organism.ncbi_taxon_id"] == 9606
     
+
+def test_split_lung_dissociation_matches_rowwise_at_scale():
+    rng = np.random.default_rng(0)
+    protocols = list(LUNG_DIGESTION) + [np.nan]
+    tier2_df = pd.DataFrame({
+        "sample_id": [f"s{i}" for i in range(20000)],
+        "protocol_tissue_dissociation": rng.choice(np.array(protocols, dtype=object), 20000),
+        "protocol_tissue_dissociation_free_text": np.nan
+    })
+    # row-wise reference
+    fields = set().union(*[LUNG_DIGESTION[prot] for prot in tier2_df["protocol_tissue_dissociation"].dropna().unique()])
+    expected = tier2_df.copy()
+    for field in fields:
+        expected[field] = [LUNG_DIGESTION[prot].get(field, np.nan) if isinstance(prot, str) else np.nan
+                           for prot in tier2_df["protocol_tissue_dissociation"]]
+    del expected["protocol_tissue_dissociation"]
+
+    result = split_lung_dissociation(tier2_df, LUNG_DIGESTION_TABLE)
+    assert set(result.columns) == set(expected.columns)
+    pd.testing.assert_frame_equal(result[expected.columns], expected, check_dtype=False)
+
+def test_split_lung_dissociation_unknown_protocol():
+    tier2_df = pd.DataFrame({"protocol_tissue_dissociation": ["unknown"],
+                             "protocol_tissue_dissociation_free_text": [np.nan]})
+    with pytest.raises(ValueError):
+        split_lung_dissociation(tier2_df, LUNG_DIGESTION)
+
+def test_add_protocol_targets_at_scale():
+    n = 20000
+    sample = "specimen_from_organism.biomaterial_core.biomaterial_id"
+    prot = "dissociation_protocol.protocol_core.protocol_id"
+    tier2_df = pd.DataFrame({sample: [f"s{i}" for i in range(n)],
+                             prot: [f"diss_{i % 3}" for i in range(n)]})
+    wrangled = {"Cell suspension": pd.DataFrame({sample: [f"s{n - 1 - i}" for i in range(n)],
+                                                 prot: [f"enz_{i % 2}" for i in range(n)]})}
+    result = add_protocol_targets(tier2_df, wrangled)["Cell suspension"]
+    expected = [f"diss_{(n - 1 - i) % 3}||enz_{i % 2}" for i in range(n)]
+    assert result[prot].tolist() == expected
+
+def test_add_protocol_targets_missing_sample():
+    sample = "specimen_from_organism.biomaterial_core.biomaterial_id"
+    prot = "dissociation_protocol.protocol_core.protocol_id"
+    tier2_df = pd.DataFrame({sample: ["s1"], prot: ["diss_1"]})
+    wrangled = {"Cell suspension": pd.DataFrame({sample: ["s2"], prot: ["enz_1"]})}
+    with pytest.raises(KeyError):
+        add_protocol_targets(tier2_df, wrangled)
+
+def test_get_fastq_exts_matches_get_fastq_ext():
+    names = pd.Series(["a.fastq.gz", "b.fastq", "c.fq.gz", "d.fq"] * 1000)
+    assert get_fastq_exts(names).tolist() == [get_fastq_ext(name) for name in names]
+    with pytest.raises(KeyError):
+        get_fastq_exts(pd.Series(["a.fastq.gz", "base_pairs.csv"]))
+
+def test_read_file_manifest_in_chunks(tmp_path):
+    path = tmp_path / "file_manifest.tsv"
+    pd.DataFrame({"file_name": [f"lib{i}_R1.fastq.gz" for i in range(5)],
+                  "library_ID": ["l1", "l1", "l2", "l2", "l3"],
+                  "lane_index": [1, 2, 1, 2, 1],
+                  "md5": ["x"] * 5}).to_csv(path, sep="\t", index=False)
+    chunks = list(read_file_manifest(str(path), columns=["file_name", "library_ID", "lane_index"], chunksize=2))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert "md5" not in chunks[0]
+    assert chunks[0]["library_ID"].dtype == "category"
+    assert chunks[0]["lane_index"].tolist() == [1, 2]
+
+
+def test_read_file_manifest_text_lanes(tmp_path):
+    path = tmp_path / "file_manifest.csv"
+    pd.DataFrame({"file_name": ["a_R1.fastq.gz", "b_R1.fastq.gz", "c_R1.fastq.gz", "d_R1.fastq.gz"],
+                  "lane_index": ["1", "2", "L001", "1,2"]}).to_csv(path, index=False)
+    first, second = read_file_manifest(str(path), columns=["file_name", "lane_index"], chunksize=2)
+    assert first["lane_index"].dtype == "Int16"
+    assert second["lane_index"].tolist() == ["L001", "1,2"]
+
+def test_merge_overlap_chunks_matches_merge_overlap(wrangled_spreadsheet, std_dcp_keys):
+    key = std_dcp_keys["file_name"]
+    manifest = pd.DataFrame({key: ["l2.fastq.gz", "l3.fastq.gz", "l1.fastq.gz"],
+                             "sequence_file.read_index": ["read1", "read2", "index1"]})
+    seq_tab = wrangled_spreadsheet["Sequence file"]
+    expected = merge_overlap(seq_tab, manifest, list(manifest.columns), key=key, suffix="fm")
+    result = merge_overlap_chunks(seq_tab, [manifest.iloc[:2], manifest.iloc[2:]], key=key)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_merge_overlap_chunks_repeated_keys(wrangled_spreadsheet, std_dcp_keys):
+    key = std_dcp_keys["file_name"]
+    # l1 is listed again in a later chunk, with another read index and as an exact repeat
+    manifest = pd.DataFrame({key: ["l1.fastq.gz", "l2.fastq.gz", "l1.fastq.gz", "l1.fastq.gz"],
+                             "sequence_file.read_index": ["read1", "read2", "read1", "index1"]})
+    seq_tab = wrangled_spreadsheet["Sequence file"]
+    expected = merge_overlap(seq_tab, manifest, list(manifest.columns), key=key, suffix="fm")
+    result = merge_overlap_chunks(seq_tab, [manifest.iloc[:2], manifest.iloc[2:]], key=key)
+    pd.testing.assert_frame_equal(result.sort_values([key, "sequence_file.read_index"], ignore_index=True),
+                                  expected.sort_values([key, "sequence_file.read_index"], ignore_index=True), check_dtype=False)
@@ -195,3 +195,25 @@ def test_flatten_rename_and_merge():
     assert merged_df['Specimen from organism'].loc[0, "specimen_from_organism.biomaterial_core.biomaterial_id"] == "sample_1"
     assert merged_df['Donor organism'].loc[0, "donor_organism.ncbi_taxon_id"] == 9606
     
+
+
+def test_main_exports_needs_label(tmp_path, mocker):
+    import merge_tier2_metadata
+    from helper_files import ontology
+    stale = ontology.start_lookup_budget(deadline=0)
+    stale.degraded = True
+
+    def fill_ontologies(tier2_flat, matcher=None):
+        budget = ontology.get_budget()
+        assert budget is not stale and not budget.degraded
+        budget.needs_label.add("UBERON:0002048")
+        return tier2_flat
+
+    for name in ["open_spreadsheet", "flatten_tiered_spreadsheet", "manual_fixes", "rename_tier2_columns",
+                 "add_protocol_targets", "check_dcp_required_fields", "check_enum_values"]:
+        mocker.patch.object(merge_tier2_metadata, name)
+    mocker.patch.object(merge_tier2_metadata, "fill_ontologies", side_effect=fill_ontologies)
+    mocker.patch.object(merge_tier2_metadata, "add_protocol_targets", return_value={"Project": pd.DataFrame({"a": [1]})})
+    merge_tier2_metadata.main("tier2.xlsx", "cid_ds1_dcp.xlsx", output_dir=str(tmp_path))
+    assert ontology.read_needs_label(tmp_path / "cid_ds1_dcp_Tier2_needs_label.csv") == {"UBERON:0002048"}
+    ontology.start_lookup_budget()
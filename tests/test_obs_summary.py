@@ -0,0 +1,70 @@
+
+import numpy as np
+import pandas as pd
+
+from helper_files.obs_summary import summarize_obs, save_obs_summary, CELL_COUNT
+
+
+def cell_obs():
+    return pd.DataFrame({
+        "library_id": pd.Categorical(["lib1", "lib1", "lib2", "lib2", "lib2", "lib3"]),
+        "donor_id": ["don1", "don1", "don2", "don2", "don2", "don2"],
+        "sex_ontology_term_id": pd.Categorical(["PATO:0000383", "PATO:0000383", "PATO:0000384", np.nan, "PATO:0000384", "PATO:0000384"]),
+        "tissue_type": ["tissue", "tissue", "tissue", "tissue", "organoid", "tissue"],
+        "cell_type_ontology_term_id": ["CL:1", "CL:2", "CL:1", "CL:1", "CL:3", "CL:2"],
+    })
+
+
+def test_summarize_obs_matches_drop_duplicates():
+    obs = cell_obs()
+    tier1_cols = ["library_id", "donor_id", "sex_ontology_term_id", "tissue_type"]
+    rows, cell_count, nunique = summarize_obs(obs)
+    pd.testing.assert_frame_equal(rows, obs[tier1_cols].drop_duplicates())
+    assert cell_count.to_dict() == {"lib1": 2, "lib2": 3, "lib3": 1}
+    assert nunique.loc["lib2"].to_dict() == {"donor_id": 1, "sex_ontology_term_id": 2, "tissue_type": 2}
+    assert (nunique.loc[["lib1", "lib3"]] == 1).all().all()
+
+
+def test_save_obs_summary(tmp_path):
+    metadata, report = save_obs_summary(cell_obs(), "cid_ds1", str(tmp_path))
+    saved = pd.read_csv(tmp_path / "cid_ds1_metadata.csv", index_col="library_id")
+    assert saved[CELL_COUNT].to_dict() == {"lib1": 2, "lib2": 3, "lib3": 1}
+    assert report[["library_id", "field", "n_values"]].values.tolist() == \
+        [["lib2", "sex_ontology_term_id", 2], ["lib2", "tissue_type", 2]]
+    assert report.loc[report["field"] == "tissue_type", "values"].item() == "tissue||organoid"
+    assert (tmp_path / "cid_ds1_inconsistent_fields.csv").exists()
+
+    # a consistent dataset removes the stale report
+    consistent = cell_obs().iloc[[0, 1, 5]]
+    _, report = save_obs_summary(consistent, "cid_ds1", str(tmp_path))
+    assert report.empty
+    assert not (tmp_path / "cid_ds1_inconsistent_fields.csv").exists()
+
+
+def test_cell_number_loaded_kept(tmp_path):
+    obs = cell_obs().assign(cell_number_loaded=5000)
+    metadata, _ = save_obs_summary(obs, "cid_ds1", str(tmp_path))
+    assert CELL_COUNT not in metadata
+    assert (metadata["cell_number_loaded"] == 5000).all()
+
+
+def test_donor_index_without_library(tmp_path):
+    metadata, _ = save_obs_summary(cell_obs().drop(columns="library_id"), "cid_ds1", str(tmp_path))
+    assert metadata.index.name == "donor_id"
+    assert CELL_COUNT not in metadata
+
+
+def test_summarize_large_obs():
+    n_cells = 2_000_000
+    rng = np.random.default_rng(0)
+    libraries = rng.integers(0, 400, n_cells)
+    obs = pd.DataFrame({
+        "library_id": pd.Categorical.from_codes(libraries, [f"lib{i}" for i in range(400)]),
+        "donor_id": pd.Categorical.from_codes(libraries // 4, [f"don{i}" for i in range(100)]),
+        "tissue_type": pd.Categorical.from_codes(np.zeros(n_cells, dtype=int), ["tissue"]),
+        "suspension_type": np.where(libraries % 2, "cell", "nucleus"),
+    })
+    rows, cell_count, nunique = summarize_obs(obs)
+    assert len(rows) == 400
+    assert cell_count.sum() == n_cells
+    assert (nunique == 1).all().all()
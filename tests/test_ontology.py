@@ -0,0 +1,207 @@
+import re
+import threading
+from unittest.mock import patch, MagicMock
+
+import pandas as pd
+import requests
+
+from helper_files.ontology import (
+    LookupBudget,
+    start_lookup_budget,
+    get_budget,
+    export_needs_label,
+    read_needs_label,
+    label_columns,
+    fetch_terms,
+    search_terms,
+    ols_labels,
+    TermMatcher,
+    read_ontology_dump,
+    build_matcher
+)
+from helper_files import ontology
+from helper_files.convert import ols_label, fill_ontology_ids
+
+@patch("helper_files.ontology.requests.get", side_effect=requests.exceptions.Timeout("slow"))
+def test_budget_trips_after_failures(mock_get):
+    budget = LookupBudget(max_failures=2)
+    assert budget.get("http://ols") is None
+    assert not budget.degraded
+    assert budget.get("http://ols") is None
+    assert budget.degraded
+    # no more requests once degraded
+    assert budget.get("http://ols") is None
+    assert mock_get.call_count == 2
+
+@patch("helper_files.ontology.requests.get")
+def test_budget_deadline(mock_get):
+    budget = LookupBudget(deadline=0)
+    assert budget.get("http://ols") is None
+    assert budget.degraded
+    mock_get.assert_not_called()
+
+@patch("helper_files.ontology.requests.get")
+def test_budget_timeout_bounded_by_deadline(mock_get):
+    mock_get.return_value.json.return_value = {"label": "lung"}
+    budget = LookupBudget(deadline=5, timeout=100)
+    assert budget.get("http://ols") == {"label": "lung"}
+    assert mock_get.call_args.kwargs["timeout"] <= 5
+
+def test_degraded_ols_label_keeps_id(tmp_path):
+    budget = start_lookup_budget()
+    budget.degraded = True
+    assert ols_label("UBERON_0002048") == "UBERON:0002048"
+    assert get_budget().needs_label == {"UBERON:0002048"}
+    path = export_needs_label(str(tmp_path), "label")
+    assert read_needs_label(path) == {"UBERON:0002048"}
+    start_lookup_budget()
+
+def test_label_columns():
+    tab = pd.DataFrame(columns=["donor_organism.sex",
+                                "donor_organism.diseases.text",
+                                "donor_organism.diseases.ontology",
+                                "donor_organism.diseases.ontology_label",
+                                "specimen_from_organism.organ_parts.text"])
+    assert label_columns(tab) == ["donor_organism.diseases.text", "donor_organism.diseases.ontology_label"]
+
+def ols_response(url, params=None, **kwargs):
+    """Mocked OLS: the search returns the queried IDs found in the ontology plus an unrelated term,
+    rows at a time; the term endpoint labels IDs by their number. PATO:0000384 is unknown to both."""
+    response = MagicMock()
+    if url == ontology.OLS_SEARCH:
+        ids = re.findall(r'"([^"]+)"', params["q"])
+        docs = [{"obo_id": id, "label": f"label {id.split(':')[1]}"} for id in ids if id != "PATO:0000384"]
+        docs.append({"obo_id": f"{params['ontology'].upper()}:9999999", "label": "unrelated"})
+        page = docs[params["start"]:params["start"] + params["rows"]]
+        response.json.return_value = {"response": {"numFound": len(docs), "docs": page}}
+        return response
+    term = url.split("%252F")[-1]
+    if term == "PATO_0000384":
+        response.raise_for_status.side_effect = requests.exceptions.HTTPError(response=MagicMock(status_code=404))
+    response.json.return_value = {"obo_id": term.replace("_", ":"), "label": f"label {term.split('_')[1]}"}
+    return response
+
+@patch("helper_files.ontology.requests.get", side_effect=ols_response)
+def test_fetch_terms_batched_per_ontology(mock_get):
+    start_lookup_budget()
+    terms = fetch_terms(["UBERON:0002048", "UBERON:0002107", "UBERON:0000955", "EFO:0009922",
+                         "PATO:0000384", "UBERON:0002048"], chunk_size=2)
+    assert {term: doc["label"] for term, doc in terms.items()} == {
+        "UBERON:0002048": "label 0002048", "UBERON:0002107": "label 0002107",
+        "UBERON:0000955": "label 0000955", "EFO:0009922": "label 0009922"}
+    searches = [call.kwargs["params"] for call in mock_get.call_args_list if call.args[0] == ontology.OLS_SEARCH]
+    assert [(params["ontology"], params["q"]) for params in searches] == [
+        ("uberon", '"UBERON:0002048" OR "UBERON:0002107"'),
+        ("uberon", '"UBERON:0000955"'),
+        ("efo", '"EFO:0009922"'),
+        ("pato", '"PATO:0000384"')]
+    # only the ID the search did not find is looked up on its own
+    assert [call.args[0] for call in mock_get.call_args_list if call.args[0] != ontology.OLS_SEARCH] == [
+        "https://www.ebi.ac.uk/ols4/api/ontologies/pato/terms/http%253A%252F%252Fpurl.obolibrary.org%252Fobo%252FPATO_0000384"]
+
+@patch("helper_files.ontology.requests.get", side_effect=ols_response)
+def test_search_terms_follows_pages(mock_get):
+    start_lookup_budget()
+    ids = ["CL:0000001", "CL:0000002", "CL:0000003"]
+    # the unrelated term comes last, so the search stops once all IDs are found
+    assert list(search_terms("cl", ids, chunk_size=2)) == ids
+    assert [call.kwargs["params"]["start"] for call in mock_get.call_args_list] == [0, 2]
+
+@patch("helper_files.ontology.requests.get", side_effect=ols_response)
+def test_ols_labels_cached(mock_get):
+    start_lookup_budget()
+    ontology._LABEL_CACHE.clear()
+    labels = ols_labels(["PATO_0000383", "PATO:0000384", "unknown"])
+    assert labels == {"PATO_0000383": "label 0000383", "PATO:0000384": "PATO:0000384", "unknown": "unknown"}
+    # one search for both PATO IDs and a single lookup of the one it did not find
+    assert mock_get.call_count == 2
+    # cached labels are not requested again
+    assert ols_labels(["PATO:0000383"]) == {"PATO:0000383": "label 0000383"}
+    assert mock_get.call_count == 2
+
+@patch("helper_files.ontology.requests.get", side_effect=requests.exceptions.ConnectionError("down"))
+def test_fetch_terms_failures_need_label(mock_get):
+    budget = start_lookup_budget(max_failures=10)
+    assert fetch_terms(["UBERON:0002048", "CL:0000236"]) == {}
+    assert budget.needs_label == {"UBERON:0002048", "CL:0000236"}
+    start_lookup_budget()
+
+def test_budget_per_thread():
+    main_budget = start_lookup_budget(deadline=100)
+    thread_budgets = []
+    def run():
+        thread_budgets.append(start_lookup_budget(deadline=5))
+        thread_budgets.append(get_budget())
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    assert thread_budgets[0] is thread_budgets[1]
+    assert thread_budgets[0].deadline == 5
+    # a job in another thread does not replace the budget of the main run
+    assert get_budget() is main_budget
+    start_lookup_budget()
+
+
+OBO = """format-version: 1.2
+ontology: uberon
+
+[Term]
+id: UBERON:0002048
+name: lung
+synonym: "pulmo" EXACT []
+
+[Term]
+id: UBERON:0002113
+name: kidney
+synonym: "nephros" RELATED []
+
+[Term]
+id: UBERON:0000001
+name: lung lobe
+is_obsolete: true
+
+[Typedef]
+id: part_of
+name: part of
+"""
+
+
+def test_read_ontology_dump(tmp_path):
+    (tmp_path / "uberon.obo").write_text(OBO)
+    assert read_ontology_dump(str(tmp_path / "uberon.obo")) == [
+        ("UBERON:0002048", "lung", ["pulmo"], "uberon"), ("UBERON:0002113", "kidney", ["nephros"], "uberon")]
+    pd.DataFrame({"obo_id": ["CL:0000236"], "label": ["B cell"], "synonyms": ["B lymphocyte||B-cell"]}).to_csv(tmp_path / "cl.csv", index=False)
+    assert read_ontology_dump(str(tmp_path / "cl.csv")) == [("CL:0000236", "B cell", ["B lymphocyte", "B-cell"], None)]
+
+
+def test_term_matcher_ranked_and_restricted():
+    matcher = TermMatcher([
+        ("CL:0000236", "B cell", ["B lymphocyte"], None),
+        ("CL:0000084", "T cell", ["T lymphocyte", "T-cell"], None),
+        ("EFO:0000001", "B cell", [], "efo"),
+        ("UBERON:0002048", "lung", [], None)])
+    assert matcher.match("t-Cell")[0] == ("CL:0000084", "T cell", 1.0)
+    # ties are ranked by ID
+    assert [obo_id for obo_id, _, _ in matcher.match("B cell")] == ["CL:0000236", "EFO:0000001"]
+    assert [obo_id for obo_id, _, _ in matcher.match("B cell", ontologies=["efo"])] == ["EFO:0000001"]
+    assert matcher.match("b lymphocytes", ontologies=["cl"])[0][0] == "CL:0000236"
+    assert matcher.match("kidney") == []
+
+
+def test_term_matcher_exact_hit_in_other_ontology():
+    matcher = TermMatcher([("UBERON:1", "lung", [], "uberon"), ("EFO:2", "lungs", [], "efo")])
+    assert matcher.match("lung", ["efo"]) == [("EFO:2", "lungs", 0.667)]
+    assert matcher.match("lung", ["uberon"]) == [("UBERON:1", "lung", 1.0)]
+
+
+def test_fill_ontology_ids_local(tmp_path, mocker):
+    (tmp_path / "uberon.obo").write_text(OBO)
+    mocker.patch("helper_files.convert.get_ontology_restriction", return_value=["uberon"])
+    search = mocker.patch.object(ontology.LookupBudget, "get")
+    mocker.patch.dict(ontology._LABEL_CACHE, {"CL:0000236": "B cell"})
+    matcher = build_matcher([str(tmp_path / "uberon.obo")])
+    assert fill_ontology_ids("Pulmo", "specimen_from_organism.organ.text", (), matcher=matcher) == "UBERON:0002048"
+    assert fill_ontology_ids("B cell", "specimen_from_organism.organ.text", (), matcher=matcher) is None
+    # resolved labels are indexed too
+    assert matcher.match("B cell")[0][0] == "CL:0000236"
+    search.assert_not_called()
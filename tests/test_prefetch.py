@@ -0,0 +1,99 @@
+import threading
+
+import pandas as pd
+import pytest
+
+from helper_files import prefetch, h5ad_store
+from helper_files.h5ad_store import H5adStore
+from helper_files.prefetch import DiskBudget, prefetch_dataset, prefetch_rows
+
+
+def collection(dataset_ids):
+    return {"datasets": [{"dataset_id": ds, "dataset_version_id": f"v_{ds}",
+                          "assets": [{"filetype": "H5AD", "url": f"http://cxg/{ds}.h5ad", "filesize": 10}]}
+                         for ds in dataset_ids]}
+
+
+def fake_download(url, path, quiet=False):
+    with open(path, "wb") as h5ad:
+        h5ad.write(b"0" * 10)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return H5adStore(str(tmp_path), budget_gb=1)
+
+
+@pytest.fixture
+def mock_fetch(mocker):
+    mocker.patch.object(prefetch, "get_collection_data", side_effect=lambda cid: collection([f"{cid}_ds"]))
+    return mocker.patch.object(h5ad_store, "download_h5ad_file", side_effect=fake_download)
+
+
+def input_rows(n):
+    return pd.DataFrame({"collection_id": [f"c{i}" for i in range(n)],
+                         "dataset_id": [f"c{i}_ds" for i in range(n)]}).iterrows()
+
+
+def test_prefetch_dataset_single_dataset(mock_fetch, store):
+    budget = DiskBudget(100)
+    prefetched = prefetch_dataset("c0", float("nan"), budget, 0, store)
+    assert prefetched["dataset_id"] == "c0_ds"
+    assert prefetched["reserved"] == 10
+    assert budget.reserved == 10 and budget.turn == 1
+    mock_fetch.assert_called_once_with("http://cxg/c0_ds.h5ad", store.path("v_c0_ds"), quiet=True)
+    # pinned until converted
+    assert store.pins["v_c0_ds"] == 1
+    # stored H5ADs take no budget
+    assert prefetch_dataset("c0", "c0_ds", budget, 1, store)["reserved"] == 0
+
+
+def test_prefetch_dataset_failure_advances_turn(mocker, store):
+    mocker.patch.object(prefetch, "get_collection_data", side_effect=ValueError("offline"))
+    budget = DiskBudget(100)
+    with pytest.raises(ValueError):
+        prefetch_dataset("c0", "ds", budget, 0, store)
+    assert budget.turn == 1 and budget.reserved == 0
+
+
+def test_prefetch_rows_in_order_and_bounded(mock_fetch, store):
+    seen = []
+    for index, row, prefetched in prefetch_rows(input_rows(5), depth=2, store=store):
+        seen.append(index)
+        assert prefetched["dataset_id"] == row["dataset_id"]
+        # current dataset plus at most two ahead
+        assert mock_fetch.call_count <= index + 3
+    assert seen == [0, 1, 2, 3, 4]
+    assert mock_fetch.call_count == 5
+    assert not store.pins
+
+
+def test_prefetch_rows_disk_budget(mock_fetch, store):
+    # budget fits a single file: the next download waits until the current dataset is converted
+    downloaded = []
+    def download(url, path, quiet):
+        downloaded.append(path)
+        fake_download(url, path)
+    mock_fetch.side_effect = download
+    for index, _, prefetched in prefetch_rows(input_rows(3), depth=2, disk_budget_gb=15 / 1024 ** 3, store=store):
+        assert len(downloaded) == index + 1
+        assert prefetched["reserved"] == 10
+        threading.Event().wait(0.05)
+        assert len(downloaded) == index + 1
+
+
+def test_prefetch_rows_failure_falls_back(mocker, capsys, store):
+    mocker.patch.object(prefetch, "get_collection_data", side_effect=ValueError("offline"))
+    results = [prefetched for _, _, prefetched in prefetch_rows(input_rows(2), depth=1, store=store)]
+    assert results == [None, None]
+    assert "Collecting in the foreground" in capsys.readouterr().out
+
+
+def test_prefetch_rows_disabled(mock_fetch, store):
+    assert [prefetched for _, _, prefetched in prefetch_rows(input_rows(2), depth=0, store=store)] == [None, None]
+    mock_fetch.assert_not_called()
+
+
+def test_prefetch_rows_stop_early(mock_fetch, store):
+    for _ in prefetch_rows(input_rows(5), depth=2, disk_budget_gb=15 / 1024 ** 3, store=store):
+        break
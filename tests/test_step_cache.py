@@ -0,0 +1,115 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from helper_files import convert
+from helper_files.convert import EDIT_STEPS, edit_all_sample_metadata
+from helper_files.ontology import start_lookup_budget, get_budget
+from helper_files.step_cache import step_key, step_outputs, apply_outputs, run_cached_step
+
+
+def sample_metadata():
+    return pd.DataFrame({
+        'sample_id': ['s1', 's2', 's3'],
+        'organism_ontology_term_id': ['NCBITaxon:9606'] * 3,
+        'tissue_type': ['tissue', 'organoid', 'tissue'],
+        'sex_ontology_term_id': ['PATO:0000383', 'PATO:0000384', np.nan],
+        'self_reported_ethnicity_ontology_term_id': ['unknown', 'HANCESTRO:0005', 'unknown'],
+        'sample_source': ['organ_donor', 'surgical donor', 'postmortem donor'],
+        'manner_of_death': ['1', 'not applicable', 'unknown'],
+        'sampled_site_condition': ['healthy', 'adjacent', 'diseased'],
+        'disease_ontology_term_id': ['PATO:0000461', 'MONDO:0000001', 'MONDO:0000002'],
+        'alignment_software': ['cellranger 7.0.1', 'STARsolo', 'cellranger 6.1'],
+        'assay_ontology_term_id': ['EFO:0009899'] * 3,
+        'suspension_type': ['cell', 'nucleus', 'cell'],
+        'development_stage_ontology_term_id': ['HsapDv:0000264', 'HsapDv:0000268', 'unknown'],
+    })
+
+
+@pytest.fixture
+def mock_ols(mocker):
+    labels = {'PATO:0000383': 'female', 'PATO:0000384': 'male'}
+    age_ranges = {'HsapDv:0000264': '0-14 year', 'HsapDv:0000268': '15-19 year'}
+    mocker.patch.object(convert, 'dev_label', side_effect=lambda term: age_ranges.get(term, term))
+    return mocker.patch.object(convert, 'ols_labels', side_effect=lambda terms: {term: labels.get(term, term) for term in terms})
+
+
+def run_serially(df):
+    for step, spec in EDIT_STEPS.items():
+        kwargs = {'collection_dict': {}} if step == 'edit_collection_method' else {}
+        df = spec['function'](df, **kwargs)
+    return df
+
+
+def test_cached_steps_match_serial_run(mock_ols, tmp_path):
+    start_lookup_budget()
+    expected = run_serially(sample_metadata())
+    pd.testing.assert_frame_equal(edit_all_sample_metadata(sample_metadata(), {}), expected)
+    pd.testing.assert_frame_equal(edit_all_sample_metadata(sample_metadata(), {}, cache_dir=str(tmp_path)), expected)
+    calls = mock_ols.call_count
+    pd.testing.assert_frame_equal(edit_all_sample_metadata(sample_metadata(), {}, cache_dir=str(tmp_path)), expected)
+    # ontology lookups of edit_sex were reused
+    assert mock_ols.call_count == calls
+
+
+def test_only_changed_steps_rerun(mock_ols, tmp_path, mocker):
+    start_lookup_budget()
+    edit_all_sample_metadata(sample_metadata(), {}, cache_dir=str(tmp_path))
+    n_cached = {step: len(os.listdir(tmp_path / step)) for step in os.listdir(tmp_path)}
+    edited = sample_metadata()
+    edited.loc[2, 'sex_ontology_term_id'] = 'PATO:0000383'
+    result = edit_all_sample_metadata(edited, {}, cache_dir=str(tmp_path))
+    assert result.loc[2, 'donor_organism.sex'] == 'female'
+    assert {step: len(os.listdir(tmp_path / step)) for step in os.listdir(tmp_path)} == \
+        {step: n + (step == 'edit_sex') for step, n in n_cached.items()}
+
+
+def test_declared_outputs(mock_ols):
+    start_lookup_budget()
+    df = sample_metadata()
+    for step, spec in EDIT_STEPS.items():
+        if spec['outputs'] is None or not spec.get('cache', True):
+            continue
+        inputs = df[[col for col in spec['inputs'] if col in df]]
+        outputs = step_outputs(inputs, spec['function'](inputs.copy()))
+        assert set(outputs['columns']) | set(outputs['deleted']) <= set(spec['outputs']), step
+        df = apply_outputs(df, outputs)
+
+
+def test_step_key_values_and_types():
+    df = pd.DataFrame({'a': ['1', '2']})
+    assert step_key('s', 'code', df) == step_key('s', 'code', df.copy())
+    assert step_key('s', 'code', df) != step_key('s', 'code', pd.DataFrame({'a': [1, '2']}, dtype=object))
+    assert step_key('s', 'code', df) != step_key('s', 'other code', df)
+    assert step_key('s', 'code', df) != step_key('s', 'code', df.rename(columns={'a': 'b'}))
+
+
+def test_degraded_lookups_not_cached(tmp_path):
+    def unlabelled(df):
+        get_budget().needs_label.add('PATO:0000383')
+        df['donor_organism.sex'] = df['sex_ontology_term_id']
+        return df
+    start_lookup_budget()
+    df = run_cached_step('edit_sex', unlabelled, ['sex_ontology_term_id'], sample_metadata(), cache_dir=str(tmp_path))
+    assert 'donor_organism.sex' in df
+    assert not os.path.exists(tmp_path / 'edit_sex')
+    start_lookup_budget()
+
+
+def test_cached_step_replays_warnings(tmp_path, capsys):
+    calls = []
+
+    def warning_step(df):
+        calls.append(True)
+        print("Unsupported sex value PATO:0000000")
+        df['donor_organism.sex'] = df['sex_ontology_term_id']
+        return df
+    start_lookup_budget()
+    for _ in range(2):
+        run_cached_step('edit_sex', warning_step, ['sex_ontology_term_id'], sample_metadata(), cache_dir=str(tmp_path))
+    assert len(calls) == 1
+    out = capsys.readouterr().out
+    assert out.count("Unsupported sex value PATO:0000000") == 2
+    assert "`sex` (cached)" in out
@@ -0,0 +1,147 @@
+import io
+import time
+import threading
+
+import pandas as pd
+import pytest
+
+from helper_files.convert import EDIT_STEPS, edit_all_sample_metadata
+from helper_files.ontology import start_lookup_budget, get_budget
+from helper_files.step_graph import step_graph, critical_path, render_mermaid, run_step_graph
+from helper_files.utils import captured_output
+from tests.test_step_cache import sample_metadata, run_serially, mock_ols
+
+
+def add_column(name, source, value):
+    def step(df):
+        df[name] = df[source] + value
+        return df
+    return step
+
+
+def test_step_graph_edges():
+    steps = {
+        'a': {'function': None, 'inputs': ['x'], 'outputs': ['a']},
+        'b': {'function': None, 'inputs': ['y'], 'outputs': ['b']},
+        'c': {'function': None, 'inputs': ['a', 'b'], 'outputs': ['c']},
+        # overwrites a column 'b' reads
+        'd': {'function': None, 'inputs': ['x'], 'outputs': ['y']},
+        'barrier': {'function': None, 'inputs': [], 'outputs': None},
+        'e': {'function': None, 'inputs': ['x'], 'outputs': ['e']},
+    }
+    graph = step_graph(steps)
+    assert graph['a'] == set() and graph['b'] == set()
+    assert graph['c'] == {'a', 'b'}
+    assert graph['d'] == {'b'}
+    assert graph['barrier'] == {'a', 'b', 'c', 'd'}
+    assert graph['e'] == {'barrier'}
+
+
+def test_critical_path_and_mermaid():
+    graph = {'a': set(), 'b': set(), 'c': {'a', 'b'}}
+    assert critical_path(graph, {'a': 1, 'b': 3, 'c': 1}) == (['b', 'c'], 4)
+    mermaid = render_mermaid(graph, {'b': {'network': True}}, {'a': 1, 'b': 3, 'c': 1})
+    assert mermaid.startswith('flowchart TD\n')
+    assert '    b["b 3.00s (network)"]' in mermaid
+    assert '    a --> c' in mermaid and '    b --> c' in mermaid
+    assert '    class b,c critical' in mermaid
+
+
+def test_edit_steps_graph_renders():
+    mermaid = render_mermaid(step_graph(EDIT_STEPS), EDIT_STEPS)
+    assert all(step in mermaid for step in EDIT_STEPS)
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_graph_matches_serial_run(mock_ols, max_workers):
+    start_lookup_budget()
+    expected = run_serially(sample_metadata())
+    durations = {}
+    result = edit_all_sample_metadata(sample_metadata(), {}, max_workers=max_workers, durations=durations)
+    pd.testing.assert_frame_equal(result, expected)
+    assert set(durations) == set(EDIT_STEPS)
+
+
+def test_network_steps_run_concurrently():
+    running, overlapped = set(), []
+
+    def slow(name):
+        def step(df):
+            running.add(name)
+            time.sleep(0.2)
+            overlapped.append(len(running) > 1)
+            df[name] = df['x']
+            running.discard(name)
+            return df
+        return step
+
+    steps = {
+        'slow_a': {'function': slow('a'), 'inputs': ['x'], 'outputs': ['a'], 'network': True},
+        'slow_b': {'function': slow('b'), 'inputs': ['x'], 'outputs': ['b'], 'network': True},
+        'local': {'function': add_column('c', 'x', 1), 'inputs': ['x'], 'outputs': ['c']},
+    }
+    result = run_step_graph(pd.DataFrame({'x': [1, 2]}), steps, max_workers=4)
+    assert any(overlapped)
+    # columns in the order of a serial run, whichever step finished first
+    assert list(result.columns) == ['x', 'a', 'b', 'c']
+
+
+def test_worker_threads_share_budget():
+    seen = []
+
+    def lookup(df):
+        seen.append((threading.current_thread() is threading.main_thread(), get_budget()))
+        df['a'] = df['x']
+        return df
+
+    start_lookup_budget()
+    steps = {'lookup': {'function': lookup, 'inputs': ['x'], 'outputs': ['a'], 'network': True}}
+    run_step_graph(pd.DataFrame({'x': [1]}), steps, max_workers=2)
+    assert seen == [(False, get_budget())]
+
+
+def test_steps_without_inputs_skipped():
+    called = []
+
+    def missing(df):
+        called.append(True)
+        return df
+
+    steps = {
+        'a': {'function': add_column('a', 'x', 1), 'inputs': ['x'], 'outputs': ['a']},
+        'missing': {'function': missing, 'inputs': ['absent'], 'outputs': ['m']},
+        'b': {'function': add_column('b', 'a', 1), 'inputs': ['a'], 'outputs': ['b']},
+    }
+    durations = {}
+    result = run_step_graph(pd.DataFrame({'x': [1]}), steps, durations=durations)
+    assert not called
+    assert durations['missing'] == 0
+    assert result.to_dict('list') == {'x': [1], 'a': [2], 'b': [3]}
+
+
+def test_worker_output_reaches_caller_capture(capsys):
+    def chatty(name, fail=False):
+        def step(df):
+            print(f"warning from {name}")
+            if fail:
+                raise ValueError(name)
+            df[name] = df['x']
+            return df
+        return step
+
+    steps = {
+        'a': {'function': chatty('a'), 'inputs': ['x'], 'outputs': ['a'], 'network': True},
+        'b': {'function': chatty('b'), 'inputs': ['x'], 'outputs': ['b'], 'network': True},
+    }
+    log = io.StringIO()
+    with captured_output(log):
+        run_step_graph(pd.DataFrame({'x': [1]}), steps, max_workers=2)
+    # replayed in step order in the calling thread's capture
+    assert log.getvalue() == "warning from a\nwarning from b\n"
+    assert capsys.readouterr().out == ""
+
+    steps['b']['function'] = chatty('b', fail=True)
+    log = io.StringIO()
+    with captured_output(log), pytest.raises(ValueError, match="b"):
+        run_step_graph(pd.DataFrame({'x': [1]}), steps, max_workers=2)
+    assert "warning from b" in log.getvalue()
@@ -0,0 +1,71 @@
+from unittest.mock import patch
+
+import pandas as pd
+import numpy as np
+
+from helper_files import validate
+from helper_files.validate import (
+    field_modules,
+    field_prefixes,
+    validate_required_fields,
+    check_required_fields,
+    enum_property,
+    validate_enum_values
+)
+from helper_files.constants.required_fields import required_fields
+
+def test_field_modules_matches_substring_search():
+    fields = [
+        "donor_organism.death.hardy_scale",
+        "library_preparation_protocol.cell_barcode.barcode_read",
+        "project.publications.doi",
+        "dataset_id"
+    ]
+    for field in fields:
+        assert field_modules(field) == {key for key in required_fields if key in field}
+
+def test_field_prefixes():
+    assert field_prefixes(["donor_organism.development_stage.text"]) == {
+        "donor_organism", "donor_organism.development_stage", "donor_organism.development_stage.text"}
+
+def test_validate_required_fields():
+    spreadsheet = {
+        "Donor organism": pd.DataFrame({
+            "donor_organism.biomaterial_core.biomaterial_id": ["donor_1"],
+            "donor_organism.sex": ["female"],
+            "donor_organism.development_stage.text": ["adult"],
+            "donor_organism.is_living": [None]
+        }),
+        "Specimen from organism": pd.DataFrame(),
+        "Schemas": pd.DataFrame({"x": [1]})
+    }
+    missing = validate_required_fields(spreadsheet)
+    assert missing == {"Donor organism": ["donor_organism.biomaterial_core.ncbi_taxon_id",
+                                         "donor_organism.is_living"]}
+
+def test_check_required_fields_complete(capsys):
+    spreadsheet = {"Cell suspension": pd.DataFrame({
+        "cell_suspension.biomaterial_core.biomaterial_id": ["lib_1"],
+        "cell_suspension.biomaterial_core.ncbi_taxon_id": [9606]
+    })}
+    assert check_required_fields(spreadsheet) == {}
+    assert "MISSING" not in capsys.readouterr().out
+
+def test_enum_property():
+    assert enum_property("specimen_from_organism.preservation_storage.storage_method") == ("preservation_storage", "storage_method")
+    assert enum_property("dissociation_protocol.method.text") == (None, None)
+    assert enum_property("dataset_id") == (None, None)
+
+@patch.object(validate, "get_xml_keys", return_value=("module/biomaterial/6.0.0/preservation_storage",))
+@patch.object(validate, "get_entity_schema")
+def test_validate_enum_values(mock_schema, mock_keys):
+    mock_schema.return_value = {"properties": {"storage_method": {"enum": ["frozen", "fresh"]}}}
+    validate.ENUM_CACHE.clear()
+    field = "specimen_from_organism.preservation_storage.storage_method"
+    df = pd.DataFrame({field: ["frozen", "dried", "dried", np.nan, "fresh"],
+                       "donor_organism.biomaterial_core.biomaterial_id": ["d1"] * 5})
+    violations = validate_enum_values(df, fields=df.columns)
+    assert violations.to_dict(orient="records") == [{"field": field, "value": "dried", "n_rows": 2}]
+    # schema is fetched once and cached with its version
+    validate_enum_values(df)
+    assert mock_schema.call_count == 1
@@ -0,0 +1,131 @@
+import os
+
+import pandas as pd
+import pytest
+
+import watch_metadata
+from watch_metadata import (
+    classify_workbook,
+    workbook_label,
+    settled_changes,
+    process_changes,
+    scan
+)
+
+
+TIER1_DATASET = {"Tier 1 Dataset Metadata": ["title", "study_pi"]}
+TIER1_DONOR = {"Tier 1 Donor Metadata": ["donor_id", "sex_ontology_term_id"]}
+TIER2_DONOR = {"Tier 2 Donor Metadata": ["donor_id", "bmi"]}
+TIER2_SAMPLE = {"Tier 2 Sample Metadata": ["sample_id", "cell_suspension_storage_time"]}
+
+
+def write_workbook(path, tabs):
+    with pd.ExcelWriter(path) as writer:
+        for tab, columns in tabs.items():
+            pd.DataFrame({col: [1] for col in columns}).to_excel(writer, sheet_name=tab, index=False)
+
+
+def test_classify_workbook(tmp_path):
+    write_workbook(tmp_path / "t1.xlsx", {**TIER1_DATASET, **TIER1_DONOR})
+    write_workbook(tmp_path / "t2.xlsx", TIER2_DONOR)
+    write_workbook(tmp_path / "fm.xlsx", {"File_manifest": ["file_name", "library_id"]})
+    pd.DataFrame({"file_name": ["a.fastq.gz"], "library_ID": ["l1"]}).to_csv(tmp_path / "fm.tsv", sep="\t", index=False)
+    pd.DataFrame({"other": [1]}).to_csv(tmp_path / "other.csv", index=False)
+    assert [classify_workbook(str(tmp_path / name)) for name in ["t1.xlsx", "t2.xlsx", "fm.xlsx", "fm.tsv", "other.csv"]] == \
+        ["tier1", "tier2", "file_manifest", "file_manifest", None]
+
+
+def test_classify_workbook_from_headers(tmp_path):
+    # tab names as submitted, the headers tell the kind
+    write_workbook(tmp_path / "t2.xlsx", {"Tier2": ["Donor_ID", "age_value", "BMI"], "GDN": ["donor_id", "smoking_status"]})
+    write_workbook(tmp_path / "t1.xlsx", {"Sheet1": ["library_id", "tissue_ontology_term_id", "sample_source"]})
+    write_workbook(tmp_path / "keys.xlsx", {"Tier 2": ["donor_id", "sample_id"]})
+    assert [classify_workbook(str(tmp_path / name)) for name in ["t2.xlsx", "t1.xlsx", "keys.xlsx"]] == \
+        ["tier2", "tier1", None]
+
+
+def test_workbook_label():
+    assert workbook_label("metadata/hca_tier1_metadata_lung.xlsx") == "lung"
+    assert workbook_label("metadata/hca_tier2_metadata_lung.xlsx") == "lung"
+    assert workbook_label("metadata/lung_file_manifest.tsv") == "lung"
+
+
+def test_settled_changes_debounce():
+    state = {"files": {"a.xlsx": {"stat": [1, 10]}}, "stages": {}}
+    pending = {}
+    snapshot = {"a.xlsx": [1, 10], "b.xlsx": [1, 10]}
+    # unchanged files are ignored, new ones wait for the debounce
+    assert settled_changes(snapshot, pending, state, 2, now=0) == []
+    assert settled_changes(snapshot, pending, state, 2, now=1) == []
+    # still being written: the debounce restarts
+    snapshot["b.xlsx"] = [2, 20]
+    assert settled_changes(snapshot, pending, state, 2, now=2) == []
+    assert settled_changes(snapshot, pending, state, 2, now=4) == ["b.xlsx"]
+    assert pending == {}
+
+
+@pytest.fixture
+def watched(tmp_path, mocker):
+    run_stage = mocker.patch.object(watch_metadata, "run_stage", side_effect=lambda stage, inputs, output_dir, local_template: stage)
+    write_workbook(tmp_path / "lung_tier1.xlsx", TIER1_DATASET)
+    write_workbook(tmp_path / "lung_tier2.xlsx", TIER2_DONOR)
+    return tmp_path, run_stage
+
+
+def process(tmp_path, state, *names):
+    snapshot = scan(str(tmp_path))
+    return process_changes([os.path.join(str(tmp_path), name) for name in names], snapshot, state, str(tmp_path))
+
+
+def test_process_changes_runs_dependent_stages(watched, capsys):
+    tmp_path, run_stage = watched
+    state = {"files": {}, "stages": {}}
+    assert process(tmp_path, state, "lung_tier1.xlsx", "lung_tier2.xlsx") == {"lung": ["collect", "convert"]}
+    inputs = run_stage.call_args.args[1]
+    assert inputs["tier2"]["path"].endswith("lung_tier2.xlsx")
+
+    # a tier 2 edit only converts again
+    write_workbook(tmp_path / "lung_tier2.xlsx", {**TIER2_DONOR, **TIER2_SAMPLE})
+    assert process(tmp_path, state, "lung_tier2.xlsx") == {"lung": ["convert"]}
+
+    # saving without changes runs nothing
+    os.utime(tmp_path / "lung_tier1.xlsx")
+    assert process(tmp_path, state, "lung_tier1.xlsx") == {}
+    assert run_stage.call_count == 3
+
+
+def test_process_changes_waits_for_tier1(watched, capsys):
+    tmp_path, run_stage = watched
+    state = {"files": {}, "stages": {}}
+    assert process(tmp_path, state, "lung_tier2.xlsx") == {}
+    assert "Waiting for the tier 1 workbook of lung" in capsys.readouterr().out
+    run_stage.assert_not_called()
+
+
+def test_failed_stage_is_retried(watched):
+    tmp_path, run_stage = watched
+    run_stage.side_effect = ValueError("bad workbook")
+    state = {"files": {}, "stages": {}}
+    assert process(tmp_path, state, "lung_tier1.xlsx") == {}
+    assert run_stage.call_count == 1
+    run_stage.side_effect = lambda stage, inputs, output_dir, local_template: stage
+    write_workbook(tmp_path / "lung_tier1.xlsx", {**TIER1_DATASET, **TIER1_DONOR})
+    assert process(tmp_path, state, "lung_tier1.xlsx") == {"lung": ["collect", "convert"]}
+
+
+def test_main_once(tmp_path, mocker):
+    process = mocker.patch.object(watch_metadata, "process_changes")
+    write_workbook(tmp_path / "lung_tier1.xlsx", TIER1_DATASET)
+    watch_metadata.main(input_dir=str(tmp_path), output_dir=str(tmp_path), once=True)
+    assert process.call_args.args[0] == [str(tmp_path / "lung_tier1.xlsx")]
+    assert os.path.exists(tmp_path / ".watch_state.json")
+
+
+def test_unknown_workbook_is_reported(watched, capsys):
+    tmp_path, run_stage = watched
+    write_workbook(tmp_path / "notes.xlsx", {"Sheet1": ["comment"]})
+    state = {"files": {}, "stages": {}}
+    assert process(tmp_path, state, "notes.xlsx") == {}
+    assert "notes.xlsx has no tier 1, tier 2 or file manifest header fields" in capsys.readouterr().out
+    assert state["files"][str(tmp_path / "notes.xlsx")]["kind"] is None
+    run_stage.assert_not_called()
@@ -0,0 +1,235 @@
+import os
+import re
+import json
+import time
+import hashlib
+import argparse
+
+import pandas as pd
+
+import collect_spreadsheet_metadata
+import convert_to_dcp
+from helper_files.convert import tiered_suffix
+from helper_files.constants.tier1_mapping import tier1_list, KEY_COLS
+from helper_files.constants.tier2_mapping import TIER2_TO_DCP, TIER2_TO_DCP_UPDATE
+from helper_files.utils import filename_suffixed, get_label, detect_excel_format, BOLD_START, BOLD_END
+
+WATCH_EXTENSIONS = ('.xlsx', '.csv', '.tsv')
+STATE_FILE = '.watch_state.json'
+BUFFER_SIZE = 1024 * 1024
+
+# header fields telling tier 1 and tier 2 workbooks apart, whatever their tab names
+TIER2_FIELDS = {field.lower() for field in {**TIER2_TO_DCP, **TIER2_TO_DCP_UPDATE}}
+TIER1_ONLY_FIELDS = set(tier1_list) - TIER2_FIELDS - set(KEY_COLS)
+TIER2_ONLY_FIELDS = TIER2_FIELDS - set(tier1_list) - set(KEY_COLS)
+
+# inputs each stage depends on, in pipeline order
+STAGE_INPUTS = {
+    'collect': ['tier1'],
+    'convert': ['tier1', 'tier2', 'file_manifest']
+}
+
+def define_parser():
+    """Defines and returns the argument parser."""
+    parser = argparse.ArgumentParser(description="Watch a directory and re-run the stages depending on new or changed tier 1, tier 2 and file manifest workbooks")
+    parser.add_argument("-i", "--input_dir", action="store", default='metadata',
+                        dest="input_dir", type=str, required=False,
+                        help="Directory where submitted workbooks are dropped")
+    parser.add_argument("-o", "--output_dir", action="store", default='metadata',
+                        dest="output_dir", type=str, required=False,
+                        help="Directory with the t1/ and dt/ output directories")
+    parser.add_argument("--interval", action="store", default=1,
+                        dest="interval", type=float, required=False,
+                        help="Seconds between directory scans")
+    parser.add_argument("--debounce", action="store", default=2,
+                        dest="debounce", type=float, required=False,
+                        help="Seconds a file must stay unchanged before it is processed")
+    parser.add_argument("-lt", "--local_template", action="store",
+                        dest="local_template", type=str, required=False,
+                        help="Local path of the HCA spreadsheet template")
+    parser.add_argument("--once", action="store_true",
+                        dest="once", required=False,
+                        help="Process pending changes once and exit")
+    return parser
+
+def file_sha256(path, buffer_size=BUFFER_SIZE):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(buffer_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def is_workbook(name):
+    # skip office lock files and hidden files
+    return name.lower().endswith(WATCH_EXTENSIONS) and not name.startswith(('~$', '.'))
+
+def scan(input_dir):
+    """{path: [mtime_ns, size]} of the workbooks directly in input_dir. Output sub-directories are not watched."""
+    with os.scandir(input_dir) as entries:
+        return {entry.path: [entry.stat().st_mtime_ns, entry.stat().st_size]
+                for entry in entries if entry.is_file() and is_workbook(entry.name)}
+
+def header_kind(columns):
+    """'file_manifest' for a header with file_name, else 'tier1' or 'tier2' for the tier with more fields only
+    its own mapping has (shared keys like donor_id don't count), None if neither."""
+    columns = {str(col).lower() for col in columns}
+    if 'file_name' in columns:
+        return 'file_manifest'
+    n_tier1, n_tier2 = len(columns & TIER1_ONLY_FIELDS), len(columns & TIER2_ONLY_FIELDS)
+    if n_tier1 == n_tier2:
+        return None
+    return 'tier1' if n_tier1 > n_tier2 else 'tier2'
+
+def classify_workbook(path):
+    """Return 'tier1', 'tier2' or 'file_manifest' from the header columns of all tabs of a workbook
+    or of a csv, None if unknown."""
+    if path.lower().endswith('.xlsx'):
+        with pd.ExcelFile(path) as excel:
+            skiprows = detect_excel_format(excel)
+            header = [col for sheet in excel.sheet_names if sheet != 'validation_sheet'
+                      for col in excel.parse(sheet, skiprows=skiprows, nrows=0).columns]
+    else:
+        header = pd.read_csv(path, sep=None, engine='python', nrows=0).columns
+    return header_kind(header)
+
+def workbook_label(path):
+    """Label of the dataset a workbook belongs to: tier 2 and file manifest workbooks
+    get the label of the tier 1 workbook with the same name."""
+    name = re.sub(r'(tier[_\s-]*)2', r'\g<1>1', os.path.basename(path), flags=re.I)
+    name = re.sub(r'[_\s-]*file[_\s-]*manifest', '', name, flags=re.I)
+    return get_label(name)
+
+def settled_changes(snapshot, pending, state, debounce, now):
+    """Return the paths of snapshot that changed since they were last processed and stayed
+    unchanged for debounce seconds. pending keeps {path: [stat, first seen]} between scans."""
+    ready = []
+    for path in set(pending) - set(snapshot):
+        del pending[path]
+    for path, stat in snapshot.items():
+        known = state['files'].get(path)
+        if known and known['stat'] == stat:
+            continue
+        if path not in pending or pending[path][0] != stat:
+            pending[path] = [stat, now]
+        elif now - pending[path][1] >= debounce:
+            ready.append(path)
+            del pending[path]
+    return sorted(ready)
+
+def load_state(state_path):
+    if not os.path.exists(state_path):
+        return {'files': {}, 'stages': {}}
+    with open(state_path, 'r', encoding='utf-8') as state:
+        return json.load(state)
+
+def save_state(state, state_path):
+    with open(state_path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(state, file, indent=2)
+    os.replace(state_path + '.tmp', state_path)
+
+def label_inputs(state, label):
+    """{kind: {'path', 'sha256'}} of the latest workbook of each kind for label."""
+    inputs = {}
+    for path, entry in sorted(state['files'].items(), key=lambda item: item[1]['stat'][0]):
+        if entry['label'] == label and entry['kind']:
+            inputs[entry['kind']] = {'path': path, 'sha256': entry['sha256']}
+    return inputs
+
+def stale_stages(state, label):
+    """Stages of label whose input fingerprints differ from the ones of their last run, in pipeline order."""
+    inputs = label_inputs(state, label)
+    if 'tier1' not in inputs:
+        return []
+    last_runs = state['stages'].get(label, {})
+    return [stage for stage, kinds in STAGE_INPUTS.items()
+            if last_runs.get(stage) != stage_fingerprint(inputs, kinds)]
+
+def stage_fingerprint(inputs, kinds):
+    return {kind: inputs[kind]['sha256'] for kind in kinds if kind in inputs}
+
+def run_stage(stage, inputs, output_dir, local_template=None):
+    """Run a stage with the current inputs of a label and return its output path."""
+    t1_dir, dt_dir = os.path.join(output_dir, 't1'), os.path.join(output_dir, 'dt')
+    tier2 = inputs.get('tier2', {}).get('path')
+    file_manifest = inputs.get('file_manifest', {}).get('path')
+    if stage == 'collect':
+        os.makedirs(t1_dir, exist_ok=True)
+        label = collect_spreadsheet_metadata.main(inputs['tier1']['path'], t1_dir)
+        return filename_suffixed(t1_dir, label, 'metadata')
+    if stage == 'convert':
+        os.makedirs(dt_dir, exist_ok=True)
+        flat_tier1 = filename_suffixed(t1_dir, get_label(inputs['tier1']['path']), 'metadata')
+        convert_to_dcp.main(flat_tier1, tier2_spreadsheet=tier2, file_manifest=file_manifest,
+                            output_dir=dt_dir, local_template=local_template)
+        return filename_suffixed(dt_dir, get_label(flat_tier1), tiered_suffix(tier2, file_manifest), ext='xlsx')
+    raise ValueError(f"Unknown stage {stage}")
+
+def process_changes(paths, snapshot, state, output_dir, local_template=None):
+    """Fingerprint changed workbooks and re-run the stale stages of their labels.
+    Return {label: [stages run]}."""
+    labels = []
+    for path in paths:
+        sha256 = file_sha256(path)
+        known = state['files'].get(path)
+        if known and known['sha256'] == sha256:
+            # saved without changes
+            known['stat'] = snapshot[path]
+            continue
+        try:
+            kind = classify_workbook(path)
+        except (ValueError, OSError) as e:
+            print(f"{BOLD_START}WARNING:{BOLD_END} Could not read {path}: {e}")
+            continue
+        label = workbook_label(path)
+        state['files'][path] = {'stat': snapshot[path], 'sha256': sha256, 'kind': kind, 'label': label}
+        if not kind:
+            print(f"{BOLD_START}WARNING:{BOLD_END} {path} has no tier 1, tier 2 or file manifest header fields, not processed")
+            continue
+        print(f"{BOLD_START}CHANGED:{BOLD_END} {path} ({kind}, label {label})")
+        if label not in labels:
+            labels.append(label)
+
+    stages_run = {}
+    for label in labels:
+        inputs = label_inputs(state, label)
+        for stage in stale_stages(state, label):
+            start = time.monotonic()
+            try:
+                output = run_stage(stage, inputs, output_dir, local_template)
+            except Exception as e:
+                print(f"{BOLD_START}ERROR:{BOLD_END} {stage} of {label} failed: {type(e).__name__}: {e}")
+                break
+            state['stages'].setdefault(label, {})[stage] = stage_fingerprint(inputs, STAGE_INPUTS[stage])
+            stages_run.setdefault(label, []).append(stage)
+            print(f"{BOLD_START}{stage.upper()} {label}{BOLD_END} done in {time.monotonic() - start:.1f}s: {output}")
+        if label not in stages_run and 'tier1' not in inputs:
+            print(f"Waiting for the tier 1 workbook of {label}.")
+    return stages_run
+
+def main(input_dir='metadata', output_dir='metadata', interval=1, debounce=2, local_template=None, once=False):
+    state_path = os.path.join(input_dir, STATE_FILE)
+    state = load_state(state_path)
+    pending = {}
+    print(f"Watching {input_dir} for tier 1, tier 2 and file manifest workbooks. Ctrl+C to stop.")
+    try:
+        while True:
+            snapshot = scan(input_dir)
+            now = time.monotonic()
+            ready = settled_changes(snapshot, pending, state, debounce, now)
+            if once:
+                # the first scan only registers changes, settle them right away
+                ready = settled_changes(snapshot, pending, state, 0, now)
+            if ready:
+                process_changes(ready, snapshot, state, output_dir, local_template)
+                save_state(state, state_path)
+            if once:
+                return state
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        save_state(state, state_path)
+    return state
+
+if __name__ == "__main__":
+    args = define_parser().parse_args()
+    main(input_dir=args.input_dir, output_dir=args.output_dir, interval=args.interval,
+         debounce=args.debounce, local_template=args.local_template, once=args.once)